@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Measures latency of PUT /issue/<ref> changing status against number of sponsors
+notified. Uses in-memory database, run from the project directory:
+
+    python benchmark/notify_sponsors.py
+"""
+
+import sys, os, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from bountyfunding.core.config import config
+config.init(dict(config_file="", db_in_memory=True))
+
+import bountyfunding
+from bountyfunding.core.const import SponsorshipStatus
+from bountyfunding.core.data import create_database, retrieve_create_users
+from bountyfunding.core.models import db, Sponsorship, Email
+
+SPONSOR_COUNTS = [1, 10, 100, 300, 1000, 3000]
+REPEAT = 5
+
+
+def create_sponsors(app, ref, count):
+    app.post('/issues', data=dict(ref=ref, status='READY', title='Title', link='/issue/%s' % ref))
+    issue_id = to_issue_id(ref)
+    user_ids = retrieve_create_users(1, ['sponsor%d' % i for i in xrange(count)])
+    db.session.execute(Sponsorship.__table__.insert(), [dict(project_id=1, issue_id=issue_id, 
+        user_id=user_id, amount=10, status=SponsorshipStatus.PLEDGED) for user_id in user_ids.values()])
+    db.session.commit()
+
+def to_issue_id(ref):
+    return db.session.execute('SELECT issue_id FROM issue WHERE issue_ref = :ref', 
+            dict(ref=str(ref))).scalar()
+
+def main():
+    app = bountyfunding.app.test_client()
+    app.get('/version')
+    create_database()
+
+    print '%10s %12s %12s' % ('sponsors', 'median ms', 'max ms')
+    ref = 0
+    for count in SPONSOR_COUNTS:
+        timings = []
+        for i in xrange(REPEAT):
+            ref += 1
+            create_sponsors(app, ref, count)
+            start = time.time()
+            r = app.put('/issue/%d' % ref, data=dict(status='STARTED'))
+            timings.append((time.time() - start) * 1000)
+            assert r.status_code == 200, r.data
+        timings.sort()
+        print '%10d %12.1f %12.1f' % (count, timings[len(timings) / 2], timings[-1])
+
+    print '%d emails created' % Email.query.count()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Measures throughput of concurrent reads and writes against number of threads
+on SQLite database file, with default driver settings and without retries,
+production profile, and with group committing writer. Writer saves disk syncs 
+with synchronous=FULL, in WAL mode NORMAL syncs only on checkpoints.
+Run from the project directory, optionally with fraction of writes:
+
+    python benchmark/sqlite_profile.py [write_ratio]
+"""
+
+import sys, os, time, random, threading, tempfile, shutil, subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+THREAD_COUNTS = [1, 2, 4, 8]
+VARIANTS = [
+    ('default', dict(profile='default', synchronous='full', retries=0, writer=False)),
+    ('production', dict(profile='production', synchronous='normal', retries=5, writer=False)),
+    ('writer', dict(profile='production', synchronous='normal', retries=5, writer=True)),
+    ('full', dict(profile='production', synchronous='full', retries=5, writer=False)),
+    ('full+writer', dict(profile='production', synchronous='full', retries=5, writer=True)),
+]
+DURATION = 5
+ISSUES = 100
+# Fraction of requests modifying an issue by default, the rest read one
+WRITE_RATIO = 0.2
+
+CONFIG = """
+[general]
+database_url = sqlite:///%(path)s
+threads = %(threads)d
+secret = benchmark
+
+[sqlite]
+profile = %(profile)s
+synchronous = %(synchronous)s
+busy_retries = %(retries)d
+writer = %(writer)s
+
+[log]
+exceptions = True
+"""
+
+
+def run(variant, threads, write_ratio):
+    """Runs single measurement in this process, prints one result line"""
+    directory = tempfile.mkdtemp()
+    try:
+        config_file = os.path.join(directory, 'bountyfunding.ini')
+        with open(config_file, 'w') as f:
+            f.write(CONFIG % dict(dict(VARIANTS)[variant], threads=threads,
+                path=os.path.join(directory, 'bench.db')))
+
+        from bountyfunding.core.config import config
+        config.init(dict(config_file=config_file))
+
+        import bountyfunding
+        from bountyfunding.util.metrics import metrics
+        from flask import json
+
+        app = bountyfunding.app.test_client()
+        app.get('/version')
+        issues = [dict(ref=i, status='READY', title='Title', link='/issue/%d' % i)
+                for i in xrange(ISSUES)]
+        app.post('/issues/bulk', data=json.dumps(issues), content_type='application/json')
+
+        counts = dict(reads=0, writes=0, errors=0)
+        lock = threading.Lock()
+        deadline = time.time() + DURATION
+
+        def worker():
+            client = bountyfunding.app.test_client()
+            while time.time() < deadline:
+                ref = random.randrange(ISSUES)
+                write = random.random() < write_ratio
+                try:
+                    if write:
+                        r = client.put('/issue/%d' % ref, data=dict(title='Title %f' % time.time()))
+                    else:
+                        r = client.get('/issue/%d' % ref)
+                    key = 'errors' if r.status_code >= 400 else 'writes' if write else 'reads'
+                except Exception:
+                    key = 'errors'
+                with lock:
+                    counts[key] += 1
+
+        workers = [threading.Thread(target=worker) for i in xrange(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        groups = metrics.get('writer.groups')
+        print '%12s %8d %10.1f %10.1f %8d %8d %8.1f' % (variant, threads,
+                counts['reads'] / float(DURATION), counts['writes'] / float(DURATION),
+                counts['errors'], metrics.get('sqlite.busy_retries'),
+                metrics.get('writer.requests') / float(groups) if groups else 1)
+        sys.stdout.flush()
+        # Background threads of the webapp would keep the database busy
+        os._exit(0)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main(write_ratio):
+    print '%12s %8s %10s %10s %8s %8s %8s' % ('variant', 'threads', 'reads/s', 'writes/s',
+            'errors', 'retries', 'group')
+    sys.stdout.flush()
+    for variant, settings in VARIANTS:
+        for threads in THREAD_COUNTS:
+            # Engine is configured once per process
+            subprocess.call([sys.executable, __file__, str(write_ratio), variant, str(threads)])
+
+if __name__ == '__main__':
+    write_ratio = float(sys.argv[1]) if len(sys.argv) > 1 else WRITE_RATIO
+    if len(sys.argv) == 4:
+        run(sys.argv[2], int(sys.argv[3]), write_ratio)
+    else:
+        main(write_ratio)
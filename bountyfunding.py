@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import sys
 from os import path
 from argparse import ArgumentParser
 from waitress import serve
@@ -10,6 +11,11 @@ from bountyfunding.core.config import config
 from bountyfunding.core import models
 from bountyfunding.core.models import db
 from bountyfunding.core import const
+from bountyfunding.core import totals
+from bountyfunding.core import compact as compaction
+from bountyfunding.core import shards
+from bountyfunding.util.homer import BOUNTYFUNDING_HOME
+from datetime import datetime, timedelta
 
 
 # TODO: merge with functions or use real action classes with docstrings
@@ -17,13 +23,54 @@ class Action(Enum):
     RUN = 'run'
     CREATE_DB = 'create-db'
     SHELL = 'shell'
+    REBUILD_TOTALS = 'rebuild-totals'
+    CHECK_TOTALS = 'check-totals'
+    COMPACT = 'compact'
+    MOVE_PROJECT = 'move-project'
 
 def run():
     serve(app, host=config.HOST, port=config.PORT, threads=config.THREADS)
 
 def create_db():
     print 'Creating database in %s' % config.DATABASE_URL
-    db.create_all()
+    for engine in shards.shard_map.engines():
+        db.metadata.create_all(engine)
+
+def rebuild_totals():
+    print 'Rebuilding issue totals in %s' % config.DATABASE_URL
+    totals.rebuild_issue_totals()
+
+def check_totals():
+    inconsistencies = totals.check_issue_totals()
+    for issue_id, expected, stored in inconsistencies:
+        print 'Issue %s: expected %s, stored %s' % (issue_id, expected, stored)
+    print '%d inconsistent issue totals' % len(inconsistencies)
+    if inconsistencies:
+        sys.exit(1)
+
+def compact():
+    before = datetime.now() - timedelta(days=config.COMPACT_MAX_AGE)
+    archive_dir = path.join(BOUNTYFUNDING_HOME, config.COMPACT_ARCHIVE_DIR)
+    archive_path, archived = compaction.archive_changes(before, archive_dir)
+    print 'Archived %d changes older than %s' % (archived, before.date()),
+    print 'to %s' % archive_path if archive_path else ''
+
+    if config.COMPACT_RESPONSE_LENGTH > 0:
+        truncated = compaction.truncate_responses(config.COMPACT_RESPONSE_LENGTH)
+        print 'Truncated %d responses' % truncated
+
+    print 'Optimizing database'
+    compaction.optimize(config.COMPACT_VACUUM)
+
+def move_project(name, shard):
+    if not name or not shard:
+        sys.exit('Both --project and --shard are required')
+    project = models.Project.query.filter_by(name=name).first()
+    if project == None:
+        sys.exit('Unknown project: %s' % name)
+    print 'Moving project %s to %s, its writes are refused until done' % (name, shard)
+    moved = shards.move_project(project.project_id, shard)
+    print 'Moved %d rows' % moved
 
 def shell():
     namespace = dict(app=app, db=db, config=config, models=models, const=const)
@@ -75,6 +122,19 @@ if __name__ == "__main__":
             action='store', type=int, default=None,
             help='Number of worker threads')
 
+    arg_parser.add_argument('--compact-max-age', 
+            action='store', type=int, default=None, metavar='DAYS',
+            help='Archive changes older than that many days when compacting')
+
+    arg_parser.add_argument('--project', 
+            action='store', default=None, metavar='NAME',
+            help='Project moved by move-project action, its writes are refused for about '
+            '%d seconds while running servers notice the move and data is copied' % (2 * shards.MOVE_WAIT))
+
+    arg_parser.add_argument('--shard', 
+            action='store', default=None, metavar='NAME',
+            help='Shard to which move-project action moves the project, main for database url')
+
     args = vars(arg_parser.parse_args())
    
     config.init(args)
@@ -90,5 +150,17 @@ if __name__ == "__main__":
     elif action == Action.SHELL:
         shell()
 
+    elif action == Action.REBUILD_TOTALS:
+        rebuild_totals()
+
+    elif action == Action.CHECK_TOTALS:
+        check_totals()
+
+    elif action == Action.COMPACT:
+        compact()
+
+    elif action == Action.MOVE_PROJECT:
+        move_project(args['project'], args['shard'])
+
     else: 
         assert False, 'Invalid action: %s' % action 
@@ -1,6 +1,40 @@
-from flask import Flask
+from flask import Flask, request, copy_current_request_context
 
-app = Flask(__name__)
+
+# Batches and GUI requests commit in the middle, payments call their gateways
+UNREPEATABLE_ENDPOINTS = ('api.post_batch', 'api.put_payment', 'api.create_payment')
+
+def is_repeatable():
+    """Whether request failing on locked database can be dispatched again,
+    API views read the body buffered by the first attempt"""
+    return request.blueprint == 'api' and request.endpoint not in UNREPEATABLE_ENDPOINTS
+
+
+class BountyFunding(Flask):
+    def full_dispatch_request(self):
+        dispatch = super(BountyFunding, self).full_dispatch_request
+        if request.method not in ('POST', 'PUT', 'DELETE'):
+            response = dispatch()
+            # Some pages write while displayed
+            if db.session().info.get('primary'):
+                replica_router.written()
+            return response
+
+        # Batch and GUI requests commit in the middle, they cannot share transaction
+        if writer.is_running() and request.blueprint == 'api' and request.endpoint != 'api.post_batch':
+            dispatch = lambda: writer.submit(copy_current_request_context(
+                    super(BountyFunding, self).full_dispatch_request))
+
+        # Concurrent writers may find SQLite database locked, whole request is
+        # repeated in a new transaction, unless it has effects outside of it
+        retries = None if is_repeatable() else 0
+        response = retry_busy(dispatch, db.session.rollback, retries)
+        # Following reads of the client wait for the replica to catch up
+        replica_router.written()
+        return response
+
+
+app = BountyFunding(__name__)
 
 from bountyfunding.api import api
 
@@ -10,3 +44,7 @@ from bountyfunding.gui import gui
 
 app.register_blueprint(gui)
 
+from bountyfunding.core.models import db
+from bountyfunding.core.sqlite_profile import retry_busy
+from bountyfunding.core.writer import writer
+from bountyfunding.core.replica import replica_router
@@ -0,0 +1,69 @@
+from bountyfunding.core.totals import totals_listeners
+from bountyfunding.util.cache import LruCache
+from bountyfunding.util.metrics import metrics
+
+import hashlib, threading
+
+
+CACHE_SIZE = 4096
+
+# Badges are embedded in issue pages and fetched through image proxies
+CACHE_CONTROL = 'public, max-age=60, stale-while-revalidate=600'
+
+
+class Badge:
+
+    def __init__(self, issue_id, bounty, body):
+        self.issue_id = issue_id
+        self.bounty = bounty
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+
+
+class BadgeCache:
+    """Rendered SVG badges by project name and issue reference. Badges are
+    stored only if no invalidation happened since their rendering started,
+    so one rendered before a sponsorship commit is not cached after it"""
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.badges = LruCache(max_size)
+        self.lock = threading.Lock()
+        self.version = 0
+
+    def get(self, project_name, issue_ref):
+        badge = self.badges.get((project_name, issue_ref))
+        if badge != None:
+            metrics.increment('badge_cache.hits')
+        else:
+            metrics.increment('badge_cache.misses')
+        return badge
+
+    def current_version(self):
+        """Taken before reading the data of a badge and passed to put"""
+        return self.version
+
+    def put(self, project_name, issue_ref, badge, version):
+        with self.lock:
+            if version == self.version:
+                self.badges.put((project_name, issue_ref), badge)
+
+    def invalidate_issues(self, issue_ids):
+        issue_ids = set(issue_ids)
+        with self.lock:
+            self.version += 1
+            self.badges.invalidate_if(lambda key, badge: badge.issue_id in issue_ids)
+
+    def invalidate_project(self, project_name):
+        with self.lock:
+            self.version += 1
+            self.badges.invalidate_if(lambda key, badge: key[0] == project_name)
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.badges.clear()
+
+
+badge_cache = BadgeCache()
+
+totals_listeners.append(badge_cache.invalidate_issues)
@@ -0,0 +1,96 @@
+from bountyfunding.core.config import config
+from bountyfunding.core.changes import change_notifier, changes_key, emails_key, \
+        change_type, retrieve_changes, retrieve_last_change_id, mapify_change
+from bountyfunding.util.metrics import metrics
+
+import threading, time, json
+
+
+# Waiting stream is closed after this many seconds, releasing its worker
+# thread, client reconnects with Last-Event-ID after STREAM_RETRY
+STREAM_DURATION = 5
+
+# Milliseconds after which subscriber of a closed waiting stream reconnects
+STREAM_RETRY = 1000
+
+# Milliseconds after which subscriber without waiting slot reconnects
+POLL_RETRY = 5000
+
+BATCH_SIZE = 100
+
+# Worker threads per waiting slot, waiting subscribers may hold a quarter
+# of the pool at most, none with fewer than four threads
+THREADS_PER_WAITING_SLOT = 4
+
+
+class WaitingSlots:
+    """Waitress serves each response from a worker thread, which a stream
+    waiting for events holds until it is closed. Only few threads may wait,
+    other subscribers are served pending events and poll"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.waiting >= config.THREADS / THREADS_PER_WAITING_SLOT:
+                return False
+            self.waiting += 1
+            metrics.set('events.waiting', self.waiting)
+            return True
+
+    def release(self):
+        with self.lock:
+            self.waiting -= 1
+            metrics.set('events.waiting', self.waiting)
+
+
+waiting_slots = WaitingSlots()
+
+
+def format_event(event, data, id=None):
+    lines = []
+    if id != None:
+        lines.append('id: %s' % id)
+    lines.append('event: %s' % event)
+    lines.append('data: %s' % json.dumps(data))
+    return '\n'.join(lines) + '\n\n'
+
+def stream_events(project_id, last_id):
+    """Generates Server-Sent Events of changes after last_id, None means only
+    the future ones. Without free waiting slot only pending events are sent"""
+    if last_id == None:
+        last_id = retrieve_last_change_id(project_id)
+
+    keys = [changes_key(project_id), emails_key(project_id)]
+    versions = change_notifier.snapshot(keys)
+
+    waiting = waiting_slots.acquire()
+    try:
+        if waiting:
+            metrics.increment('events.streams')
+            yield 'retry: %d\n\n' % STREAM_RETRY
+        else:
+            metrics.increment('events.polls')
+            yield 'retry: %d\n\n' % POLL_RETRY
+
+        deadline = time.time() + STREAM_DURATION
+        while True:
+            changes = retrieve_changes(project_id, last_id, BATCH_SIZE)
+            for change in changes:
+                last_id = change.change_id
+                yield format_event(change_type(change.path), mapify_change(change), last_id)
+            if len(changes) == BATCH_SIZE:
+                continue
+
+            timeout = deadline - time.time()
+            if not waiting or timeout <= 0:
+                break
+            current = change_notifier.wait(versions, timeout)
+            if current[emails_key(project_id)] != versions[emails_key(project_id)]:
+                yield format_event('email', dict(type='email'))
+            versions = current
+    finally:
+        if waiting:
+            waiting_slots.release()
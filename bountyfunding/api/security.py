@@ -2,7 +2,9 @@ from bountyfunding.core.errors import SecurityError
 from bountyfunding.core.models import Project, Token
 from bountyfunding.core.const import ProjectType
 from bountyfunding.core.config import config
-from bountyfunding.core.data import retrieve_project
+from bountyfunding.core.data import retrieve_project, project_cache
+from bountyfunding.core.replica import replica_router
+from bountyfunding.util.metrics import metrics
 
 
 class ImmutableProject:
@@ -17,6 +19,20 @@ class ImmutableProject:
         return False
 
 
+class ProjectSnapshot:
+    """Detached copy of a database project, safe to share between requests"""
+
+    def __init__(self, project):
+        self.project_id = project.project_id
+        self.name = project.name
+        self.description = project.description
+        self.type = project.type
+        self.mutable = project.is_mutable()
+
+    def is_mutable(self):
+        return self.mutable
+
+
 DEFAULT_PROJECT = ImmutableProject(1, 'Default', 'Default project', ProjectType.NORMAL)
 DEFAULT_TOKEN = 'default'
 
@@ -55,8 +71,21 @@ def get_project(token):
         else:
             raise SecurityError("Root token disabled")
 
-    project = retrieve_project(token)
+    project = project_cache.get(token)
+    if project != None:
+        metrics.increment('project_cache.hits')
+        return project
+
+    metrics.increment('project_cache.misses')
+    # Snapshot read before a concurrent update commits is not cached after
+    # its invalidation
+    version = project_cache.version
+    # Cached project is invalidated on commit to the primary
+    with replica_router.primary():
+        project = retrieve_project(token)
     if project != None:
+        project = ProjectSnapshot(project)
+        project_cache.put(token, project, version)
         return project
     else:
         raise SecurityError("Invalid token")
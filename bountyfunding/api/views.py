@@ -4,37 +4,144 @@ from bountyfunding.core.data import *
 from bountyfunding.core.const import *
 
 from bountyfunding.core.payment.factory import payment_factory
+from bountyfunding.core.audit import audit_log, change_record, complete_change, insert_changes
+from bountyfunding.core.outbox import outbox
+from bountyfunding.core.webhooks import webhook_dispatcher, check_webhook_url, WEBHOOK_EVENTS
+from bountyfunding.core.writer import writer
+from bountyfunding.core.shards import shard_map
+from bountyfunding.core.replica import replica_router
 from bountyfunding.core.errors import Error, SecurityError
 
 from bountyfunding.api import security
+from bountyfunding.api.badge import Badge, badge_cache, CACHE_CONTROL
+from bountyfunding.api.events import stream_events, waiting_slots
+from bountyfunding.core.changes import change_notifier, changes_key, retrieve_changes, mapify_change
 from bountyfunding.core.config import config
+from bountyfunding.util.metrics import metrics
+
+import sys, re, json, time
 
 from flask import Flask, url_for, render_template, make_response, redirect, abort, jsonify, request, g, current_app, send_file, Response
 
 
 @api.route("/projects/<project_name>/issues/<issue_ref>.svg", methods=['GET'])
 def get_issue_image(project_name, issue_ref):
-    project = Project.query.filter_by(name=project_name).first()
-    issue = retrieve_issue(project.project_id, issue_ref)
-    if issue == None:
-        abort(404)
+    badge = badge_cache.get(project_name, issue_ref)
+
+    if badge == None:
+        version = badge_cache.current_version()
+        # Cached badge is invalidated on commit to the primary
+        with replica_router.primary():
+            project = Project.query.filter_by(name=project_name).first()
+            if project == None:
+                abort(404)
+            # Badges are requested without token of their project
+            with shard_map.project(project.project_id):
+                issue = retrieve_issue(project.project_id, issue_ref)
+                if issue == None:
+                    abort(404)
     
-    sponsorships = retrieve_all_sponsorships(issue.issue_id)
-    bounty = sum(s.amount for s in sponsorships)
+                total = retrieve_issue_total(issue.issue_id)
+        bounty = total.total if total != None else 0
+
+        body = render_template('issue.svg', bounty=bounty).encode('utf-8')
+        badge = Badge(issue.issue_id, bounty, body)
+        badge_cache.put(project_name, issue_ref, badge, version)
 
-    return Response(render_template('issue.svg', bounty=bounty), mimetype="image/svg+xml")
+    response = Response(badge.body, mimetype="image/svg+xml")
+    response.set_etag(badge.etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response.make_conditional(request)
 
 
 @api.route('/version', methods=['GET'])
 def status():
     return jsonify(version=config.VERSION)
 
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not (g.project.type == ProjectType.ROOT and request.remote_addr == '127.0.0.1'):
+        return jsonify(error="Insufficient permissions to read metrics"), 400
+
+    return jsonify(metrics.snapshot())
+
+@api.route('/events', methods=['GET'])
+def get_events():
+    """Streams changes of the project as Server-Sent Events"""
+    last_id = request.headers.get('Last-Event-ID', request.values.get('last_event_id'))
+    if last_id != None:
+        last_id = parse_cursor(last_id, 1)[0]
+
+    response = Response(stream_events(g.project_id, last_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Disable proxy buffering, nginx would hold events otherwise
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Long polling holds a worker thread, same as waiting event streams
+MAX_CHANGES_WAIT = 30
+
+@api.route('/changes', methods=['GET'])
+def get_changes():
+    """Returns changes of the project after since change_id. With wait parameter
+    waits up to that many seconds for the first change, with ndjson format streams
+    all of them, one per line"""
+    since = parse_cursor(request.values.get('since', '0'), 1)[0]
+    limit = get_limit() or MAX_LIMIT
+
+    if request.values.get('format') == 'ndjson':
+        return Response(stream_changes(g.project_id, since), mimetype='application/x-ndjson')
+
+    wait = request.values.get('wait', '0')
+    try:
+        wait = min(float(wait), MAX_CHANGES_WAIT)
+    except ValueError:
+        raise Error("wait is not a number")
+
+    changes = retrieve_changes(g.project_id, since, limit)
+    if not changes and wait > 0 and waiting_slots.acquire():
+        try:
+            versions = change_notifier.snapshot([changes_key(g.project_id)])
+            deadline = time.time() + wait
+            while not changes and time.time() < deadline:
+                versions = change_notifier.wait(versions, deadline - time.time())
+                changes = retrieve_changes(g.project_id, since, limit)
+        finally:
+            waiting_slots.release()
+
+    cursor = str(changes[-1].change_id) if changes else str(since)
+    return jsonify(data=map(mapify_change, changes), next=cursor)
+
+def stream_changes(project_id, since):
+    while True:
+        changes = retrieve_changes(project_id, since, MAX_LIMIT)
+        for change in changes:
+            yield json.dumps(mapify_change(change)) + '\n'
+        if len(changes) < MAX_LIMIT:
+            break
+        since = changes[-1].change_id
+
 @api.route("/issues", methods=['GET'])
 def get_issues():
-    issues = retrieve_issues(g.project_id)
-    issues = {'data': map(mapify_issue, issues)}
-    response = jsonify(issues)
-    return response
+    """Returns all issues, or a page of them when limit parameter is given"""
+    status, owner_id = get_issue_filters()
+    limit = get_limit()
+    after = request.values.get('after')
+    if after != None:
+        after = parse_cursor(after, 1)[0]
+
+    if limit == None:
+        issues = retrieve_issues(g.project_id, status, owner_id, after)
+        return jsonify(data=map(mapify_issue, issues))
+
+    issues = retrieve_issues(g.project_id, status, owner_id, after, limit + 1)
+    cursor = None
+    if len(issues) > limit:
+        issues = issues[:limit]
+        cursor = str(issues[-1].issue_id)
+
+    total = count_issues(g.project_id, status, owner_id)
+    return paged_response(map(mapify_issue, issues), cursor, total)
 
 @api.route("/issues", methods=['POST'])
 def post_issue():
@@ -52,8 +159,7 @@ def post_issue():
 
     owner_id = None
     if owner_name != None:
-        owner = retrieve_create_user(g.project_id, owner_name)
-        owner_id = owner.user_id
+        owner_id = retrieve_create_user_id(g.project_id, owner_name)
 
     issue = retrieve_issue(g.project_id, ref)
 
@@ -64,6 +170,29 @@ def post_issue():
 
     return jsonify(message='OK')
 
+@api.route("/issues/bulk", methods=['POST'])
+def post_issues_bulk():
+    """Creates or updates many issues at once, accepts JSON array of issues 
+    or one JSON issue per line with application/x-ndjson content type"""
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            # Buffered body is read again when request is repeated on locked database
+            issues = [json.loads(line) for line in request.get_data().splitlines() if line.strip()]
+        except ValueError:
+            return jsonify(error="Each line must be a JSON object"), 400
+    else:
+        issues = request.get_json(silent=True)
+        if not isinstance(issues, list):
+            return jsonify(error="JSON array of issues is required"), 400
+    
+    results = import_issues(g.project_id, issues)
+
+    counts = {}
+    for result in results:
+        counts[result['result']] = counts.get(result['result'], 0) + 1
+
+    return jsonify(data=results, **counts)
+
 @api.route("/issue/<issue_ref>", methods=['GET'])
 def get_issue(issue_ref):
     issue = retrieve_issue(g.project_id, issue_ref)
@@ -89,9 +218,9 @@ def put_issue(issue_ref):
     if link != None and not link.startswith('/'):
         return jsonify(error="Link must be relative to the issue tracker URL and start with /"), 400
 
-    owner = None
+    owner_id = None
     if owner_name != None:
-        owner = retrieve_create_user(g.project_id, owner_name)
+        owner_id = retrieve_create_user_id(g.project_id, owner_name)
 
     issue = retrieve_issue(g.project_id, issue_ref)
 
@@ -100,20 +229,7 @@ def put_issue(issue_ref):
         
     if status != None and status != issue.status:
         issue.status = status
-        # Nothing to do for default status
-        # TODO: be more clever to avoid sending repeated emails
-        if status == IssueStatus.READY:
-            pass
-        elif status == IssueStatus.STARTED:
-            body = 'The task you have sponsored has been started. Please deposit the promised amount. To do that please go to project issue tracker, log in, find this issue and select Confirm.'
-            notify_sponsors(g.project_id, issue.issue_id, SponsorshipStatus.PLEDGED, body)
-        elif status == IssueStatus.COMPLETED:
-            body_confirmed = 'The task you have sponsored has been completed by the developer. Please validate it. To do that please go to project issue tracker, log in, find an issue and select Validate.'
-            notify_sponsors(g.project_id, issue.issue_id, SponsorshipStatus.CONFIRMED, body_confirmed)
-            body_pledged = 'The task you have sponsored has been completed by the developer. Please deposit the promised amout and validate it. To do that please go to project issue tracker, log in, find an issue and select Confirm and then Validate.'
-            notify_sponsors(g.project_id, issue.issue_id, SponsorshipStatus.PLEDGED, body_pledged)
-        else:
-            return jsonify(error="Unknown status"), 400
+        notify_issue_status(g.project_id, issue.issue_id, status)
 
     if title != None and title != issue.title:
         issue.title = title
@@ -121,8 +237,8 @@ def put_issue(issue_ref):
     if link != None and link != issue.link:
         issue.link = link
 
-    if owner != None and owner.user_id != issue.owner_id:
-        issue.owner_id = owner.user_id
+    if owner_id != None and owner_id != issue.owner_id:
+        issue.owner_id = owner_id
 
     update_issue(issue)
 
@@ -130,8 +246,72 @@ def put_issue(issue_ref):
 
 @api.route("/sponsored_issues", methods=['GET'])
 def get_sponsored_issues():
-    issues = retrieve_sponsored_issues(g.project_id)
-    response = jsonify(issues)
+    """Returns all sponsored issues, or a page of them when limit parameter is given"""
+    status, owner_id = get_issue_filters()
+    limit = get_limit()
+    after = request.values.get('after')
+    if after != None:
+        after = parse_cursor(after, 2)
+
+    mapify = lambda issue: mapify_sponsored_issue(g.project_id, issue)
+
+    if limit == None:
+        issues = retrieve_sponsored_issues(g.project_id, status, owner_id, after)
+        return jsonify(data=map(mapify, issues))
+
+    issues = retrieve_sponsored_issues(g.project_id, status, owner_id, after, limit + 1)
+    cursor = None
+    if len(issues) > limit:
+        issues = issues[:limit]
+        cursor = '%d:%d' % (issues[-1].amount, issues[-1].issue_id)
+
+    total = count_sponsored_issues(g.project_id, status, owner_id)
+    return paged_response(map(mapify, issues), cursor, total)
+
+# Issue listings are paginated using keyset cursors, next cursor is 
+# returned in the response together with total count header
+
+MAX_LIMIT = 1000
+
+def get_limit():
+    limit = request.values.get('limit')
+    if limit == None:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise Error("limit is not a number")
+    if limit <= 0 or limit > MAX_LIMIT:
+        raise Error("limit must be between 1 and %d" % MAX_LIMIT)
+    return limit
+
+def parse_cursor(cursor, length):
+    try:
+        values = map(int, cursor.split(':'))
+    except ValueError:
+        raise Error("Invalid cursor")
+    if len(values) != length:
+        raise Error("Invalid cursor")
+    return values
+
+def get_issue_filters():
+    status_string = request.values.get('status')
+    status = IssueStatus.from_string(status_string)
+    if status_string != None and status == None:
+        raise Error("Invalid status: %s" % status_string)
+
+    owner_id = None
+    owner_name = request.values.get('owner')
+    if owner_name != None:
+        owner = retrieve_user(g.project_id, owner_name)
+        # No user means no issues, -1 is never a valid user_id
+        owner_id = owner.user_id if owner != None else -1
+
+    return status, owner_id
+
+def paged_response(data, cursor, total):
+    response = jsonify(data=data, next=cursor)
+    response.headers['X-Total-Count'] = str(total)
     return response
 
 @api.route("/issue/<issue_ref>/sponsorships", methods=['GET'])
@@ -162,13 +342,13 @@ def post_sponsorship(issue_ref):
     if issue == None:
         return jsonify(error='Issue not found'), 404
 
-    user = retrieve_create_user(g.project_id, user_name)
+    user_id = retrieve_create_user_id(g.project_id, user_name)
     
-    sponsorship = retrieve_sponsorship(issue.issue_id, user.user_id)
+    sponsorship = retrieve_sponsorship(issue.issue_id, user_id)
     if sponsorship != None:
         return jsonify(error="Sponsorship already exists"), 409
     
-    sponsorship = create_sponsorship(g.project_id, issue.issue_id, user.user_id, amount)
+    sponsorship = create_sponsorship(g.project_id, issue.issue_id, user_id, amount)
 
     response = jsonify(message='Sponsorship updated')
     return response
@@ -227,9 +407,9 @@ def put_sponsorship(issue_ref, user_name):
     if issue == None:
         return jsonify(error='Issue not found'), 404
     
-    user = retrieve_create_user(g.project_id, user_name)
+    user_id = retrieve_create_user_id(g.project_id, user_name)
     
-    sponsorship = retrieve_sponsorship(issue.issue_id, user.user_id)
+    sponsorship = retrieve_sponsorship(issue.issue_id, user_id)
     if sponsorship == None:
         return jsonify(error='Sponsorship not found'), 404
 
@@ -247,8 +427,8 @@ def put_sponsorship(issue_ref, user_name):
             if (sponsorship.status != SponsorshipStatus.CONFIRMED
                     and sponsorship.status != SponsorshipStatus.REJECTED):
                 return jsonify(error='Can only validate confirmed sponsorship'), 403
-            body = 'User %s has validated his/her sponsorship. Please transfer the money to the developer.'% user_name
-            notify_admins(g.project_id, issue.issue_id, body)
+            notify_admins(g.project_id, issue.issue_id, EmailTemplate.SPONSORSHIP_VALIDATED, 
+                    dict(user=user_name))
         elif status == SponsorshipStatus.TRANSFERRED:
             if sponsorship.status != SponsorshipStatus.VALIDATED:
                 return jsonify(error='Can only transfer when sponsorship is validated'), 403
@@ -256,8 +436,8 @@ def put_sponsorship(issue_ref, user_name):
             if (sponsorship.status != SponsorshipStatus.CONFIRMED 
                     and sponsorship.status != SponsorshipStatus.VALIDATED):
                 return jsonify(error='Can only reject confirmed sponsorship'), 403
-            body = 'User %s has rejected his/her sponsorship. Please refund the money to the user.'% user_name
-            notify_admins(g.project_id, issue.issue_id, body)
+            notify_admins(g.project_id, issue.issue_id, EmailTemplate.SPONSORSHIP_REJECTED, 
+                    dict(user=user_name))
         elif status == SponsorshipStatus.REFUNDED:
             if sponsorship.status != SponsorshipStatus.REJECTED:
                 return jsonify(error='Can only refund rejected sponsorship'), 403
@@ -405,20 +585,72 @@ def put_user(user_name):
 
     return jsonify(message='User updated')
 
+# Claimed emails are not returned to other consumers for this many seconds
+DEFAULT_LEASE_DURATION = 300
+MAX_LEASE_DURATION = 3600
+DEFAULT_CLAIM_LIMIT = 100
+
 @api.route('/emails', methods=['GET'])
 def get_emails():
-    emails = retrieve_all_emails()
+    """Returns emails not claimed by other consumers, all or a page of them"""
+    limit = get_limit()
+    after = request.values.get('after')
+    if after != None:
+        after = parse_cursor(after, 1)[0]
+
+    if limit == None:
+        emails = retrieve_emails(g.project_id, after)
+        return jsonify(data=map(mapify_email, emails))
+
+    emails = retrieve_emails(g.project_id, after, limit + 1)
+    cursor = None
+    if len(emails) > limit:
+        emails = emails[:limit]
+        cursor = str(emails[-1].email_id)
+
+    total = count_emails(g.project_id)
+    return paged_response(map(mapify_email, emails), cursor, total)
+
+@api.route('/emails/claim', methods=['POST'])
+def claim_emails_batch():
+    """Leases a batch of emails, other consumers do not get them until the lease expires"""
+    limit = get_limit() or DEFAULT_CLAIM_LIMIT
+    duration = request.values.get('duration', DEFAULT_LEASE_DURATION)
+    try:
+        duration = int(duration)
+    except ValueError:
+        return jsonify(error="duration is not a number"), 400
+    if duration <= 0 or duration > MAX_LEASE_DURATION:
+        return jsonify(error="duration must be between 1 and %d" % MAX_LEASE_DURATION), 400
+
+    lease, emails = claim_emails(g.project_id, limit, duration)
+    if config[g.project_id].EMAIL_DIGEST_WINDOW > 0:
+        data = mapify_digests(emails)
+    else:
+        data = map(mapify_email, emails)
+    return jsonify(lease=lease, duration=duration, data=data)
+
+@api.route('/emails', methods=['DELETE'])
+def delete_emails():
+    """Acknowledges emails claimed under a lease or listed by ids"""
+    lease = request.values.get('lease')
+    ids = request.values.get('ids')
+    if lease == None and ids == None:
+        return jsonify(error="lease or ids parameter is required"), 400
+
+    email_ids = None
+    if ids != None:
+        try:
+            email_ids = [int(i) for i in ids.split(',') if i.strip()]
+        except ValueError:
+            return jsonify(error="ids must be a comma separated list of numbers"), 400
 
-    response = []
-    for email in emails:
-        response.append({'id': email.email_id, 'recipient':email.user.name, 'issue_id':email.issue.issue_ref, 'body':email.body})
-        
-    response = jsonify(data=response)
-    return response 
+    deleted = remove_emails(g.project_id, lease, email_ids)
+    return jsonify(message='Emails deleted', deleted=deleted)
 
 @api.route('/email/<email_id>', methods=['DELETE'])
 def delete_email(email_id):
-    email = retrieve_email(email_id)
+    email = retrieve_email(g.project_id, email_id)
     if email != None:
         remove_email(email)
         response = jsonify(message='Email deleted')
@@ -428,6 +660,45 @@ def delete_email(email_id):
     return response
 
 
+@api.route('/webhooks', methods=['GET'])
+def get_webhooks():
+    return jsonify(data=map(mapify_webhook, retrieve_webhooks(g.project_id)))
+
+@api.route('/webhooks', methods=['POST'])
+def post_webhook():
+    url = request.values.get('url')
+    secret = request.values.get('secret')
+    events = request.values.get('events', '')
+
+    error = check_webhook_url(url)
+    if error != None:
+        return jsonify(error=error), 400
+    events = [e.strip().lower() for e in events.split(',') if e.strip()]
+    for event in events:
+        if event not in WEBHOOK_EVENTS:
+            return jsonify(error="Unknown event: %s" % event), 400
+
+    webhook = create_webhook(g.project_id, url, secret, ','.join(events))
+    return jsonify(mapify_webhook(webhook))
+
+@api.route('/webhook/<int:webhook_id>', methods=['DELETE'])
+def delete_webhook(webhook_id):
+    webhook = retrieve_webhook(g.project_id, webhook_id)
+    if webhook == None:
+        return jsonify(error='Webhook not found'), 404
+    remove_webhook(webhook)
+    return jsonify(message='Webhook deleted')
+
+@api.route('/webhook/<int:webhook_id>/failures', methods=['GET'])
+def get_webhook_failures(webhook_id):
+    """Returns event batches not delivered after all retries"""
+    webhook = retrieve_webhook(g.project_id, webhook_id)
+    if webhook == None:
+        return jsonify(error='Webhook not found'), 404
+    failures = retrieve_webhook_failures(webhook_id)
+    return jsonify(data=map(mapify_webhook_failure, failures))
+
+
 @api.route('/project', methods=['GET'])
 def get_project():
     return jsonify(mapify_project(g.project))
@@ -437,15 +708,19 @@ def put_project():
     name = request.values.get('name')
     description = request.values.get('description')
 
-    project = g.project
-
-    if not project.is_mutable():
+    if not g.project.is_mutable():
         return jsonify(error="This project can't be modified"), 400
 
     if name == None and description == None:
         return jsonify(error="Nothing to modify"), 400
 
-    if name != None:
+    # Request project is a shared snapshot, modify the database entity
+    project = Project.query.get(g.project_id)
+
+    if name != None and name != project.name:
+        # Badges are cached by project name
+        old_name = project.name
+        after_commit(lambda: badge_cache.invalidate_project(old_name))
         project.name = name
 
     if description != None:
@@ -476,6 +751,117 @@ def get_config_payment_gateways():
     return jsonify(gateways=gateways)
 
 
+@api.route('/batch', methods=['POST'])
+def post_batch():
+    """Executes a list of API requests and returns all their responses.
+
+    Request body is a JSON object with requests list, each having method, path 
+    and optional params, and atomic flag. Atomic batch is executed in a single 
+    transaction and stops at the first failed request, rolling back all the 
+    previous ones. Otherwise each request is committed or rolled back separately.
+    """
+    batch = request.get_json(silent=True)
+    if not isinstance(batch, dict) or not isinstance(batch.get('requests'), list):
+        return jsonify(error="JSON object with requests list is required"), 400
+    
+    subrequests = batch['requests']
+    atomic = bool(batch.get('atomic', False))
+    
+    if len(subrequests) > MAX_BATCH_SIZE:
+        return jsonify(error="Batch may contain up to %d requests" % MAX_BATCH_SIZE), 400
+
+    results = []
+    changes = []
+    committed = True
+    for subrequest in subrequests:
+        if not isinstance(subrequest, dict):
+            return jsonify(error="Each request must be a JSON object"), 400
+        method = str(subrequest.get('method', 'GET')).upper()
+        path = subrequest.get('path')
+        params = subrequest.get('params') or {}
+        if not path or not isinstance(params, dict):
+            return jsonify(error="Each request requires path and params object"), 400
+
+        response, change = dispatch_subrequest(method, path, params)
+        results.append(dict(status=response.status_code, body=get_response_body(response)))
+
+        if response.status_code >= 400:
+            db.session.rollback()
+            if atomic:
+                for c in changes:
+                    complete_change(c, 409, 'Rolled back with batch')
+                committed = False
+        elif not atomic:
+            # Committed with the subrequest, later ones may fail
+            if change != None:
+                insert_changes(db.session, [change])
+                change = None
+            db.session.commit()
+
+        if change != None:
+            changes.append(change)
+        if not committed:
+            break
+
+    g.changes.extend(changes)
+    return jsonify(data=results, committed=committed)
+
+MAX_BATCH_SIZE = 100
+
+def dispatch_subrequest(method, path, params):
+    """Dispatches request to API view function within current project,
+    returns the response and change record for mutating requests"""
+    values = {k: unicode(v) for k, v in params.items() if k != 'token'}
+    if method == 'GET':
+        context = current_app.test_request_context(path, method=method, query_string=values)
+    else:
+        context = current_app.test_request_context(path, method=method, data=values)
+
+    with context:
+        # Unknown paths are reported as usual by dispatch_request
+        if request.routing_exception == None and (request.blueprint != api.name 
+                or request.endpoint == 'api.post_batch'):
+            return make_response(jsonify(error="Invalid batch request path: %s" % path), 400), None
+        if request.routing_exception == None and waits_for_changes():
+            return make_response(jsonify(error="Batch request cannot wait for changes: %s" % path), 
+                    400), None
+
+        try:
+            response = current_app.make_response(current_app.dispatch_request())
+        except Exception as e:
+            try:
+                response = current_app.make_response(current_app.handle_user_exception(e))
+            except Exception:
+                current_app.logger.exception('Batch request %s %s failed', method, path)
+                response = make_response(jsonify(error="Internal error"), 500)
+            # Do not let handled exception reach request teardown
+            sys.exc_clear()
+
+        change = None
+        if is_mutating(method):
+            change = change_record(g.project_id, method, request.path, 
+                    describe_arguments(request.values))
+            complete_change(change, response.status_code, response.data)
+        
+        return response, change
+
+def waits_for_changes():
+    """Event stream and long polling would hold the batch and its transaction"""
+    if request.endpoint == 'api.get_events':
+        return True
+    if request.endpoint == 'api.get_changes':
+        try:
+            return float(request.values.get('wait', '0')) > 0
+        except ValueError:
+            return False
+    return False
+
+def get_response_body(response):
+    if response.mimetype == 'application/json':
+        return json.loads(response.data)
+    return response.data
+
+
 # Order of these two functions is important - first one needs to be executed
 # before the second, because I need project_id to log the change
 # http://t27668.web-flask-general.webdiscuss.info/priority-for-before-request-t27668.html
@@ -489,18 +875,65 @@ def check_access_and_set_project():
 
 @api.before_request
 def log_change():
-    if request.method == 'POST' or request.method == 'PUT' or request.method == 'DELETE':
-        arguments = ", ".join(map(lambda (k, v): '%s:%s' % (k, v),\
-                sorted(request.values.iteritems(True))))
-        g.change_id = create_change(g.project_id, request.method, request.path, arguments)
+    # Changes of finished batch subrequests
+    g.changes = []
+    # Batch is logged as its individual subrequests
+    if is_mutating(request.method) and request.endpoint != 'api.post_batch':
+        g.change = change_record(g.project_id, request.method, request.path, 
+                describe_arguments(request.values))
+
+@api.before_request
+def check_project_writable():
+    # Data of the project is being copied to another shard by move-project action
+    if is_mutating(request.method) and shard_map.is_moving(g.project_id):
+        return jsonify(error="Project is being moved, try again later"), 503
+
+def is_mutating(method):
+    return method == 'POST' or method == 'PUT' or method == 'DELETE'
+
+# Arguments whose values are not written to the change log
+SECRET_ARGUMENTS = ('token', 'secret', 'password')
+
+def describe_arguments(values):
+    return ", ".join(map(lambda (k, v): '%s:%s' % (k, '***' if k in SECRET_ARGUMENTS else v),\
+            sorted(values.iteritems(True))))
+
+# Each request is a single unit of work committed at the end together with
+# its change log entry, entry of failed request is written asynchronously afterwards
 
 @api.after_request
-def log_change_result(response):
-    # Documentation says that this may not be executed and that data will be removed - investigate
-    if 'change_id' in g:
-        update_change(g.change_id, response.status_code, response.data)
+def commit_unit_of_work(response):
+    if 'change' in g:
+        complete_change(g.change, response.status_code, response.data)
+        g.changes.append(g.change)
+    # Failed request should not leave any partial modifications
+    if response.status_code >= 400:
+        db.session.rollback()
+        write_changes(g.changes)
+    else:
+        insert_changes(db.session, g.changes)
+        db.session.commit()
     return response
 
+@api.teardown_request
+def rollback_unit_of_work(exception):
+    if exception != None:
+        db.session.rollback()
+        if 'change' in g:
+            complete_change(g.change, 500, None)
+            g.changes.append(g.change)
+        write_changes(g.get('changes', []))
+
+def write_changes(changes):
+    def write():
+        for change in changes:
+            audit_log.write(change)
+    # Request executed by the writer is committed later with its group
+    if writer.in_group():
+        after_commit(write)
+    else:
+        write()
+
 @api.before_app_first_request
 def init():
     # For in-memory DB need to initialize memory database in the same thread
@@ -511,7 +944,11 @@ def init():
     
     # Multiple threads do not work with memory database
     if not config.DATABASE_IN_MEMORY:
-        notify()
+        outbox.start()
+        audit_log.start()
+        webhook_dispatcher.start()
+        if config.SQLITE_WRITER:
+            writer.start()
 
 
 @api.errorhandler(SecurityError)
@@ -0,0 +1,145 @@
+from bountyfunding import app
+from bountyfunding.core.models import Change, after_commit
+from bountyfunding.core.changes import change_notifier, changes_key, change_listeners
+from bountyfunding.core.shards import shard_map
+from bountyfunding.util.metrics import metrics
+
+from datetime import datetime
+import threading, atexit, time, Queue
+
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 1.0
+
+# Same as change.response column length
+MAX_RESPONSE_LENGTH = 4096
+
+_STOP = object()
+
+
+def change_record(project_id, method, path, arguments):
+    """Returns in-memory change, status and response are filled after the request"""
+    return dict(project_id=project_id, timestamp=datetime.now(), method=method,
+            path=path, arguments=arguments, status=None, response=None)
+
+def complete_change(change, status, response):
+    change['status'] = status
+    if response != None:
+        change['response'] = response[:MAX_RESPONSE_LENGTH]
+
+def insert_changes(session, records):
+    """Inserts change records within the transaction of the changes they
+    describe, so that a committed change is never missing from the change log.
+    Subscribers are notified after the commit"""
+    if not records:
+        return
+    session.execute(Change.__table__.insert(), records)
+    project_ids = set(r['project_id'] for r in records)
+    count = len(records)
+    def committed():
+        metrics.increment('audit.written', count)
+        notify_changes(project_ids)
+    after_commit(committed, session)
+
+def notify_changes(project_ids):
+    change_notifier.notify(map(changes_key, project_ids))
+    for listener in change_listeners:
+        listener(project_ids)
+
+
+class AuditLog:
+    """Writes change records of failed requests, which have no transaction
+    to insert them in and are not delivered to subscribers. When started,
+    records are inserted in batches by a background thread, otherwise
+    synchronously"""
+
+    def __init__(self, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.queue = Queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.thread = None
+
+    def start(self):
+        if self.thread != None:
+            return
+        self.thread = threading.Thread(target=self._run, name='audit-log')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Writes all queued records and stops the background thread"""
+        if self.thread == None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def write(self, record):
+        if self.thread == None:
+            self._insert([record])
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            metrics.increment('audit.dropped')
+            app.logger.warn('Audit log queue full, dropping change %s %s',
+                    record['method'], record['path'])
+        metrics.set('audit.queue_depth', self.queue.qsize())
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            batch = []
+            record = self.queue.get()
+            deadline = time.time() + self.flush_interval
+            while record is not _STOP:
+                batch.append(record)
+                timeout = deadline - time.time()
+                if len(batch) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+            stopped = (record is _STOP)
+
+            if batch:
+                self._insert(batch)
+            metrics.set('audit.queue_depth', self.queue.qsize())
+
+    def _insert(self, records):
+        projects = {}
+        for record in records:
+            projects.setdefault(record['project_id'], []).append(record)
+
+        # Only records of a failing shard are dropped
+        shards = {}
+        for project_id, project_records in projects.items():
+            try:
+                engine = shard_map.engine(project_id)
+            except Exception:
+                self._dropped(project_records)
+                continue
+            shards.setdefault(engine, []).extend(project_records)
+
+        written = []
+        for engine, shard_records in shards.items():
+            try:
+                engine.execute(Change.__table__.insert(), shard_records)
+            except Exception:
+                self._dropped(shard_records)
+                continue
+            metrics.increment('audit.written', len(shard_records))
+            written.extend(shard_records)
+
+        if written:
+            notify_changes(set(r['project_id'] for r in written))
+
+    def _dropped(self, records):
+        metrics.increment('audit.dropped', len(records))
+        app.logger.exception('Unable to write %d changes to audit log', len(records))
+
+
+audit_log = AuditLog()
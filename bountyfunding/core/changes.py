@@ -0,0 +1,94 @@
+from bountyfunding.core.models import Change
+from bountyfunding.core.shards import shard_map
+
+from sqlalchemy import select, func
+import threading, time, re
+
+
+# Resource affected by a change, first matching path pattern wins
+CHANGE_TYPES = [
+    (re.compile(r'^/issue/[^/]+/sponsorships?/[^/]+/payments?'), 'payment'),
+    (re.compile(r'^/issue/[^/]+/sponsorships?'), 'sponsorship'),
+    (re.compile(r'^/issues?(/|$)'), 'issue'),
+    (re.compile(r'^/emails?(/|$)'), 'email'),
+    (re.compile(r'^/users?(/|$)'), 'user'),
+    (re.compile(r'^/projects?(/|$)'), 'project'),
+]
+
+
+# Functions called with a set of project_ids after their changes are written
+change_listeners = []
+
+
+class ChangeNotifier:
+    """Wakes up threads waiting for new changes of a project. Each key has
+    a version increased on every notification, waiters compare versions"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.versions = {}
+
+    def notify(self, keys):
+        with self.condition:
+            for key in keys:
+                self.versions[key] = self.versions.get(key, 0) + 1
+            self.condition.notify_all()
+
+    def snapshot(self, keys):
+        with self.condition:
+            return {key: self.versions.get(key, 0) for key in keys}
+
+    def wait(self, versions, timeout):
+        """Waits until any of the keys has version different than given one
+        or timeout elapses, returns current versions"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while all(self.versions.get(k, 0) == v for k, v in versions.items()):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return {key: self.versions.get(key, 0) for key in versions}
+
+
+def changes_key(project_id):
+    return ('changes', project_id)
+
+def emails_key(project_id):
+    return ('emails', project_id)
+
+def change_type(path):
+    for pattern, type in CHANGE_TYPES:
+        if pattern.match(path):
+            return type
+    return 'other'
+
+def retrieve_changes(project_id, since, limit):
+    """Returns successful changes of a project after given change_id, in id order.
+    Uses the engine directly, may be called after request has finished"""
+    table = Change.__table__
+    query = select([table.c.change_id, table.c.timestamp, table.c.method, table.c.path,
+            table.c.status]) \
+            .where(table.c.project_id == project_id) \
+            .where(table.c.change_id > since) \
+            .where(table.c.status < 400) \
+            .order_by(table.c.change_id).limit(limit)
+    return shard_map.engine(project_id).execute(query).fetchall()
+
+def retrieve_last_change_id(project_id):
+    table = Change.__table__
+    query = select([func.max(table.c.change_id)]).where(table.c.project_id == project_id)
+    return shard_map.engine(project_id).execute(query).scalar() or 0
+
+def mapify_change(change):
+    return {
+        'id': change.change_id,
+        'type': change_type(change.path),
+        'method': change.method,
+        'path': change.path,
+        'status': change.status,
+        'timestamp': change.timestamp.isoformat(),
+    }
+
+
+change_notifier = ChangeNotifier()
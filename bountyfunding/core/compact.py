@@ -0,0 +1,90 @@
+from bountyfunding.core.models import Change
+from bountyfunding.core.shards import shard_map
+
+from sqlalchemy import select, func, and_
+from datetime import datetime
+import os, time, json, gzip
+
+
+# Rows archived or updated per transaction, keeps write locks short
+BATCH_SIZE = 1000
+
+# Pause between batches letting other writers in
+BATCH_PAUSE = 0.05
+
+
+def archive_changes(before, archive_dir, batch_size=BATCH_SIZE):
+    """Moves changes older than given datetime to a gzipped JSON lines file,
+    returns its path and number of changes archived. Each batch is written
+    to the file before it is deleted, interrupted run may archive some
+    changes twice but never loses them. Changes of all shards go to one file.
+    Newest change of each database is kept, SQLite would reuse its id otherwise
+    and cursors of change feeds and webhooks past it would skip new changes"""
+    table = Change.__table__
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+    path = os.path.join(archive_dir, 'changes-%s.jsonl.gz' % datetime.now().strftime('%Y%m%d-%H%M%S'))
+
+    archived = 0
+    archive = gzip.open(path, 'wb')
+    try:
+        for engine in shard_map.engines():
+            last_id = engine.execute(select([func.max(table.c.change_id)])).scalar() or 0
+            while True:
+                with engine.begin() as connection:
+                    rows = connection.execute(table.select()
+                            .where(and_(table.c.timestamp < before, table.c.change_id < last_id))
+                            .order_by(table.c.change_id).limit(batch_size)).fetchall()
+                    for row in rows:
+                        archive.write(json.dumps(_serialize(row)) + '\n')
+                    archive.flush()
+                    if rows:
+                        connection.execute(table.delete().where(
+                                table.c.change_id.in_([row.change_id for row in rows])))
+                archived += len(rows)
+                if len(rows) < batch_size:
+                    break
+                time.sleep(BATCH_PAUSE)
+    finally:
+        archive.close()
+
+    if archived == 0:
+        os.remove(path)
+        path = None
+    return path, archived
+
+def _serialize(row):
+    change = dict(row)
+    change['timestamp'] = change['timestamp'].isoformat()
+    return change
+
+def truncate_responses(max_length, batch_size=BATCH_SIZE):
+    """Shortens stored responses longer than max_length, returns number of changes updated"""
+    table = Change.__table__
+    truncated = 0
+    for engine in shard_map.engines():
+        last_id = engine.execute(select([func.max(table.c.change_id)])).scalar() or 0
+        for start in xrange(0, last_id, batch_size):
+            with engine.begin() as connection:
+                result = connection.execute(table.update()
+                        .where(and_(table.c.change_id > start, table.c.change_id <= start + batch_size,
+                            func.length(table.c.response) > max_length))
+                        .values(response=func.substr(table.c.response, 1, max_length)))
+                truncated += result.rowcount
+            time.sleep(BATCH_PAUSE)
+    return truncated
+
+def optimize(vacuum=False):
+    """Updates query planner statistics and on SQLite optionally rebuilds
+    the database file to return freed space to the file system, which locks
+    the whole database until done"""
+    for engine in shard_map.engines():
+        dialect = engine.dialect.name
+        if dialect == 'sqlite':
+            if vacuum:
+                engine.execute('VACUUM')
+            engine.execute('ANALYZE')
+        elif dialect == 'mysql':
+            engine.execute('ANALYZE TABLE `change`')
+        else:
+            engine.execute('ANALYZE')
@@ -4,8 +4,11 @@ import re
 import ConfigParser
 import argparse
 import subprocess
+import threading
+from collections import OrderedDict
 
 from bountyfunding.util.homer import BOUNTYFUNDING_HOME
+from bountyfunding.util.metrics import metrics
 from bountyfunding import app
 from bountyfunding.core.const import PaymentGateway
 
@@ -30,6 +33,24 @@ def string_list(value):
 def payment_gateway_list(value):
     return [PaymentGateway.from_string(s) for s in string_list(value)]
 
+def named_list(value):
+    """Parses comma separated name=value pairs keeping their order"""
+    result = OrderedDict()
+    for item in string_list(value):
+        name, sep, v = item.partition('=')
+        if not sep or not name.strip() or not v.strip():
+            raise ValueError, 'Not a name=value pair: %s' % item
+        result[name.strip()] = v.strip()
+    return result
+
+def choice(*values):
+    def parse_choice(value):
+        v = value.strip().lower()
+        if v not in values:
+            raise ValueError, 'Not one of %s: %s' % (', '.join(values), v)
+        return v
+    return parse_choice
+
 
 class Property:
     def __init__(self, description, parser, defualt_value, in_args, in_file, in_db):
@@ -48,9 +69,23 @@ properties = {
     'THREADS' : Property('Number of worker threads', int, 4, True, True, False),
 
     'DATABASE_URL' : Property('SQLAlchemy database url', str, '', False, True, False),
+    'DATABASE_REPLICA_URL' : Property('SQLAlchemy url of read-only replica serving GET requests, empty serves them from database url', str, '', False, True, False),
+    'DATABASE_REPLICA_LAG' : Property('Seconds after a write of a client during which its GET requests are served from database url', int, 5, False, True, False),
+    'DATABASE_SHARDS' : Property('Comma separated name=url pairs of databases holding data of projects assigned to them, other projects stay in database url', named_list, OrderedDict(), False, True, False),
+    'DATABASE_SHARD_ROUTING' : Property('Picks shard of a new project: fewest projects, hash of project id, or module.function called with project id and shard names', str, 'fewest', False, True, False),
     'DATABASE_IN_MEMORY' : Property('Use empty in-memory database', boolean, False, False, False, False),
     'DATABASE_CREATE' : Property('Create database', boolean, False, False, False, False),
+
+    'SQLITE_PROFILE' : Property('SQLite connection profile, default keeps driver settings, production pools connections and enables WAL journal with the pragmas below', choice('default', 'production'), 'default', False, True, False),
+    'SQLITE_SYNCHRONOUS' : Property('SQLite synchronous pragma, NORMAL is durable in WAL mode except on power loss', choice('off', 'normal', 'full', 'extra'), 'normal', False, True, False),
+    'SQLITE_BUSY_TIMEOUT' : Property('Milliseconds SQLite waits for a lock held by other connection', int, 5000, False, True, False),
+    'SQLITE_MMAP_SIZE' : Property('Bytes of SQLite database file read through memory mapping', int, 268435456, False, True, False),
+    'SQLITE_CACHE_SIZE' : Property('KiB of SQLite page cache per connection', int, 16384, False, True, False),
+    'SQLITE_WRITER' : Property('Execute modifying API requests on a single writer thread, committing requests waiting for it together', boolean, False, False, True, False),
+    'SQLITE_BUSY_RETRIES' : Property('Number of times a modifying request failing on locked SQLite database is repeated', int, 5, False, True, False),
     
+    'WEBHOOK_ALLOW_PRIVATE' : Property('Allow webhooks posting to loopback, private and link-local addresses', boolean, False, False, True, False),
+
     'SECRET' : Property('Webapp secret key', str, '', False, True, False),
 
     'TRACKER_URL' : Property('Externally accessible location of bug tracker', str, '', False, True, True),
@@ -58,6 +93,7 @@ properties = {
     'ADMIN' : Property('Admin user identifier', str, '', False, True, True),
     'MAX_PLEDGE_AMOUNT' : Property('Maximum pledge amount', int, 100, False, True, True),
     'PAYMENT_GATEWAYS' : Property('List of enabled payment gateways', payment_gateway_list, [PaymentGateway.DUMMY], False, True, True),
+    'EMAIL_DIGEST_WINDOW' : Property('Seconds during which emails to the same user are merged into one digest, 0 disables digests', int, 0, False, True, True),
         
     'PROJECT_DEFAULT' : Property('Enable default project', boolean, True, False, True, False),
     'PROJECT_TEST' : Property('Enable test projects', boolean, True, False, True, False),
@@ -67,6 +103,11 @@ properties = {
     'LOG_SQL' : Property('Log SQL statements', boolean, False, False, True, False),
     'LOG_HTTP' : Property('Log outgoing HTTP requests', boolean, False, False, True, False),
 
+    'COMPACT_MAX_AGE' : Property('Days after which changes are moved to archive by compact action', int, 90, True, True, False),
+    'COMPACT_ARCHIVE_DIR' : Property('Directory of compressed change archives, relative to home directory', str, 'db/archive', False, True, False),
+    'COMPACT_RESPONSE_LENGTH' : Property('Responses of remaining changes are truncated to this length, 0 keeps them whole', int, 0, False, True, False),
+    'COMPACT_VACUUM' : Property('Rebuild SQLite database file after compacting, locks the database while running', boolean, False, False, True, False),
+
     'PAYPAL_SANDBOX' : Property('Use Paypal sandbox or live system', boolean, True, False, True, True),
     'PAYPAL_RECEIVER_EMAIL' : Property('Email of the entity receiving payments', str, '', False, True, True),
     'PAYPAL_PDT_ACCESS_TOKEN' : Property('Paypal Payment Data Transfer (PDT) access token', str, '', False, True, True),
@@ -120,7 +161,7 @@ class CommonConfig:
     def _init_value_from_file(self, parser, name):
         option = name.lower()
         section = 'general'
-        for prefix in ('paypal', 'project', 'log', 'github'):
+        for prefix in ('paypal', 'project', 'log', 'github', 'compact', 'sqlite'):
             if option.startswith(prefix):
                 section = prefix
                 option = option[len(prefix)+1:]
@@ -166,23 +207,37 @@ class CommonConfig:
             self.DATABASE_CREATE = True
             # Only one thread supported when using in-memory database
             self.THREADS = 1
+            self.SQLITE_WRITER = False
 
         elif self.DATABASE_URL.startswith('sqlite:///'):
-            path = self.DATABASE_URL[10:]
-        
-            # Relative path for sqlite database should be based on home directory
-            if not os.path.isabs(path):
-                path = os.path.join(BOUNTYFUNDING_HOME, path)
-                self.DATABASE_URL = 'sqlite:///' + path
-
-            if not os.path.exists(path):
+            self.DATABASE_URL = self._sqlite_url(self.DATABASE_URL)
+            if not os.path.exists(self.DATABASE_URL[10:]):
                 self.DATABASE_CREATE = True
 
+        if self.DATABASE_REPLICA_URL:
+            if self.DATABASE_REPLICA_URL.startswith('sqlite:///'):
+                self.DATABASE_REPLICA_URL = self._sqlite_url(self.DATABASE_REPLICA_URL)
+            app.config['SQLALCHEMY_BINDS'] = {'replica': self.DATABASE_REPLICA_URL}
+
+        for name, url in self.DATABASE_SHARDS.items():
+            if url.startswith('sqlite:///'):
+                self.DATABASE_SHARDS[name] = url = self._sqlite_url(url)
+            binds = app.config.get('SQLALCHEMY_BINDS') or {}
+            binds['shard:' + name] = url
+            app.config['SQLALCHEMY_BINDS'] = binds
+
         app.config['SQLALCHEMY_DATABASE_URI'] = self.DATABASE_URL
         db.init_app(app)
         # See http://piotr.banaszkiewicz.org/blog/2012/06/29/flask-sqlalchemy-init_app/, option 2
         db.app = app
 
+    def _sqlite_url(self, url):
+        path = url[10:]
+        # Relative path for sqlite database should be based on home directory
+        if not os.path.isabs(path):
+            path = os.path.join(BOUNTYFUNDING_HOME, path)
+        return 'sqlite:///' + path
+
     def _init_secret(self):
         if not self.SECRET:
             app.logger.warn('Secret not defined, generating random one. ' 
@@ -194,27 +249,78 @@ class CommonConfig:
         setattr(self, name, properties[name].default_value)
 
 
+class ProjectConfigCache:
+    """Per-project properties stored in the database, loaded all at once and 
+    kept until project configuration changes"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.versions = {}
+
+    def get(self, project_id):
+        with self.lock:
+            version = self.versions.get(project_id, 0)
+            entry = self.entries.get(project_id)
+            if entry != None and entry[0] == version:
+                metrics.increment('config_cache.hits')
+                return entry[1]
+        metrics.increment('config_cache.misses')
+
+        values = {}
+        for prop in self._load_properties(project_id):
+            name = prop.name.upper()
+            if name in properties and properties[name].in_db:
+                values[name] = parse(name, prop.value)
+
+        with self.lock:
+            # Do not store values if configuration has changed while loading
+            if self.versions.get(project_id, 0) == version:
+                self.entries[project_id] = (version, values)
+        return values
+
+    def invalidate(self, project_id):
+        with self.lock:
+            self.versions[project_id] = self.versions.get(project_id, 0) + 1
+            self.entries.pop(project_id, None)
+
+    def clear(self):
+        with self.lock:
+            for project_id in self.entries.keys():
+                self.versions[project_id] = self.versions.get(project_id, 0) + 1
+            self.entries.clear()
+
+    def _load_properties(self, project_id):
+        with replica_router.primary():
+            return Config.query.filter_by(project_id=project_id).all()
+
+
 class ProjectConfig:
-    def __init__(self, project_id):
+    def __init__(self, project_id, cache=None):
         self.project_id = project_id
+        self.cache = cache or project_config_cache
 
     def __getattr__(self, name):
-        #TODO: add caching
         if properties[name].in_db:
-            prop = self._get_property(self.project_id, name.lower())
-            if prop != None:
-                value = parse(name, prop.value)
-                return value
+            values = self.cache.get(self.project_id)
+            if name in values:
+                return values[name]
         return getattr(config, name)
-
-    def _get_property(self, project_id, name):
-        prop = Config.query.filter_by(project_id=project_id, name=name).first()
-        return prop
         
 
+project_config_cache = ProjectConfigCache()
+
 config = CommonConfig()
 
 
 # Tricky because DB needs config and config needs DB
-from bountyfunding.core.models import db, Config
+from bountyfunding.core.models import db, Config, after_commit
+from bountyfunding.core.replica import replica_router
+
+def _invalidate_project_config(mapper, connection, target):
+    project_id = target.project_id
+    after_commit(lambda: project_config_cache.invalidate(project_id), 
+            db.object_session(target))
 
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    db.event.listen(Config, _event, _invalidate_project_config)
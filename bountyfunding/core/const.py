@@ -19,6 +19,13 @@ class SponsorshipStatus(Enum):
     REJECTED = 50
     REFUNDED = 60
 
+class EmailTemplate(Enum):
+    ISSUE_STARTED = 10
+    ISSUE_COMPLETED_CONFIRMED = 20
+    ISSUE_COMPLETED_PLEDGED = 30
+    SPONSORSHIP_VALIDATED = 40
+    SPONSORSHIP_REJECTED = 50
+
 class PaymentStatus(Enum):
     INITIATED = 10
     CONFIRMED = 20
@@ -1,32 +1,68 @@
 #This is future data access layer
 
 from bountyfunding.core.const import *
-from bountyfunding.core.models import db, Project, Issue, User, Sponsorship, Email, Payment, Change, Token
-from bountyfunding.core.config import config
+from bountyfunding.core.models import db, Project, Issue, User, Sponsorship, Email, Payment, Change, Token, IssueTotal, Webhook, WebhookFailure, after_commit
+from bountyfunding.core.config import config, project_config_cache
 from bountyfunding.core.errors import Error
-
-import re, requests, threading, random, string, contextlib
+from bountyfunding.core.totals import retrieve_issue_total
+from bountyfunding.core.outbox import outbox
+from bountyfunding.core.changes import change_notifier, emails_key, retrieve_last_change_id
+from bountyfunding.core.shards import shard_map
+from bountyfunding.util.cache import LruCache
+
+import re, json, random, string, contextlib
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from sqlalchemy.exc import IntegrityError
 from flask import current_app
 
-#TODO: move to config, 0 means no notifications, set for tests, automatically when in-memory-database in config
-NOTIFY_INTERVAL = 5
+# Number of rows in multi-row statements and IN clauses
+CHUNK_SIZE = 100
+
+# Token to project snapshot cache, used to authorize API requests
+PROJECT_CACHE_SIZE = 1024
+PROJECT_CACHE_TTL = 300
+project_cache = LruCache(PROJECT_CACHE_SIZE, PROJECT_CACHE_TTL)
+
+# (project_id, shard version, user name) to user_id cache, users are never renamed,
+# but get new ids when their project is moved to another shard
+USER_CACHE_SIZE = 10000
+user_cache = LruCache(USER_CACHE_SIZE)
+
+def user_key(project_id, name):
+    return (project_id, shard_map.version(project_id), name)
 
 #TODO: generic update and delete methods, use constructors to create
 
 #TODO: move trivial queries back to the views, trivial creates too
 
+# Functions below only flush the session, transaction is committed by the caller,
+# for API requests at the end of the request
+
 #TODO: replace mapify with iter https://stackoverflow.com/questions/23252370/overloading-dict-on-python-class
 
+def chunks(elements, size):
+    elements = list(elements)
+    for i in xrange(0, len(elements), size):
+        yield elements[i:i + size]
+
 def create_database():
-    db.drop_all()
-    db.create_all()
+    # Shards get all tables too, so that foreign keys resolve
+    for engine in shard_map.engines():
+        db.metadata.drop_all(engine)
+        db.metadata.create_all(engine)
 
 def clean_database():
-    with contextlib.closing(db.engine.connect()) as con:
-        trans = con.begin()
-        for table in reversed(db.metadata.sorted_tables):
-            con.execute(table.delete())
-        trans.commit()
+    for engine in shard_map.engines():
+        with contextlib.closing(engine.connect()) as con:
+            trans = con.begin()
+            for table in reversed(db.metadata.sorted_tables):
+                con.execute(table.delete())
+            trans.commit()
+    project_config_cache.clear()
+    project_cache.clear()
+    user_cache.clear()
+    shard_map.clear()
 
 def retrieve_user(project_id, name):
     user = User.query.filter_by(project_id=project_id, name=name).first()
@@ -35,11 +71,15 @@ def retrieve_user(project_id, name):
 def create_project(name, description):
     project = Project(name, description, ProjectType.NORMAL)
     db.session.add(project)
+    db.session.flush()
+    project.shard = shard_map.choose(project.project_id)
 
     token = Token(project.project_id, generate_token())
     db.session.add(token)
 
-    db.session.commit()
+    after_commit(lambda: project_cache.invalidate(token.token))
+    after_commit(lambda: shard_map.invalidate(project.project_id))
+    db.session.flush()
     return project, token
 
 def retrieve_project(token):
@@ -47,7 +87,10 @@ def retrieve_project(token):
 
 def update_project(project):
     db.session.add(project)
-    db.session.commit()
+    project_id = project.project_id
+    after_commit(lambda: project_cache.invalidate_if(
+            lambda token, cached: cached.project_id == project_id))
+    db.session.flush()
 
 def mapify_project(project):
     type = ProjectType.to_string(project.type)
@@ -57,9 +100,26 @@ def generate_token():
     return ''.join(random.choice(string.ascii_lowercase) for _ in xrange(32))
 
 
-def retrieve_issues(project_id):
-    issues = Issue.query.filter_by(project_id=project_id).all()
-    return issues
+def retrieve_issues(project_id, status=None, owner_id=None, after=None, limit=None):
+    """Returns issues ordered by id, optionally only the ones after given issue_id"""
+    query = _filter_issues(Issue.query.filter_by(project_id=project_id), status, owner_id)
+    if after != None:
+        query = query.filter(Issue.issue_id > after)
+    query = query.order_by(Issue.issue_id)
+    if limit != None:
+        query = query.limit(limit)
+    return query.all()
+
+def count_issues(project_id, status=None, owner_id=None):
+    query = _filter_issues(Issue.query.filter_by(project_id=project_id), status, owner_id)
+    return query.count()
+
+def _filter_issues(query, status, owner_id):
+    if status != None:
+        query = query.filter(Issue.status == status)
+    if owner_id != None:
+        query = query.filter(Issue.owner_id == owner_id)
+    return query
 
 def retrieve_issue(project_id, issue_ref):
     issue = Issue.query.filter_by(project_id=project_id, issue_ref=issue_ref).first()
@@ -68,12 +128,12 @@ def retrieve_issue(project_id, issue_ref):
 def create_issue(project_id, ref, status, title, link, owner_id):
     issue = Issue(project_id, ref, status, title, link, owner_id)
     db.session.add(issue)
-    db.session.commit()
+    db.session.flush()
     return issue
 
 def update_issue(issue):
     db.session.add(issue)
-    db.session.commit()
+    db.session.flush()
 
 def mapify_issue(issue):
     result = dict(ref=issue.issue_ref, title=issue.title)	
@@ -86,38 +146,182 @@ def mapify_issue(issue):
 
     return result
 
-def retrieve_sponsored_issues(project_id):
-    issues = db.engine.execute("""
-        SELECT i.issue_ref, i.status, i.title, i.link, sum(s.amount) AS amount
-        FROM issue AS i JOIN sponsorship AS s ON (i.issue_id = s.issue_id) 
-        WHERE i.project_id = :1
-        GROUP BY i.issue_id
-        HAVING amount > 0
-        ORDER BY amount DESC
-    """, [project_id]).fetchall()
-
-    issues = {'data': map(lambda i: {
-        'ref': i[0],
-        'status': IssueStatus.to_string(i[1]),
-        'title': i[2],
-        'link': config[project_id].TRACKER_URL + i[3],
-        'amount': i[4]
-    }, issues)}
-    
-    return issues
+def import_issues(project_id, items):
+    """Creates or updates issues given as dictionaries with ref, status, title, 
+    link and optional owner keys, using one query per chunk of issues.
+    Returns list of dictionaries with ref and result of the operation"""
+    results = []
+    valid = []
+    refs = set()
+    for item in items:
+        error = _check_imported_issue(item)
+        ref = item.get('ref') if isinstance(item, dict) else None
+        # Refs are stored as strings, so 1 and "1" are the same issue
+        if error == None and unicode(ref) in refs:
+            error = 'Duplicate ref'
+        if error != None:
+            results.append(dict(ref=ref, result='error', error=error))
+        else:
+            refs.add(unicode(ref))
+            result = dict(ref=ref)
+            results.append(result)
+            valid.append((item, result))
+
+    for chunk in chunks(valid, CHUNK_SIZE):
+        _import_issues_chunk(project_id, chunk)
+
+    return results
+
+def _check_imported_issue(item):
+    if not isinstance(item, dict):
+        return "Issue must be an object"
+    if (item.get('ref') == None or item.get('status') == None 
+            or item.get('title') == None or item.get('link') == None):
+        return "ref, status, title and link are required"
+    if not isinstance(item['ref'], (basestring, int, long)) or isinstance(item['ref'], bool):
+        return "ref must be a string or a number"
+    if not isinstance(item['status'], basestring) or not isinstance(item['link'], basestring) \
+            or not isinstance(item['title'], basestring):
+        return "status, title and link must be strings"
+    if item.get('owner') != None and not isinstance(item['owner'], basestring):
+        return "owner must be a string"
+    if IssueStatus.from_string(item['status']) == None:
+        return "Unknown status"
+    if not item['link'].startswith('/'):
+        return "Link must be relative to the issue tracker URL and start with /"
+    return None
+
+def _import_issues_chunk(project_id, chunk):
+    owners = set(item['owner'] for item, result in chunk if item.get('owner') != None)
+    owner_ids = retrieve_create_users(project_id, owners)
+
+    refs = [unicode(item['ref']) for item, result in chunk]
+    existing = {i.issue_ref: i for i in db.session.query(Issue.issue_id, Issue.issue_ref, 
+            Issue.status, Issue.title, Issue.link, Issue.owner_id)
+        .filter(Issue.project_id == project_id, Issue.issue_ref.in_(refs))}
+
+    created = []
+    updated = []
+    for item, result in chunk:
+        values = dict(project_id=project_id, issue_ref=unicode(item['ref']), 
+                status=IssueStatus.from_string(item['status']), title=item['title'], 
+                link=item['link'], owner_id=owner_ids.get(item.get('owner')))
+        issue = existing.get(values['issue_ref'])
+        if issue == None:
+            created.append(values)
+            result['result'] = 'created'
+        elif (issue.status, issue.title, issue.link, issue.owner_id) != \
+                (values['status'], values['title'], values['link'], values['owner_id']):
+            updated.append({'b_' + k: v for k, v in values.items()})
+            updated[-1]['b_issue_id'] = issue.issue_id
+            result['result'] = 'updated'
+            if values['status'] != issue.status:
+                notify_issue_status(project_id, issue.issue_id, values['status'])
+        else:
+            result['result'] = 'unchanged'
+
+    table = Issue.__table__
+    if created:
+        db.session.execute(table.insert().values(created))
+    if updated:
+        db.session.execute(table.update()
+                .where(table.c.issue_id == db.bindparam('b_issue_id'))
+                .values(status=db.bindparam('b_status'), title=db.bindparam('b_title'), 
+                    link=db.bindparam('b_link'), owner_id=db.bindparam('b_owner_id')),
+                updated)
+
+def retrieve_sponsored_issues(project_id, status=None, owner_id=None, after=None, limit=None):
+    """Returns issues with positive bounty ordered by descending bounty, 
+    optionally only the ones after given (amount, issue_id) position"""
+    query = _sponsored_issues_query(project_id, status, owner_id)
+    if after != None:
+        amount, issue_id = after
+        query = query.filter(db.or_(IssueTotal.total < amount, 
+                db.and_(IssueTotal.total == amount, IssueTotal.issue_id > issue_id)))
+    query = query.order_by(IssueTotal.total.desc(), IssueTotal.issue_id)
+    if limit != None:
+        query = query.limit(limit)
+    return query.all()
+
+def count_sponsored_issues(project_id, status=None, owner_id=None):
+    return _sponsored_issues_query(project_id, status, owner_id).count()
+
+def _sponsored_issues_query(project_id, status, owner_id):
+    query = db.session.query(IssueTotal.issue_id, IssueTotal.total.label('amount'), 
+            Issue.issue_ref, Issue.status, Issue.title, Issue.link) \
+        .join(Issue, Issue.issue_id == IssueTotal.issue_id) \
+        .filter(IssueTotal.project_id == project_id, IssueTotal.total > 0)
+    return _filter_issues(query, status, owner_id)
+
+def mapify_sponsored_issue(project_id, issue):
+    return {
+        'ref': issue.issue_ref,
+        'status': IssueStatus.to_string(issue.status),
+        'title': issue.title,
+        'link': config[project_id].TRACKER_URL + issue.link,
+        'amount': issue.amount
+    }
 
 
 def retrieve_create_user(project_id, name):
-    user = retrieve_user(project_id, name)
-    if user == None:
-        user = User(project_id=project_id, name=name)
-        db.session.add(user)
-        db.session.commit()
-    return user
+    user_id = retrieve_create_user_id(project_id, name)
+    return User.query.get(user_id)
+
+def retrieve_create_user_id(project_id, name):
+    return retrieve_create_users(project_id, [name])[name]
+
+def retrieve_create_users(project_id, names):
+    """Returns dictionary of user name -> user_id, creates missing users"""
+    names = set(names)
+    user_ids = {}
+    for name in names:
+        user_id = user_cache.get(user_key(project_id, name))
+        if user_id != None:
+            user_ids[name] = user_id
+
+    missing = names - set(user_ids)
+    if missing:
+        found = _retrieve_user_ids(project_id, missing)
+        missing -= set(found)
+        if missing:
+            _insert_users(project_id, missing)
+            found.update(_retrieve_user_ids(project_id, missing))
+        user_ids.update(found)
+
+        # Only committed users are cached, transaction may still be rolled back
+        def cache_users():
+            for name, user_id in found.items():
+                user_cache.put(user_key(project_id, name), user_id)
+        after_commit(cache_users)
+    return user_ids
+
+def _retrieve_user_ids(project_id, names):
+    user_ids = {}
+    for chunk in chunks(sorted(names), CHUNK_SIZE):
+        user_ids.update(db.session.query(User.name, User.user_id)
+                .filter(User.project_id == project_id, User.name.in_(chunk)))
+    return user_ids
+
+def _insert_users(project_id, names):
+    """Inserts users ignoring the ones created concurrently by other transactions"""
+    insert = User.__table__.insert()
+    dialect = db.session.get_bind(User.__mapper__).dialect.name
+    for chunk in chunks(sorted(names), CHUNK_SIZE):
+        values = [dict(project_id=project_id, name=name) for name in chunk]
+        if dialect in ('sqlite', 'mysql'):
+            db.session.execute(insert.prefix_with('OR IGNORE', dialect='sqlite')
+                    .prefix_with('IGNORE', dialect='mysql').values(values))
+        else:
+            for value in values:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(insert.values(value))
+                except IntegrityError:
+                    pass
 
 def update_user(user):
     db.session.add(user)
-    db.session.commit()
+    db.session.flush()
 
 def mapify_user(user):
     result = dict(name=user.name, paypal_email=user.paypal_email)
@@ -130,7 +334,7 @@ def mapify_user(user):
 def create_sponsorship(project_id, issue_id, user_id, amount):
     sponsorship = Sponsorship(project_id, issue_id, user_id=user_id, amount=amount)
     db.session.add(sponsorship)
-    db.session.commit()
+    db.session.flush()
     return sponsorship.sponsorship_id
 
 def retrieve_sponsorship(issue_id, user_id):
@@ -143,10 +347,14 @@ def retrieve_all_sponsorships(issue_id):
 
 def update_sponsorship(sponsorship):
     db.session.add(sponsorship)
-    db.session.commit()
+    db.session.flush()
 
-def create_update_sponsorship(project_id, issue_id, account_id, amount):
+def retrieve_account_sponsorship(issue_id, account_id):
     sponsorship = Sponsorship.query.filter_by(issue_id=issue_id, account_id=account_id).first()
+    return sponsorship
+
+def create_update_sponsorship(project_id, issue_id, account_id, amount):
+    sponsorship = retrieve_account_sponsorship(issue_id, account_id)
     if not sponsorship:
         sponsorship = Sponsorship(project_id, issue_id, account_id=account_id)
     sponsorship.amount = amount
@@ -156,7 +364,7 @@ def remove_sponsorship(issue_id, user_id):
     sponsorship = retrieve_sponsorship(issue_id, user_id)
     Payment.query.filter_by(sponsorship_id=sponsorship.sponsorship_id).delete()
     db.session.delete(sponsorship)
-    db.session.commit()
+    db.session.flush()
     
 def retrieve_last_payment(sponsorship_id):
     payment = Payment.query.filter_by(sponsorship_id=sponsorship_id) \
@@ -165,48 +373,210 @@ def retrieve_last_payment(sponsorship_id):
 
 def update_payment(payment):
     db.session.add(payment)
-    db.session.commit()
-
-def create_change(project_id, method, path, arguments):
-    change = Change(project_id, method, path, arguments)
-    db.session.add(change)
-    db.session.commit()
-    return change.change_id
-
-def update_change(change_id, status, response):
-    change = Change.query.get(change_id)
-    if change == None:
-        current_app.logger.warn('Change %s not found', change_id)
+    db.session.flush()
+
+EMAIL_TEMPLATES = {
+    EmailTemplate.ISSUE_STARTED: 'The task you have sponsored has been started. Please deposit the promised amount. To do that please go to project issue tracker, log in, find this issue and select Confirm.',
+    EmailTemplate.ISSUE_COMPLETED_CONFIRMED: 'The task you have sponsored has been completed by the developer. Please validate it. To do that please go to project issue tracker, log in, find an issue and select Validate.',
+    EmailTemplate.ISSUE_COMPLETED_PLEDGED: 'The task you have sponsored has been completed by the developer. Please deposit the promised amout and validate it. To do that please go to project issue tracker, log in, find an issue and select Confirm and then Validate.',
+    EmailTemplate.SPONSORSHIP_VALIDATED: 'User %(user)s has validated his/her sponsorship. Please transfer the money to the developer.',
+    EmailTemplate.SPONSORSHIP_REJECTED: 'User %(user)s has rejected his/her sponsorship. Please refund the money to the user.',
+}
+
+def notify_issue_status(project_id, issue_id, status):
+    # Nothing to do for default status
+    if status == IssueStatus.READY:
+        pass
+    elif status == IssueStatus.STARTED:
+        notify_sponsors(project_id, issue_id, SponsorshipStatus.PLEDGED, 
+                EmailTemplate.ISSUE_STARTED)
+    elif status == IssueStatus.COMPLETED:
+        notify_sponsors(project_id, issue_id, SponsorshipStatus.CONFIRMED, 
+                EmailTemplate.ISSUE_COMPLETED_CONFIRMED)
+        notify_sponsors(project_id, issue_id, SponsorshipStatus.PLEDGED, 
+                EmailTemplate.ISSUE_COMPLETED_PLEDGED)
+    else:
+        raise Error("Unknown status")
+
+# Each of them supersedes the previous ones about the same issue
+ISSUE_TEMPLATES = [EmailTemplate.ISSUE_STARTED, EmailTemplate.ISSUE_COMPLETED_CONFIRMED, 
+        EmailTemplate.ISSUE_COMPLETED_PLEDGED]
+
+def notify_sponsors(project_id, issue_id, status, template):
+    """Creates emails for all sponsors in given status with single INSERT ... SELECT,
+    skips sponsors who still have the same email waiting"""
+    db.session.flush()
+
+    # Drop waiting notifications about earlier status of the issue
+    sponsor_ids = db.select([Sponsorship.user_id]).where(db.and_(
+            Sponsorship.issue_id == issue_id, Sponsorship.status == status))
+    Email.query.filter(Email.issue_id == issue_id, Email.user_id.in_(sponsor_ids),
+            Email.template.in_(ISSUE_TEMPLATES), Email.template != template,
+            Email.lease == None).delete(synchronize_session=False)
+
+    pending = db.select([Email.email_id]).where(db.and_(Email.issue_id == issue_id, 
+            Email.user_id == Sponsorship.user_id, Email.template == template, Email.params == None))
+    sponsors = db.select([db.literal(project_id), Sponsorship.user_id, 
+            db.literal(issue_id), db.literal(template), db.literal(datetime.now())]) \
+            .where(db.and_(Sponsorship.issue_id == issue_id, Sponsorship.status == status,
+                Sponsorship.user_id != None, ~db.exists(pending)))
+    result = db.session.execute(Email.__table__.insert().from_select(
+            ['project_id', 'user_id', 'issue_id', 'template', 'created'], sponsors))
+    if result.rowcount != 0:
+        after_commit(lambda: emails_created(project_id))
+
+def notify_admins(project_id, issue_id, template, params=None):
+    admin_id = retrieve_create_user_id(project_id, config.ADMIN)
+    create_email(project_id, admin_id, issue_id, template, params)
+
+def create_email(project_id, user_id, issue_id, template, params=None):
+    """Creates email unless identical one is still waiting to be sent"""
+    if params != None:
+        params = json.dumps(params, sort_keys=True)
+    pending = Email.query.filter_by(issue_id=issue_id, user_id=user_id, 
+            template=template, params=params)
+    if pending.first() != None:
         return
-    change.status = status
-    change.response = response
-    db.session.add(change)
-    db.session.commit()
-
-def notify_sponsors(project_id, issue_id, status, body):
-    sponsorships = Sponsorship.query.filter_by(issue_id=issue_id, status=status)
-    for sponsorship in sponsorships:
-        create_email(project_id, sponsorship.user.user_id, issue_id, body)
-
-def notify_admins(project_id, issue_id, body):
-    admin = retrieve_create_user(project_id, config.ADMIN)
-    create_email(project_id, admin.user_id, issue_id, body)
-
-def create_email(project_id, user_id, issue_id, body):
-    email = Email(project_id, user_id, issue_id, body)
+    email = Email(project_id, user_id, issue_id, template, params)
     db.session.add(email)
-    db.session.commit()
-
-def retrieve_all_emails():
-    return Email.query.all()
+    db.session.flush()
+    after_commit(lambda: emails_created(project_id))
+
+def emails_created(project_id):
+    outbox.mark_dirty(project_id)
+    change_notifier.notify([emails_key(project_id)])
+
+def render_email_body(email):
+    # Emails created before templates were introduced only have body
+    if email.template == None:
+        return email.body
+    params = json.loads(email.params) if email.params != None else {}
+    return EMAIL_TEMPLATES[email.template] % params
+
+def retrieve_emails(project_id, after=None, limit=None):
+    """Returns emails not claimed by any consumer ordered by id, 
+    optionally only the ones after given email_id"""
+    query = _available_emails(project_id, datetime.now())
+    if after != None:
+        query = query.filter(Email.email_id > after)
+    query = query.order_by(Email.email_id)
+    if limit != None:
+        query = query.limit(limit)
+    return query.all()
+
+def count_emails(project_id):
+    return _available_emails(project_id, datetime.now()).count()
+
+def _available_emails(project_id, now):
+    return Email.query.filter(Email.project_id == project_id, 
+            db.or_(Email.lease_expires == None, Email.lease_expires < now))
+
+def claim_emails(project_id, limit, duration):
+    """Leases up to limit available emails for duration seconds, 
+    returns lease and claimed emails.
+
+    With digests enabled, emails of a user are held until the first of them
+    has waited for the whole digest window, then all of them are claimed 
+    together and limit applies to the number of users"""
+    now = datetime.now()
+    available = _available_emails(project_id, now)
+    window = config[project_id].EMAIL_DIGEST_WINDOW
+    if window > 0:
+        # Emails created before digests were introduced have no timestamp
+        cutoff = now - timedelta(seconds=window)
+        user_ids = [user_id for user_id, in available.with_entities(Email.user_id)
+                .group_by(Email.user_id)
+                .having(db.func.min(db.func.coalesce(Email.created, cutoff)) <= cutoff)
+                .order_by(db.func.min(Email.email_id)).limit(limit)]
+        email_ids = [email_id for email_id, in available.with_entities(Email.email_id)
+                .filter(Email.user_id.in_(user_ids))] if user_ids else []
+    else:
+        email_ids = [email_id for email_id, in available.with_entities(Email.email_id)
+                .order_by(Email.email_id).limit(limit)]
+
+    lease = generate_token()
+    if email_ids:
+        # Emails claimed concurrently by someone else are no longer available
+        _available_emails(project_id, now).filter(Email.email_id.in_(email_ids)).update(
+                dict(lease=lease, lease_expires=now + timedelta(seconds=duration)),
+                synchronize_session=False)
+    emails = Email.query.filter_by(project_id=project_id, lease=lease) \
+            .order_by(Email.email_id).all()
+    return lease, emails
+
+def remove_emails(project_id, lease=None, email_ids=None):
+    """Deletes emails claimed under given lease or with given ids, returns their number"""
+    query = Email.query.filter(Email.project_id == project_id)
+    if lease != None:
+        query = query.filter(Email.lease == lease)
+    if email_ids != None:
+        query = query.filter(Email.email_id.in_(email_ids))
+    return query.delete(synchronize_session=False)
+
+def mapify_email(email):
+    return {'id': email.email_id, 'recipient': email.user.name, 
+            'issue_id': email.issue.issue_ref, 'body': render_email_body(email)}
+
+def mapify_digests(emails):
+    """Merges emails of each user into a single one, ids of merged emails are listed"""
+    digests = OrderedDict()
+    for email in emails:
+        digests.setdefault(email.user_id, []).append(email)
+
+    result = []
+    for user_emails in digests.values():
+        issue_refs = []
+        for email in user_emails:
+            if email.issue.issue_ref not in issue_refs:
+                issue_refs.append(email.issue.issue_ref)
+        if len(user_emails) == 1:
+            body = render_email_body(user_emails[0])
+        else:
+            body = '\n\n'.join('Issue %s: %s' % (email.issue.issue_ref, render_email_body(email)) 
+                    for email in user_emails)
+        result.append({'id': user_emails[0].email_id, 
+                'ids': [email.email_id for email in user_emails],
+                'recipient': user_emails[0].user.name, 'issue_id': issue_refs[-1], 
+                'issues': issue_refs, 'body': body})
+    return result
 
-def retrieve_email(email_id):
-    email = Email.query.get(email_id)
+def retrieve_email(project_id, email_id):
+    email = Email.query.filter_by(project_id=project_id, email_id=email_id).first()
     return email
 
 def remove_email(email):
     db.session.delete(email)
-    db.session.commit()
+    db.session.flush()
+
+def create_webhook(project_id, url, secret, events):
+    """Webhook receives only changes made after it was created"""
+    webhook = Webhook(project_id, url, secret, events, retrieve_last_change_id(project_id))
+    db.session.add(webhook)
+    db.session.flush()
+    return webhook
+
+def retrieve_webhooks(project_id):
+    return Webhook.query.filter_by(project_id=project_id).order_by(Webhook.webhook_id).all()
+
+def retrieve_webhook(project_id, webhook_id):
+    return Webhook.query.filter_by(project_id=project_id, webhook_id=webhook_id).first()
+
+def remove_webhook(webhook):
+    WebhookFailure.query.filter_by(webhook_id=webhook.webhook_id).delete()
+    db.session.delete(webhook)
+    db.session.flush()
+
+def mapify_webhook(webhook):
+    return dict(id=webhook.webhook_id, url=webhook.url, events=webhook.events, 
+            last_change_id=webhook.last_change_id, failures=webhook.failures)
+
+def retrieve_webhook_failures(webhook_id):
+    return WebhookFailure.query.filter_by(webhook_id=webhook_id) \
+            .order_by(WebhookFailure.failure_id).all()
+
+def mapify_webhook_failure(failure):
+    return dict(id=failure.failure_id, timestamp=failure.timestamp.isoformat(),
+            error=failure.error, payload=json.loads(failure.payload))
 
 def check_pledge_amount(project_id, amount):
     if amount <= 0:
@@ -214,21 +584,3 @@ def check_pledge_amount(project_id, amount):
     max_pledge_amount = config[project_id].MAX_PLEDGE_AMOUNT
     if amount > max_pledge_amount:
         raise Error("Amount may be up to %d" % max_pledge_amount)
-
-def send_emails():
-    emails = Email.query.all()
-    if len(emails) > 0:
-        project_ids = set(map(lambda email: email.project_id, emails))
-        for project_id in project_ids:
-            notify_url = config[project_id].TRACKER_URL + '/bountyfunding/email'
-            try:
-                requests.get(notify_url, timeout=1)
-            except requests.exceptions.RequestException:
-                current_app.logger.warn('Unable to connect to issue tracker at ' + notify_url)
-
-def notify():
-    send_emails()
-    t = threading.Timer(NOTIFY_INTERVAL, notify)
-    t.daemon = True
-    t.start()
-
@@ -6,9 +6,64 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from bountyfunding.core.const import SponsorshipStatus, PaymentStatus, PaymentGateway
 from bountyfunding.core.config import config
 from bountyfunding.core.errors import Error
-
-
-db = SQLAlchemy()
+from bountyfunding.core.sqlite_profile import apply_pool_options
+
+
+class Database(SQLAlchemy):
+    def __init__(self, *args, **kwargs):
+        SQLAlchemy.__init__(self, *args, **kwargs)
+        self.instrumented = set()
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername == 'sqlite':
+            apply_pool_options(info, options)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if engine not in self.instrumented:
+            self.instrumented.add(engine)
+            instrument_engine(engine, bind or 'primary')
+        return engine
+
+
+db = Database()
+
+
+def after_commit(callback, session=None):
+    """Executes callback once the current transaction is committed, 
+    discards it when the transaction is rolled back. Callbacks added within 
+    a savepoint wait for the enclosing transaction"""
+    if session == None:
+        session = db.session()
+    session.info.setdefault('after_commit', []).append(callback)
+
+@db.event.listens_for(db.Session, 'after_transaction_create')
+def _mark_savepoint(session, transaction):
+    if transaction.nested:
+        marks = session.info.setdefault('after_commit_marks', {})
+        marks[transaction] = len(session.info.get('after_commit', []))
+
+@db.event.listens_for(db.Session, 'after_commit')
+def _run_after_commit(session):
+    if session.transaction.nested:
+        session.info.get('after_commit_marks', {}).pop(session.transaction, None)
+        return
+    callbacks = session.info.pop('after_commit', [])
+    for callback in callbacks:
+        callback()
+
+@db.event.listens_for(db.Session, 'after_rollback')
+def _discard_after_commit(session):
+    if session.transaction.nested:
+        # Only callbacks added since the savepoint are discarded
+        mark = session.info.get('after_commit_marks', {}).pop(session.transaction, 0)
+        del session.info.get('after_commit', [])[mark:]
+        return
+    session.info.pop('after_commit', None)
 
 
 class Project(db.Model):
@@ -16,6 +71,12 @@ class Project(db.Model):
     name = db.Column(db.String(64), nullable=False)
     description = db.Column(db.String(1024), nullable=False)
     type = db.Column(db.Integer, nullable=False)
+    # Name of the database holding data of the project, empty for the main one
+    shard = db.Column(db.String(64), nullable=True)
+    # Increased by every move, data of the project gets new ids in the target database
+    shard_version = db.Column(db.Integer, nullable=False, default=0)
+    # Writes of the project are refused while it is moved
+    moving = db.Column(db.Boolean, nullable=False, default=False)
 
     def __init__(self, name, description, type):
         self.name = name
@@ -28,6 +89,7 @@ class Project(db.Model):
     def is_mutable(self):
         return True
 
+db.Index('idx_project_name', Project.name)
 
 class Account(db.Model):
     account_id = db.Column(db.Integer, primary_key=True)
@@ -35,7 +97,6 @@ class Account(db.Model):
     name = db.Column(db.String(128), nullable=False)
     password_hash = db.Column(db.String(128), nullable=True)
 
-    users = db.relation("User", lazy="joined")
     
     def __init__(self, email, name, password=None):
         self.email = email
@@ -43,10 +104,11 @@ class Account(db.Model):
         self.password = password
 
     def get_user(self, project_id):
-        for user in self.users:
-            if user.project_id == project_id:
-                return user
-        return None
+        # Users are stored in the shard of their project, so there is no
+        # relation spanning all of them
+        with shard_map.project(project_id):
+            return User.query.filter_by(project_id=project_id, 
+                    account_id=self.account_id).first()
 
     # Flask-Login integration
     def is_authenticated(self):
@@ -87,7 +149,8 @@ class User(db.Model):
     user_id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, nullable=False)
     name = db.Column(db.String(256), nullable=False)
-    account_id = db.Column(db.Integer, db.ForeignKey(Account.account_id), nullable=True)
+    # Not a foreign key, accounts stay in the main database when users are sharded
+    account_id = db.Column(db.Integer, nullable=True)
 
     #TODO: move to Account
     paypal_email = db.Column(db.String(256), nullable=True)
@@ -100,6 +163,7 @@ class User(db.Model):
     def __repr__(self):
         return '<User project_id: "%s", name: "%s">' % (self.project_id, self.name)
 
+db.Index('idx_user_project_id_name', User.project_id, User.name, unique=True)
 db.Index('idx_user_project_id_account_id', User.project_id, User.account_id, unique=True)
 db.Index('idx_user_account_id', User.account_id, unique=False)
 
@@ -130,6 +194,10 @@ class Issue(db.Model):
     def full_link(self):
         return config[self.project_id].TRACKER_URL + self.link
 
+db.Index('idx_issue_project_id_issue_ref', Issue.project_id, Issue.issue_ref)
+db.Index('idx_issue_project_id_status', Issue.project_id, Issue.status)
+db.Index('idx_issue_owner_id', Issue.owner_id)
+
 class Sponsorship(db.Model):
     sponsorship_id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, nullable=False)
@@ -138,8 +206,10 @@ class Sponsorship(db.Model):
     status = db.Column(db.Integer, nullable=False)
 
     #TODO: change nullable to False
-    account_id = db.Column(db.Integer, db.ForeignKey(Account.account_id), nullable=True)
-    account = db.relation(Account, lazy="joined")
+    # Not a foreign key, accounts stay in the main database when sponsorships are sharded
+    account_id = db.Column(db.Integer, nullable=True)
+    account = db.relation(Account, lazy="select", foreign_keys=[account_id],
+            primaryjoin=lambda: Sponsorship.account_id == Account.account_id)
 
     #TODO: delete
     user_id = db.Column(db.Integer, db.ForeignKey(User.user_id), nullable=True)
@@ -158,7 +228,28 @@ class Sponsorship(db.Model):
 
     def __repr__(self):
         return '<Sponsorship issue_id: "%s", user_id: "%s">' % (self.issue_id, self.user_id)
-    
+
+db.Index('idx_sponsorship_issue_id_user_id', Sponsorship.issue_id, Sponsorship.user_id)
+db.Index('idx_sponsorship_issue_id_account_id', Sponsorship.issue_id, Sponsorship.account_id)
+
+
+class IssueTotal(db.Model):
+    """Sum of sponsorship amounts per issue and status, maintained on each flush"""
+    issue_id = db.Column(db.Integer, db.ForeignKey(Issue.issue_id), primary_key=True)
+    project_id = db.Column(db.Integer, nullable=False)
+    total = db.Column(db.Integer, nullable=False)
+    pledged = db.Column(db.Integer, nullable=False)
+    confirmed = db.Column(db.Integer, nullable=False)
+    validated = db.Column(db.Integer, nullable=False)
+    transferred = db.Column(db.Integer, nullable=False)
+    rejected = db.Column(db.Integer, nullable=False)
+    refunded = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '<IssueTotal issue_id: "%s", total: "%s">' % (self.issue_id, self.total)
+
+db.Index('idx_issue_total_project_id_total', IssueTotal.project_id, IssueTotal.total)
+
 class Payment(db.Model):
     payment_id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, nullable=False)
@@ -181,26 +272,46 @@ class Payment(db.Model):
     def __repr__(self):
         return '<Payment payment_id: "%s">' % (self.payment_id,)
 
+db.Index('idx_payment_sponsorship_id_payment_id', Payment.sponsorship_id, Payment.payment_id)
+db.Index('idx_payment_gateway_id', Payment.gateway_id)
+
 class Email(db.Model):
     email_id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey(User.user_id), nullable=False)
     issue_id = db.Column(db.Integer, db.ForeignKey(Issue.issue_id), nullable=False)
+    # Rendered from template and JSON encoded params, body is kept for old emails
+    template = db.Column(db.Integer, nullable=True)
+    params = db.Column(db.String(256), nullable=True)
     body = db.Column(db.String(1024))
+    created = db.Column(db.DateTime, nullable=True)
+
+    # Set when claimed by a consumer, until acknowledged or expired
+    lease = db.Column(db.String(32), nullable=True)
+    lease_expires = db.Column(db.DateTime, nullable=True)
 
     user = db.relation(User, lazy="joined")
     issue = db.relation(Issue, lazy="joined")
     
-    def __init__(self, project_id, user_id, issue_id, body):
+    def __init__(self, project_id, user_id, issue_id, template, params=None):
         self.project_id = project_id
         self.user_id = user_id
         self.issue_id = issue_id
-        self.body = body
+        self.template = template
+        self.params = params
+        self.body = None
+        self.created = datetime.now()
+        self.lease = None
+        self.lease_expires = None
 
     def __repr__(self):
         return '<Email project_id: "%s", user_id: "%s", issue_id: "%s">' %\
                 (self.project_id, self.user_id, self.issue_id)
 
+db.Index('idx_email_project_id_email_id', Email.project_id, Email.email_id)
+db.Index('idx_email_lease', Email.lease)
+db.Index('idx_email_issue_id_user_id', Email.issue_id, Email.user_id)
+
 class Config(db.Model):
     config_id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, nullable=False)
@@ -217,6 +328,46 @@ class Config(db.Model):
 
 db.Index('idx_config_pid_name', Config.project_id, Config.name, unique=True)
 
+class Webhook(db.Model):
+    webhook_id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, nullable=False)
+    url = db.Column(db.String(1024), nullable=False)
+    # Used to sign payloads, optional
+    secret = db.Column(db.String(256), nullable=True)
+    # Comma separated event types, all when empty
+    events = db.Column(db.String(256), nullable=False)
+
+    # Last change delivered, or given up on after retries
+    last_change_id = db.Column(db.Integer, nullable=False)
+    failures = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, project_id, url, secret, events, last_change_id):
+        self.project_id = project_id
+        self.url = url
+        self.secret = secret
+        self.events = events
+        self.last_change_id = last_change_id
+        self.failures = 0
+
+    def __repr__(self):
+        return '<Webhook %s-%s: "%s">' % (self.project_id, self.webhook_id, self.url)
+
+db.Index('idx_webhook_project_id', Webhook.project_id)
+
+class WebhookFailure(db.Model):
+    """Dead letter, batch of events not delivered after all retries"""
+    failure_id = db.Column(db.Integer, primary_key=True)
+    webhook_id = db.Column(db.Integer, nullable=False)
+    project_id = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    payload = db.Column(db.Text(), nullable=False)
+    error = db.Column(db.String(1024), nullable=False)
+
+    def __repr__(self):
+        return '<WebhookFailure %s-%s>' % (self.webhook_id, self.failure_id)
+
+db.Index('idx_webhook_failure_webhook_id', WebhookFailure.webhook_id)
+
 class Change(db.Model):
     change_id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, nullable=False)
@@ -237,6 +388,8 @@ class Change(db.Model):
     def __repr__(self):
         return '<Change change_id: "%s"' % (self.change_id,)
 
+db.Index('idx_change_project_id_change_id', Change.project_id, Change.change_id)
+
 class Token(db.Model):
     token_id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, db.ForeignKey(Project.project_id), nullable=False)
@@ -251,3 +404,13 @@ class Token(db.Model):
 
 db.Index('idx_token_token', Token.token, unique=True)
 
+
+
+# Tables stored in the shard of their project, others stay in the main database
+for model in (User, Issue, Sponsorship, IssueTotal, Payment, Email, Change):
+    model.__table__.info['sharded'] = True
+
+
+# Tricky because routing needs models
+from bountyfunding.core.replica import RoutingSession, instrument_engine
+from bountyfunding.core.shards import shard_map
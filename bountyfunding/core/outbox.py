@@ -0,0 +1,209 @@
+from bountyfunding import app
+from bountyfunding.core.models import db, Email
+from bountyfunding.core.config import config
+from bountyfunding.core.shards import shard_map
+from bountyfunding.util.metrics import metrics
+
+from sqlalchemy import select
+from multiprocessing.pool import ThreadPool
+import threading, atexit, time, requests
+
+
+# Pending emails are checked again after this many seconds,
+# in case issue tracker was unavailable or did not fetch them
+SWEEP_INTERVAL = 5
+
+PING_TIMEOUT = 1
+
+# Number of trackers pinged concurrently
+POOL_SIZE = 16
+
+# Unavailable trackers are not pinged for exponentially growing time
+BACKOFF_INITIAL = 1
+BACKOFF_MAX = 300
+
+
+class TrackerState:
+    """Circuit breaker of a single issue tracker, open after a failed ping 
+    until its backoff elapses, then one ping is let through to probe it"""
+
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0
+
+    def is_open(self, now):
+        return now < self.retry_at
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = 0
+
+    def failed(self, now):
+        self.failures += 1
+        backoff = min(BACKOFF_INITIAL * 2 ** (self.failures - 1), BACKOFF_MAX)
+        self.retry_at = now + backoff
+
+
+class Outbox:
+    """Notifies issue trackers that emails are waiting for them.
+
+    Projects are marked dirty when emails are committed, a background thread
+    pings their trackers immediately, or after the digest window when enabled.
+    While some emails remain pending, the thread sweeps email table periodically, 
+    when there are none it does no work at all"""
+
+    def __init__(self, sweep_interval=SWEEP_INTERVAL):
+        self.sweep_interval = sweep_interval
+        self.condition = threading.Condition()
+        self.dirty = set()
+        self.scheduled = {}
+        self.stopped = False
+        self.thread = None
+        self.pool = None
+        self.session = None
+        self.trackers = {}
+
+    def start(self):
+        if self.thread != None:
+            return
+        self.stopped = False
+        self.pool = ThreadPool(POOL_SIZE)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.thread = threading.Thread(target=self._run, name='outbox')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.thread == None:
+            return
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+        self.thread = None
+        self.pool.close()
+        self.pool.join()
+        self.session.close()
+
+    def mark_dirty(self, project_id):
+        with self.condition:
+            self.dirty.add(project_id)
+            self.condition.notify()
+
+    def _run(self):
+        # Emails may be left from previous run
+        sweep_at = 0
+        while True:
+            with self.condition:
+                if not self.dirty and not self.stopped:
+                    self.condition.wait(self._timeout(sweep_at))
+                dirty, self.dirty = self.dirty, set()
+                if self.stopped:
+                    return
+
+            try:
+                now = time.time()
+                project_ids = self._schedule(dirty, now) | self._due(now)
+                if dirty:
+                    sweep_at = now + self.sweep_interval
+                elif sweep_at != None and now >= sweep_at:
+                    pending = self._pending_project_ids()
+                    project_ids |= pending
+                    sweep_at = now + self.sweep_interval if pending else None
+                self._notify(project_ids)
+            except Exception:
+                app.logger.exception('Unable to notify issue trackers')
+            finally:
+                db.session.remove()
+
+    def _timeout(self, sweep_at):
+        """Seconds until next sweep or digest, None to wait for dirty projects"""
+        wake_times = self.scheduled.values()
+        if sweep_at != None:
+            wake_times.append(sweep_at)
+        if not wake_times:
+            return None
+        return max(min(wake_times) - time.time(), 0)
+
+    def _schedule(self, project_ids, now):
+        """Returns projects to notify immediately, the ones collecting digests 
+        are notified when the window of their first email elapses"""
+        immediate = set()
+        for project_id in project_ids:
+            window = self._digest_window(project_id)
+            if window > 0:
+                self.scheduled.setdefault(project_id, now + window)
+            else:
+                immediate.add(project_id)
+        return immediate
+
+    def _due(self, now):
+        due = set(project_id for project_id, notify_at in self.scheduled.items() 
+                if notify_at <= now)
+        for project_id in due:
+            del self.scheduled[project_id]
+        return due
+
+    def _digest_window(self, project_id):
+        return config[project_id].EMAIL_DIGEST_WINDOW
+
+    def _pending_project_ids(self):
+        metrics.increment('outbox.sweeps')
+        query = select([Email.project_id]).distinct()
+        return set(row.project_id for engine in shard_map.engines()
+                for row in engine.execute(query))
+
+    def _notify(self, project_ids):
+        """Pings trackers of given projects concurrently, skips the ones with open circuit"""
+        start = time.time()
+        targets = []
+        for project_id in project_ids:
+            tracker = self.trackers.setdefault(project_id, TrackerState())
+            if tracker.is_open(start):
+                metrics.increment('outbox.skipped')
+            else:
+                url = config[project_id].TRACKER_URL + '/bountyfunding/email'
+                targets.append((project_id, url))
+
+        if self.pool != None:
+            latencies = self.pool.map(self._ping_tracker, targets)
+        else:
+            latencies = map(self._ping_tracker, targets)
+
+        # Aggregates only, number of metrics must not grow with projects
+        metrics.set('outbox.cycle_seconds', round(time.time() - start, 3))
+        metrics.set('outbox.latency_max_ms', max(latencies or [0]))
+        metrics.set('outbox.circuits_open', 
+                sum(1 for t in self.trackers.values() if t.is_open(time.time())))
+        metrics.set('outbox.trackers_failing', 
+                sum(1 for t in self.trackers.values() if t.failures > 0))
+
+    def _ping_tracker(self, target):
+        """Returns latency of the ping in milliseconds"""
+        project_id, url = target
+        tracker = self.trackers[project_id]
+        start = time.time()
+        success = self._ping(url)
+        now = time.time()
+        if success:
+            tracker.succeeded()
+            metrics.increment('outbox.pings')
+        else:
+            tracker.failed(now)
+            metrics.increment('outbox.ping_errors')
+        return int((now - start) * 1000)
+
+    def _ping(self, url):
+        try:
+            response = (self.session or requests).get(url, timeout=PING_TIMEOUT)
+            return response.status_code < 500
+        except requests.exceptions.RequestException:
+            app.logger.warn('Unable to connect to issue tracker at ' + url)
+            return False
+
+
+outbox = Outbox()
@@ -0,0 +1,113 @@
+from bountyfunding.core.config import config
+from bountyfunding.util.cache import LruCache
+from bountyfunding.util.metrics import metrics
+
+from flask import request, has_request_context
+from flask.ext.sqlalchemy import SignallingSession, get_state
+from sqlalchemy.sql.expression import UpdateBase
+from sqlalchemy import event
+import threading, contextlib, time
+
+
+REPLICA_BIND = 'replica'
+
+READ_METHODS = ('GET', 'HEAD')
+
+# Clients remembered as having written recently
+RECENT_WRITERS_SIZE = 10000
+
+
+class ReplicaRouter:
+    """Decides which requests may read from the replica. Client which has
+    written reads from the primary until the replica catches up, so it
+    sees its own writes"""
+
+    def __init__(self):
+        self.recent_writers = None
+        self.local = threading.local()
+
+    def _recent_writers(self):
+        if self.recent_writers == None:
+            self.recent_writers = LruCache(RECENT_WRITERS_SIZE, ttl=config.DATABASE_REPLICA_LAG)
+        return self.recent_writers
+
+    def client_key(self):
+        # Clients without token are told apart by address
+        return request.values.get('token') or request.remote_addr
+
+    def written(self):
+        if config.DATABASE_REPLICA_URL and config.DATABASE_REPLICA_LAG > 0:
+            self._recent_writers().put(self.client_key(), True)
+
+    def use_replica(self):
+        return bool(config.DATABASE_REPLICA_URL) and has_request_context() \
+                and request.method in READ_METHODS \
+                and not getattr(self.local, 'primary', False) \
+                and self._recent_writers().get(self.client_key()) == None
+
+    @contextlib.contextmanager
+    def primary(self):
+        """Reads within the block go to the primary. Used by reads filling
+        caches, which would keep values of the lagging replica after their
+        invalidation on commit"""
+        previous = getattr(self.local, 'primary', False)
+        self.local.primary = True
+        try:
+            yield
+        finally:
+            self.local.primary = previous
+
+    def clear(self):
+        if self.recent_writers != None:
+            self.recent_writers.clear()
+
+
+replica_router = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+    """Data of the current project goes to its shard. Other reads of GET
+    requests go to the replica. Once the session writes anything it stays
+    on the primary, replica would not see its changes"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['primary'] = True
+
+        if shard_map.is_enabled() and is_sharded(mapper, clause):
+            project_id = shard_map.current_project_id()
+            shard = shard_map.shard(project_id) if project_id != None else MAIN
+            if shard != MAIN:
+                return shard_map.shard_engine(shard)
+
+        if not self.info.get('primary') and replica_router.use_replica():
+            metrics.increment('database.replica_reads')
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def instrument_engine(engine, name):
+    """Collects number of queries, their total time and connections in use"""
+    prefix = 'database.%s.' % name
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_start'] = time.time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.time() - conn.info['query_start']
+        metrics.increment(prefix + 'queries')
+        metrics.increment(prefix + 'query_ms', int(elapsed * 1000))
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.increment(prefix + 'connections')
+
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        metrics.increment(prefix + 'connections', -1)
+
+
+# Tricky because shards need models and models need routing session
+from bountyfunding.core.shards import shard_map, is_sharded, MAIN
@@ -0,0 +1,248 @@
+from bountyfunding.core.models import db, Project, Webhook
+from bountyfunding.core.config import config
+from bountyfunding.util.cache import LruCache
+from bountyfunding.util.metrics import metrics
+
+from flask import g, has_app_context
+from sqlalchemy import select, func
+from sqlalchemy.sql.util import find_tables
+from collections import namedtuple
+import threading, importlib, contextlib, time
+
+
+# Name of the main database in the shard map, stored as NULL in project table
+MAIN = 'main'
+
+SHARD_BIND_PREFIX = 'shard:'
+
+# Project to shard cache, projects are moved rarely and only by the move-project action
+SHARD_CACHE_SIZE = 10000
+SHARD_CACHE_TTL = 60
+
+# Seconds move-project action waits for servers to notice the move: for their
+# shard caches to expire and requests started before the change to finish
+MOVE_WAIT = SHARD_CACHE_TTL + 30
+
+
+# Shard of the project, number of its moves and whether it is being moved
+Location = namedtuple('Location', ['shard', 'version', 'moving'])
+
+NOT_SHARDED = Location(MAIN, 0, False)
+
+
+def shard_bind(name):
+    return SHARD_BIND_PREFIX + name
+
+def sharded_tables():
+    """Tables holding project data, in order of their dependencies"""
+    return [t for t in db.metadata.sorted_tables if t.info.get('sharded')]
+
+def is_sharded(mapper=None, clause=None):
+    if mapper != None:
+        tables = [mapper.mapped_table]
+    elif clause != None:
+        tables = find_tables(clause, include_crud=True)
+    else:
+        tables = []
+    return any(t.info.get('sharded') for t in tables)
+
+
+def route_hash(project_id, shards):
+    return shards[project_id % len(shards)]
+
+def route_fewest(project_id, shards):
+    counts = dict(db.session.query(Project.shard, func.count()).group_by(Project.shard))
+    return min(shards, key=lambda shard: counts.get(shard, 0))
+
+ROUTING_FUNCTIONS = {
+    'fewest': route_fewest,
+    'hash': route_hash,
+}
+
+
+class ShardMap:
+    """Maps projects to databases holding their users, issues, sponsorships,
+    payments, emails and changes. Projects, tokens, accounts, configuration
+    and webhooks stay in the main database, which also holds data of projects
+    not assigned to any shard"""
+
+    def __init__(self):
+        self.cache = LruCache(SHARD_CACHE_SIZE, SHARD_CACHE_TTL)
+        self.local = threading.local()
+
+    def is_enabled(self):
+        return bool(config.DATABASE_SHARDS)
+
+    def location(self, project_id):
+        if not self.is_enabled():
+            return NOT_SHARDED
+        location = self.cache.get(project_id)
+        if location == None:
+            table = Project.__table__
+            row = db.engine.execute(select([table.c.shard, table.c.shard_version, table.c.moving])
+                    .where(table.c.project_id == project_id)).first()
+            if row != None:
+                location = Location(row.shard or MAIN, row.shard_version, bool(row.moving))
+            else:
+                location = NOT_SHARDED
+            self.cache.put(project_id, location)
+            metrics.increment('shards.lookups')
+        return location
+
+    def shard(self, project_id):
+        return self.location(project_id).shard
+
+    def version(self, project_id):
+        """Changes when the project is moved, its data gets new ids then"""
+        return self.location(project_id).version
+
+    def is_moving(self, project_id):
+        """Whether writes of the project have to be refused"""
+        return self.location(project_id).moving
+
+    def shard_engine(self, shard):
+        if shard == MAIN:
+            return db.engine
+        if shard not in config.DATABASE_SHARDS:
+            raise ValueError('Unknown shard: %s' % shard)
+        return db.get_engine(db.get_app(), bind=shard_bind(shard))
+
+    def engine(self, project_id):
+        """Engine of the database holding data of the project"""
+        return self.shard_engine(self.shard(project_id))
+
+    def engines(self):
+        """Engines of all databases holding project data"""
+        return [db.engine] + [self.shard_engine(s) for s in config.DATABASE_SHARDS]
+
+    def choose(self, project_id):
+        """Picks shard of a new project with the configured routing function,
+        returns None when sharding is disabled"""
+        if not self.is_enabled():
+            return None
+        routing = config.DATABASE_SHARD_ROUTING
+        function = ROUTING_FUNCTIONS.get(routing)
+        if function == None:
+            module, dot, name = routing.rpartition('.')
+            if not module:
+                raise ValueError('Unknown shard routing: %s' % routing)
+            function = getattr(importlib.import_module(module), name)
+        shard = function(project_id, list(config.DATABASE_SHARDS))
+        if shard != MAIN and shard not in config.DATABASE_SHARDS:
+            raise ValueError('Unknown shard chosen for project %s: %s' % (project_id, shard))
+        return shard if shard != MAIN else None
+
+    def current_project_id(self):
+        """Project whose data the session reads and writes, set explicitly
+        or by the request"""
+        project_id = getattr(self.local, 'project_id', None)
+        if project_id == None and has_app_context():
+            project_id = g.get('project_id')
+        return project_id
+
+    @contextlib.contextmanager
+    def project(self, project_id):
+        """Routes session to the shard of the project within the block"""
+        previous = getattr(self.local, 'project_id', None)
+        self.local.project_id = project_id
+        try:
+            yield
+        finally:
+            self.local.project_id = previous
+
+    def invalidate(self, project_id):
+        self.cache.invalidate(project_id)
+
+    def clear(self):
+        self.cache.clear()
+
+
+shard_map = ShardMap()
+
+
+def move_project(project_id, target, wait=MOVE_WAIT):
+    """Copies data of the project to target shard (or MAIN), points the project
+    at it and deletes the data from the previous one. Primary keys are assigned
+    anew by the target database, including change ids, so webhooks are moved to
+    the corresponding change. Returns number of rows moved.
+    Running servers refuse writes of the project while it is moved, they notice
+    it only after their shard caches expire, so the move waits that long before
+    copying the data and again before deleting it"""
+    shard_map.invalidate(project_id)
+    source_engine = shard_map.engine(project_id)
+    target_engine = shard_map.shard_engine(target)
+    if source_engine is target_engine:
+        raise ValueError('Project %s already in %s' % (project_id, target))
+
+    _set_moving(project_id, True)
+    try:
+        time.sleep(wait)
+        moved = _copy_project(project_id, source_engine, target_engine, target)
+        # Servers still reading the previous shard see data as it was before the move
+        time.sleep(wait)
+        with source_engine.begin() as connection:
+            for table in reversed(sharded_tables()):
+                connection.execute(table.delete().where(table.c.project_id == project_id))
+    finally:
+        _set_moving(project_id, False)
+    return moved
+
+def _set_moving(project_id, moving):
+    table = Project.__table__
+    db.engine.execute(table.update().where(table.c.project_id == project_id)
+            .values(moving=moving))
+    shard_map.invalidate(project_id)
+
+def _copy_project(project_id, source_engine, target_engine, target):
+    tables = sharded_tables()
+    # Table name -> old id -> new id
+    ids = {}
+    moved = 0
+    with target_engine.begin() as connection:
+        for table in tables:
+            ids[table.name] = table_ids = {}
+            primary_key = list(table.primary_key.columns)[0]
+            generated = not primary_key.foreign_keys
+            rows = source_engine.execute(table.select()
+                    .where(table.c.project_id == project_id)
+                    .order_by(primary_key)).fetchall()
+            for row in rows:
+                values = dict(row)
+                for column in table.columns:
+                    for key in column.foreign_keys:
+                        referred = key.column.table.name
+                        if values[column.name] != None and referred in ids:
+                            values[column.name] = ids[referred][values[column.name]]
+                if generated:
+                    old_id = values.pop(primary_key.name)
+                    result = connection.execute(table.insert().values(values))
+                    table_ids[old_id] = result.inserted_primary_key[0]
+                else:
+                    connection.execute(table.insert().values(values))
+            moved += len(rows)
+
+    with db.engine.begin() as connection:
+        table = Project.__table__
+        connection.execute(table.update().where(table.c.project_id == project_id)
+                .values(shard=target if target != MAIN else None, 
+                    shard_version=table.c.shard_version + 1))
+        _move_webhooks(connection, project_id, ids['change'])
+    shard_map.invalidate(project_id)
+    return moved
+
+def _move_webhooks(connection, project_id, change_ids):
+    table = Webhook.__table__
+    webhooks = connection.execute(select([table.c.webhook_id, table.c.last_change_id])
+            .where(table.c.project_id == project_id)).fetchall()
+    for webhook_id, last_change_id in webhooks:
+        # Last delivered change, or the one before first change not delivered yet
+        delivered = [new for old, new in change_ids.items() if old <= last_change_id]
+        pending = [new for old, new in change_ids.items() if old > last_change_id]
+        if delivered:
+            last_change_id = max(delivered)
+        elif pending:
+            last_change_id = min(pending) - 1
+        else:
+            last_change_id = 0
+        connection.execute(table.update().where(table.c.webhook_id == webhook_id)
+                .values(last_change_id=last_change_id))
@@ -0,0 +1,93 @@
+from bountyfunding.core.config import config
+from bountyfunding.util.metrics import metrics
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import event
+import sqlite3, threading, time, random
+
+
+# Connections opened above the pool size, used by background threads
+POOL_OVERFLOW = 8
+
+# Transactions failing on locked database are retried with jittered
+# exponential backoff, in seconds
+BACKOFF_INITIAL = 0.01
+BACKOFF_MAX = 1.0
+
+
+def is_production():
+    return config.SQLITE_PROFILE == 'production'
+
+def apply_pool_options(info, options):
+    """Keeps connections of SQLite database file open in a pool, so pragmas are
+    set once per connection instead of on every checkout"""
+    if not is_production() or info.database in (None, '', ':memory:'):
+        return
+    options['poolclass'] = QueuePool
+    options['pool_size'] = config.THREADS
+    options['max_overflow'] = POOL_OVERFLOW
+    # Pool hands each connection to one thread at a time
+    options.setdefault('connect_args', {})['check_same_thread'] = False
+
+class TransactionMode(threading.local):
+    """Immediate transactions of a thread take the write lock when they begin, 
+    instead of failing to upgrade their stale read lock later"""
+    immediate = False
+
+transaction_mode = TransactionMode()
+
+
+@event.listens_for(Engine, 'connect')
+def configure_connection(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    # Driver begins transactions only before modifications and commits 
+    # before SAVEPOINT, writer needs them begun by begin_transaction instead
+    if config.SQLITE_WRITER:
+        dbapi_connection.isolation_level = None
+    if not is_production():
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        # Readers do not wait for writers, not available in memory
+        if not config.DATABASE_IN_MEMORY:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=%s' % config.SQLITE_SYNCHRONOUS)
+        cursor.execute('PRAGMA busy_timeout=%d' % config.SQLITE_BUSY_TIMEOUT)
+        cursor.execute('PRAGMA mmap_size=%d' % config.SQLITE_MMAP_SIZE)
+        # Negative size is in KiB instead of pages
+        cursor.execute('PRAGMA cache_size=%d' % -config.SQLITE_CACHE_SIZE)
+    finally:
+        cursor.close()
+
+@event.listens_for(Engine, 'begin')
+def begin_transaction(connection):
+    if config.SQLITE_WRITER and connection.dialect.name == 'sqlite':
+        connection.execute('BEGIN IMMEDIATE' if transaction_mode.immediate else 'BEGIN')
+
+def is_busy(error):
+    message = str(getattr(error, 'orig', error))
+    return 'database is locked' in message or 'database is busy' in message
+
+def retry_busy(function, rollback, retries=None):
+    """Calls function until it does not fail on locked SQLite database, rolling
+    back the transaction before each retry. Busy timeout does not help writer
+    whose read snapshot became stale, the whole transaction has to be repeated"""
+    if retries == None:
+        retries = config.SQLITE_BUSY_RETRIES
+    attempt = 0
+    while True:
+        try:
+            return function()
+        except OperationalError as e:
+            if not is_busy(e):
+                raise
+            if attempt >= retries:
+                metrics.increment('sqlite.busy_failures')
+                raise
+            rollback()
+            attempt += 1
+            metrics.increment('sqlite.busy_retries')
+            time.sleep(random.uniform(0, min(BACKOFF_INITIAL * 2 ** attempt, BACKOFF_MAX)))
@@ -0,0 +1,125 @@
+from bountyfunding.core.models import db, Sponsorship, IssueTotal, after_commit
+from bountyfunding.core.const import SponsorshipStatus
+from bountyfunding.core.shards import shard_map
+
+from sqlalchemy import select, func, case, and_
+
+
+# Functions called with a list of issue_ids after their totals change is committed
+totals_listeners = []
+
+# Maps sponsorship status to issue_total column
+STATUS_COLUMNS = {status: SponsorshipStatus.to_string(status).lower()
+        for status in SponsorshipStatus.values()}
+
+
+def _totals_query(where):
+    columns = [Sponsorship.issue_id, func.min(Sponsorship.project_id).label('project_id'),
+            func.sum(Sponsorship.amount).label('total')]
+    for status, column in sorted(STATUS_COLUMNS.items()):
+        amount = case([(Sponsorship.status == status, Sponsorship.amount)], else_=0)
+        columns.append(func.sum(amount).label(column))
+    return select(columns).where(where).group_by(Sponsorship.issue_id)
+
+def _empty_totals(issue_id, project_id):
+    totals = dict(issue_id=issue_id, project_id=project_id, total=0)
+    for column in STATUS_COLUMNS.values():
+        totals[column] = 0
+    return totals
+
+def update_issue_totals(connection, issues):
+    """Recalculates totals of given issues, a dict issue_id -> project_id"""
+    table = IssueTotal.__table__
+    rows = connection.execute(_totals_query(Sponsorship.issue_id.in_(issues.keys())))
+    totals = {issue_id: _empty_totals(issue_id, project_id)
+            for issue_id, project_id in issues.items()}
+    for row in rows:
+        totals[row.issue_id].update(dict(row))
+
+    for issue_id, values in totals.items():
+        result = connection.execute(table.update()
+                .where(table.c.issue_id == issue_id).values(values))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(values))
+
+def _engines(project_id):
+    if project_id != None:
+        return [shard_map.engine(project_id)]
+    return shard_map.engines()
+
+def rebuild_issue_totals(project_id=None):
+    """Recalculates totals from scratch for one or all projects"""
+    table = IssueTotal.__table__
+    where = and_()
+    if project_id != None:
+        where = Sponsorship.project_id == project_id
+    query = _totals_query(where)
+
+    for engine in _engines(project_id):
+        with engine.begin() as connection:
+            delete = table.delete()
+            if project_id != None:
+                delete = delete.where(table.c.project_id == project_id)
+            connection.execute(delete)
+            connection.execute(table.insert().from_select(
+                    [c.name for c in query.columns], query))
+
+def check_issue_totals(project_id=None):
+    """Returns list of (issue_id, expected, stored) tuples for inconsistent totals,
+    each value being a dict of totals or None when missing"""
+    inconsistencies = []
+    for engine in _engines(project_id):
+        inconsistencies.extend(_check_issue_totals(engine, project_id))
+    return inconsistencies
+
+def _check_issue_totals(engine, project_id):
+    where = and_()
+    if project_id != None:
+        where = Sponsorship.project_id == project_id
+    expected = {row.issue_id: dict(row) for row in engine.execute(_totals_query(where))}
+
+    table = IssueTotal.__table__
+    query = table.select()
+    if project_id != None:
+        query = query.where(table.c.project_id == project_id)
+    stored = {row.issue_id: dict(row) for row in engine.execute(query)}
+
+    inconsistencies = []
+    for issue_id in sorted(set(expected) | set(stored)):
+        e = expected.get(issue_id)
+        s = stored.get(issue_id)
+        # Issues with all sponsorships deleted keep zero totals
+        if e == None and s != None and s['total'] == 0:
+            continue
+        if e != s:
+            inconsistencies.append((issue_id, e, s))
+    return inconsistencies
+
+def retrieve_issue_total(issue_id):
+    return IssueTotal.query.get(issue_id)
+
+
+# Totals are recalculated in the same transaction, after each flush
+# that touches sponsorships
+
+@db.event.listens_for(db.Session, 'before_flush')
+def _collect_sponsorships(session, flush_context, instances):
+    issues = session.info.setdefault('issue_totals', {})
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Sponsorship):
+            issues[instance.issue_id] = instance.project_id
+
+@db.event.listens_for(db.Session, 'after_flush_postexec')
+def _update_issue_totals(session, flush_context):
+    issues = session.info.pop('issue_totals', None)
+    if issues:
+        projects = {}
+        for issue_id, project_id in issues.items():
+            projects.setdefault(project_id, {})[issue_id] = project_id
+        for project_id, project_issues in projects.items():
+            with shard_map.project(project_id):
+                connection = session.connection(mapper=IssueTotal.__mapper__)
+            update_issue_totals(connection, project_issues)
+        issue_ids = issues.keys()
+        for listener in totals_listeners:
+            after_commit(lambda listener=listener: listener(issue_ids), session)
@@ -1,7 +1,7 @@
 from bountyfunding.core.const import IssueStatus
 from bountyfunding.core.config import config
-from bountyfunding.core.data import retrieve_issue, create_issue, update_issue, retrieve_create_user
-from bountyfunding.core.models import Project
+from bountyfunding.core.data import retrieve_issue, create_issue, update_issue, retrieve_create_users
+from bountyfunding.core.models import db, Project
 from bountyfunding.util.api import GithubApi
 import re
 
@@ -31,23 +31,28 @@ def sync_issues(project_id):
         if not github_issues:
             break
 
+        # Resolve all assignees of the page at once
+        owner_ids = retrieve_create_users(project_id,
+                [i.assignee.login for i in github_issues if i.assignee])
+
         for github_issue in github_issues:
-            issue = create_update_issue_from_github_issue(project_id, github_issue)
+            issue = create_update_issue_from_github_issue(project_id, github_issue, owner_ids)
             button = update_button(project, github_issue)
             if issue or button:
                 updated_issues.append(github_issue.number)
         
         page += 1
 
+    db.session.commit()
     return updated_issues
 
-def create_update_issue_from_github_issue(project_id, github_issue):
+def create_update_issue_from_github_issue(project_id, github_issue, owner_ids=None):
     """Returns None when issue has not been update"""
     issue_ref = github_issue.number
     title = github_issue.title
     link = get_link(github_issue)
     status = get_status(github_issue)
-    owner_id = get_owner_id(github_issue, project_id)
+    owner_id = get_owner_id(github_issue, project_id, owner_ids)
 
     issue = retrieve_issue(project_id, issue_ref)
     if issue == None:
@@ -79,13 +84,14 @@ def get_status(github_issue):
         status = IssueStatus.STARTED
     return status
 
-def get_owner_id(github_issue, project_id):
+def get_owner_id(github_issue, project_id, owner_ids=None):
     owner_id = None
     assignee = github_issue.assignee
     if assignee:
         login = assignee.login
-        user = retrieve_create_user(project_id, login)
-        owner_id = user.user_id
+        if owner_ids == None:
+            owner_ids = retrieve_create_users(project_id, [login])
+        owner_id = owner_ids[login]
     return owner_id 
 
 def update_button(project, github_issue):
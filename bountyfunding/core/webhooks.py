@@ -0,0 +1,343 @@
+from bountyfunding import app
+from bountyfunding.core.models import db, Webhook, WebhookFailure
+from bountyfunding.core.changes import change_listeners, change_type, retrieve_changes, mapify_change
+from bountyfunding.core.config import config
+from bountyfunding.util.metrics import metrics
+
+from sqlalchemy import select
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
+from datetime import datetime
+import threading, atexit, time, json, hmac, hashlib, Queue, requests
+import socket, binascii, urlparse
+
+
+# Event types which can be subscribed to
+WEBHOOK_EVENTS = ['issue', 'sponsorship', 'payment', 'email', 'user', 'project']
+# Sent when subscription does not list any
+DEFAULT_WEBHOOK_EVENTS = ['issue', 'sponsorship', 'payment']
+
+# Projects with new changes waiting for delivery
+QUEUE_SIZE = 1000
+
+# Number of webhooks delivered concurrently, each one gets at most one request at a time
+POOL_SIZE = 4
+
+# Events sent in one request
+BATCH_SIZE = 100
+
+DELIVERY_TIMEOUT = 5
+
+# Batch is moved to dead letters after this many failed attempts,
+# retried with exponential backoff until then
+MAX_ATTEMPTS = 8
+BACKOFF_INITIAL = 1
+BACKOFF_MAX = 600
+
+# How often scheduled retries are checked
+RETRY_CHECK_INTERVAL = 1
+
+# Special purpose IPv4 networks not reachable globally (IANA special purpose
+# address registry), webhooks may not be posted to them unless allowed by configuration
+PRIVATE_NETWORKS = [
+    ('0.0.0.0', 8),         # this network
+    ('10.0.0.0', 8),        # private
+    ('100.64.0.0', 10),     # shared address space
+    ('127.0.0.0', 8),       # loopback
+    ('169.254.0.0', 16),    # link local
+    ('172.16.0.0', 12),     # private
+    ('192.0.0.0', 24),      # IETF protocol assignments
+    ('192.0.2.0', 24),      # documentation
+    ('192.88.99.0', 24),    # 6to4 relay anycast
+    ('192.168.0.0', 16),    # private
+    ('198.18.0.0', 15),     # benchmarking
+    ('198.51.100.0', 24),   # documentation
+    ('203.0.113.0', 24),    # documentation
+    ('224.0.0.0', 4),       # multicast
+    ('240.0.0.0', 4),       # reserved, including limited broadcast
+]
+
+# Same for IPv6, addresses embedding IPv4 ones are checked against the list above
+PRIVATE_IPV6_NETWORKS = [
+    ('::', 96),             # unspecified, loopback and IPv4 compatible
+    ('64:ff9b:1::', 48),    # local use IPv4/IPv6 translation
+    ('100::', 64),          # discard only
+    ('2001::', 23),         # IETF protocol assignments
+    ('2001:db8::', 32),     # documentation
+    ('fc00::', 7),          # unique local
+    ('fe80::', 10),         # link local
+    ('fec0::', 10),         # site local
+    ('ff00::', 8),          # multicast
+]
+
+# Prefixes of IPv6 addresses ending with IPv4 address: mapped and translated
+IPV4_EMBEDDING_PREFIXES = ['\0' * 10 + '\xff\xff', '\0\x64\xff\x9b' + '\0' * 8]
+
+_STOP = object()
+
+
+def webhook_events(events):
+    return events.split(',') if events else DEFAULT_WEBHOOK_EVENTS
+
+def sign(secret, payload):
+    return 'sha256=' + hmac.new(secret.encode('utf-8'), payload, hashlib.sha256).hexdigest()
+
+def _in_networks(packed, networks, family):
+    value = long(binascii.hexlify(packed), 16)
+    length = len(packed) * 8
+    for network, bits in networks:
+        base = long(binascii.hexlify(socket.inet_pton(family, network)), 16)
+        if value >> (length - bits) == base >> (length - bits):
+            return True
+    return False
+
+def _is_private_ipv4(address):
+    return _in_networks(socket.inet_aton(address), PRIVATE_NETWORKS, socket.AF_INET)
+
+def _is_private_ipv6(address):
+    packed = socket.inet_pton(socket.AF_INET6, address.split('%')[0])
+    if packed[:12] in IPV4_EMBEDDING_PREFIXES:
+        return _is_private_ipv4(socket.inet_ntoa(packed[12:]))
+    # 6to4 address embeds IPv4 address after its prefix
+    if packed[:2] == '\x20\x02':
+        return _is_private_ipv4(socket.inet_ntoa(packed[2:6]))
+    return _in_networks(packed, PRIVATE_IPV6_NETWORKS, socket.AF_INET6)
+
+def is_private_address(family, address):
+    return (family == socket.AF_INET and _is_private_ipv4(address)) or \
+            (family == socket.AF_INET6 and _is_private_ipv6(address))
+
+def check_webhook_url(url):
+    """Returns why webhooks may not be posted to the url, None if they may"""
+    if url == None or not url.startswith(('http://', 'https://')):
+        return 'url parameter with http or https address is required'
+    if config.WEBHOOK_ALLOW_PRIVATE:
+        return None
+    try:
+        host = urlparse.urlsplit(url).hostname
+    except ValueError:
+        host = None
+    if not host:
+        return 'url has no host'
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.error:
+        return 'Unable to resolve %s' % host
+    for family, type, proto, name, address in infos:
+        if is_private_address(family, address[0]):
+            return 'Loopback, private and link-local addresses are not allowed'
+    return None
+
+
+def _public_connection(base):
+    class PublicConnection(base):
+        """Connection refusing to send anything to a private address, host of
+        the webhook may resolve to one after its url was checked"""
+        checks_address = True
+
+        def _new_conn(self):
+            sock = base._new_conn(self)
+            address = sock.getpeername()[0]
+            if is_private_address(sock.family, address) and not config.WEBHOOK_ALLOW_PRIVATE:
+                sock.close()
+                raise socket.error('Address %s is not allowed' % address)
+            return sock
+    return PublicConnection
+
+class PublicAddressAdapter(HTTPAdapter):
+    """Checks address of each new connection, proxies are trusted to do it"""
+
+    def get_connection(self, url, proxies=None):
+        pool = super(PublicAddressAdapter, self).get_connection(url, proxies)
+        if not (proxies or {}).get(urlparse.urlsplit(url).scheme) and \
+                not getattr(pool.ConnectionCls, 'checks_address', False):
+            pool.ConnectionCls = _public_connection(pool.ConnectionCls)
+        return pool
+
+
+class WebhookDispatcher:
+    """Posts changes of projects to their webhooks. Each webhook keeps id of
+    the last change delivered, so deliveries continue where they stopped
+    after failure or restart"""
+
+    def __init__(self):
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.busy = set()
+        self.rerun = set()
+        self.retries = {}
+        self.thread = None
+        self.pool = None
+        self.session = requests.Session()
+        self.session.mount('http://', PublicAddressAdapter())
+        self.session.mount('https://', PublicAddressAdapter())
+
+    def start(self):
+        if self.thread != None:
+            return
+        self.pool = ThreadPool(POOL_SIZE)
+        self.thread = threading.Thread(target=self._run, name='webhooks')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+        # Catch up with changes made while not running
+        table = Webhook.__table__
+        query = select([table.c.project_id]).distinct()
+        self.changed(set(row.project_id for row in db.engine.execute(query)))
+
+    def stop(self):
+        if self.thread == None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+        self.pool.close()
+        self.pool.join()
+
+    def changed(self, project_ids):
+        if self.thread == None:
+            return
+        for project_id in project_ids:
+            try:
+                self.queue.put_nowait(project_id)
+            except Queue.Full:
+                # Delivered with the next change of the project
+                metrics.increment('webhooks.dropped')
+        metrics.set('webhooks.queue_depth', self.queue.qsize())
+
+    def _run(self):
+        while True:
+            project_ids = set()
+            try:
+                project_id = self.queue.get(timeout=RETRY_CHECK_INTERVAL)
+                if project_id is _STOP:
+                    return
+                project_ids.add(project_id)
+            except Queue.Empty:
+                pass
+
+            try:
+                for project_id in project_ids:
+                    for webhook_id in self._webhook_ids(project_id):
+                        self._submit(webhook_id)
+                for webhook_id in self._due_retries():
+                    self._submit(webhook_id)
+            except Exception:
+                app.logger.exception('Unable to dispatch webhooks')
+            metrics.set('webhooks.queue_depth', self.queue.qsize())
+
+    def _webhook_ids(self, project_id):
+        table = Webhook.__table__
+        query = select([table.c.webhook_id]).where(table.c.project_id == project_id)
+        return [row.webhook_id for row in db.engine.execute(query)]
+
+    def _due_retries(self):
+        now = time.time()
+        with self.lock:
+            due = [webhook_id for webhook_id, retry_at in self.retries.items() if retry_at <= now]
+            for webhook_id in due:
+                del self.retries[webhook_id]
+        return due
+
+    def _submit(self, webhook_id):
+        with self.lock:
+            if webhook_id in self.retries:
+                return
+            if webhook_id in self.busy:
+                self.rerun.add(webhook_id)
+                return
+            self.busy.add(webhook_id)
+        self.pool.apply_async(self._deliver_busy, (webhook_id,))
+
+    def _deliver_busy(self, webhook_id):
+        try:
+            # Changes may come while delivering, deliver them too
+            while self.deliver(webhook_id):
+                with self.lock:
+                    if webhook_id not in self.rerun:
+                        break
+                    self.rerun.discard(webhook_id)
+        except Exception:
+            app.logger.exception('Unable to deliver webhook %s', webhook_id)
+        finally:
+            with self.lock:
+                self.busy.discard(webhook_id)
+                self.rerun.discard(webhook_id)
+
+    def deliver(self, webhook_id):
+        """Posts all pending events to the webhook in batches, returns False
+        when delivery failed and is scheduled to be retried"""
+        table = Webhook.__table__
+        while True:
+            webhook = db.engine.execute(table.select()
+                    .where(table.c.webhook_id == webhook_id)).first()
+            if webhook == None:
+                return True
+
+            changes = retrieve_changes(webhook.project_id, webhook.last_change_id, BATCH_SIZE)
+            if not changes:
+                return True
+
+            events = webhook_events(webhook.events)
+            payload = [mapify_change(c) for c in changes if change_type(c.path) in events]
+            failures = 0
+            if payload:
+                payload = json.dumps(dict(webhook_id=webhook_id, events=payload))
+                error = self._post(webhook, payload)
+                if error == None:
+                    metrics.increment('webhooks.delivered')
+                else:
+                    metrics.increment('webhooks.failures')
+                    failures = webhook.failures + 1
+                    if failures < MAX_ATTEMPTS:
+                        self._retry_later(webhook, failures)
+                        return False
+                    self._dead_letter(webhook, payload, error)
+                    failures = 0
+
+            db.engine.execute(table.update().where(table.c.webhook_id == webhook_id)
+                    .values(last_change_id=changes[-1].change_id, failures=failures))
+            if len(changes) < BATCH_SIZE:
+                return True
+
+    def _post(self, webhook, payload):
+        """Returns error description or None on success"""
+        headers = {'Content-Type': 'application/json',
+                'X-BountyFunding-Webhook': str(webhook.webhook_id)}
+        if webhook.secret:
+            headers['X-BountyFunding-Signature'] = sign(webhook.secret, payload)
+        # Host may resolve differently than when the webhook was created,
+        # or even than now, connections check the address again
+        error = check_webhook_url(webhook.url)
+        if error != None:
+            return error
+        try:
+            # Redirects could lead to addresses which are not allowed
+            response = self.session.post(webhook.url, data=payload, headers=headers,
+                    timeout=DELIVERY_TIMEOUT, allow_redirects=False)
+        except requests.exceptions.RequestException as e:
+            return 'Unable to connect: %s' % e
+        if response.status_code < 200 or response.status_code >= 300:
+            return 'HTTP status %d' % response.status_code
+        return None
+
+    def _retry_later(self, webhook, failures):
+        table = Webhook.__table__
+        db.engine.execute(table.update().where(table.c.webhook_id == webhook.webhook_id)
+                .values(failures=failures))
+        backoff = min(BACKOFF_INITIAL * 2 ** (failures - 1), BACKOFF_MAX)
+        with self.lock:
+            self.retries[webhook.webhook_id] = time.time() + backoff
+
+    def _dead_letter(self, webhook, payload, error):
+        metrics.increment('webhooks.dead_letters')
+        app.logger.warn('Giving up delivery to webhook %s: %s', webhook.webhook_id, error)
+        db.engine.execute(WebhookFailure.__table__.insert().values(
+                webhook_id=webhook.webhook_id, project_id=webhook.project_id,
+                timestamp=datetime.now(), payload=payload, error=error[:1024]))
+
+
+webhook_dispatcher = WebhookDispatcher()
+
+change_listeners.append(webhook_dispatcher.changed)
@@ -0,0 +1,131 @@
+from bountyfunding import app
+from bountyfunding.core.models import db
+from bountyfunding.core.sqlite_profile import transaction_mode
+from bountyfunding.util.metrics import metrics
+
+from flask import _app_ctx_stack
+import threading, atexit, time, sys, Queue
+
+
+# Requests waiting for the writer at most, callers block when it is full
+QUEUE_SIZE = 1000
+
+# Requests committed together at most
+GROUP_SIZE = 64
+
+_STOP = object()
+
+
+class Task:
+    def __init__(self, function):
+        self.function = function
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Writer:
+    """Executes modifying requests on a single thread, so they do not contend
+    for SQLite write lock. Requests which arrived while the previous group was
+    executed form the next one: each of them runs in its own savepoint, rolled
+    back alone when it fails, and the whole group is committed with one disk
+    sync. Callers get their results only after the commit"""
+
+    def __init__(self, group_size=GROUP_SIZE):
+        self.group_size = group_size
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        self.thread = None
+
+    def start(self):
+        if self.thread != None:
+            return
+        self.thread = threading.Thread(target=self._run, name='writer')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.thread == None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def is_running(self):
+        return self.thread != None
+
+    def in_group(self):
+        """Tells whether current thread executes a group, whose commit comes later"""
+        return self.thread != None and threading.current_thread() is self.thread
+
+    def submit(self, function):
+        """Executes function on the writer thread and returns its result
+        once committed, or raises its exception"""
+        task = Task(function)
+        self.queue.put(task)
+        task.done.wait()
+        if task.error != None:
+            raise task.error[0], task.error[1], task.error[2]
+        return task.result
+
+    def _run(self):
+        transaction_mode.immediate = True
+        while True:
+            tasks = [self.queue.get()]
+            while len(tasks) < self.group_size:
+                try:
+                    tasks.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            # Request teardown would take handled exception for its own
+            sys.exc_clear()
+
+            stopped = _STOP in tasks
+            tasks = [t for t in tasks if t is not _STOP]
+            if tasks:
+                self._execute(tasks)
+            if stopped:
+                return
+
+    def _execute(self, tasks):
+        start = time.time()
+        # Requests share the application context, so session is not removed between them
+        with app.app_context():
+            session = db.session()
+            try:
+                for task in tasks:
+                    self._execute_task(session, task)
+                session.commit()
+            except Exception:
+                error = sys.exc_info()
+                app.logger.exception('Unable to commit group of %d requests', len(tasks))
+                session.rollback()
+                for task in tasks:
+                    if task.error == None:
+                        task.result, task.error = None, error
+                metrics.increment('writer.failed_groups')
+            finally:
+                for task in tasks:
+                    task.done.set()
+
+        metrics.increment('writer.groups')
+        metrics.increment('writer.requests', len(tasks))
+        metrics.set('writer.group_size', len(tasks))
+        metrics.set('writer.group_ms', int((time.time() - start) * 1000))
+        metrics.set('writer.queue_depth', self.queue.qsize())
+
+    def _execute_task(self, session, task):
+        # Each request starts with empty globals, as on its own thread
+        _app_ctx_stack.top.g = app.app_ctx_globals_class()
+        session.begin_nested()
+        try:
+            task.result = task.function()
+        except Exception:
+            task.error = sys.exc_info()
+            sys.exc_clear()
+        # Request failing before its unit of work ended leaves savepoint open
+        if session.transaction.nested:
+            session.rollback()
+
+
+writer = Writer()
@@ -1,11 +1,13 @@
 from bountyfunding.gui import gui
 from bountyfunding.gui.forms import LoginForm, RegisterForm, IssueForm
 from bountyfunding.core.models import db, Account, Project, Issue, Sponsorship
-from bountyfunding.core.data import retrieve_all_sponsorships, create_update_sponsorship
+from bountyfunding.core.data import retrieve_account_sponsorship, create_update_sponsorship
+from bountyfunding.core.totals import retrieve_issue_total
 from bountyfunding.core.const import IssueStatus, ProjectType
 from bountyfunding.core.trackers.github import create_update_issue
+from bountyfunding.core.shards import shard_map
 
-from flask import redirect, render_template, request, url_for, flash, abort
+from flask import redirect, render_template, request, url_for, flash, abort, g
 from flask.ext.login import LoginManager, login_required, login_user, logout_user, current_user as current_account
 from flask_bootstrap import Bootstrap
 
@@ -67,30 +69,37 @@ def register():
 @login_required
 def issue(project_name, issue_ref):
     project = Project.query.filter_by(name=project_name).first()
-    issue = Issue.query.filter_by(issue_ref=issue_ref).first()
-    
     if project == None:
         abort(404)
+
+    # Issues are read from the shard of the project
+    g.project_id = project.project_id
+    # Project being moved to another shard is read only
+    writable = not shard_map.is_moving(project.project_id)
+    issue = Issue.query.filter_by(project_id=project.project_id, issue_ref=issue_ref).first()
     
     if issue == None:
-        if project.type == ProjectType.GITHUB:
+        if project.type == ProjectType.GITHUB and writable:
             issue = create_update_issue(project.project_id, issue_ref)
+            db.session.commit()
     
     if issue == None:
         abort(404)
 
-    sponsorships = retrieve_all_sponsorships(issue.issue_id)
-    bounty = sum(s.amount for s in sponsorships)
-    sponsorship_map = {s.account.account_id: s for s in sponsorships if s.account} 
+    total = retrieve_issue_total(issue.issue_id)
+    bounty = total.total if total != None else 0
     
-    my_sponsorship = sponsorship_map.get(current_account.account_id)
+    my_sponsorship = retrieve_account_sponsorship(issue.issue_id, current_account.account_id)
     my_bounty = my_sponsorship.amount if my_sponsorship else 0
 
     form = IssueForm()
     if form.validate_on_submit():
+        if not writable:
+            abort(503)
         amount = form.amount.data
         create_update_sponsorship(project.project_id, issue.issue_id,
                     account_id=current_account.account_id, amount=amount)
+        db.session.commit()
         if amount == 0 and my_bounty > 0:
             flash('Sponsorship deleted.')
         elif amount != my_bounty:
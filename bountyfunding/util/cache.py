@@ -0,0 +1,58 @@
+from collections import OrderedDict
+import threading, time
+
+
+class LruCache:
+    """Thread-safe dictionary with limited size and optional time to live,
+    least recently used entries are evicted first. Version is incremented by
+    each invalidation, value loaded at an older one is not put"""
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry == None:
+                return default
+            value, expires = entry
+            if expires != None and expires < time.time():
+                return default
+            self.entries[key] = entry
+            return value
+
+    def put(self, key, value, version=None):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            # Invalidated while the value was loaded
+            if version != None and version != self.version:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.version += 1
+            self.entries.pop(key, None)
+
+    def invalidate_if(self, predicate):
+        """Removes all entries for which predicate(key, value) is true"""
+        with self.lock:
+            self.version += 1
+            for key, (value, expires) in self.entries.items():
+                if predicate(key, value):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
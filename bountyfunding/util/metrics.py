@@ -0,0 +1,32 @@
+import threading
+
+
+class Metrics:
+    """Thread-safe registry of named counters exposed by the /metrics endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def get(self, name):
+        with self.lock:
+            return self.values.get(name, 0)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,82 @@
+-- index sponsorships by issue
+CREATE INDEX idx_sponsorship_issue_id_user_id ON sponsorship(issue_id, user_id);
+
+-- add issue totals, populate with ./bountyfunding.py rebuild-totals
+CREATE TABLE issue_total (
+	issue_id INTEGER NOT NULL REFERENCES issue(issue_id),
+	project_id INTEGER NOT NULL,
+	total INTEGER NOT NULL,
+	pledged INTEGER NOT NULL,
+	confirmed INTEGER NOT NULL,
+	validated INTEGER NOT NULL,
+	transferred INTEGER NOT NULL,
+	rejected INTEGER NOT NULL,
+	refunded INTEGER NOT NULL,
+	PRIMARY KEY (issue_id)
+);
+
+CREATE INDEX idx_issue_total_project_id_total ON issue_total(project_id, total);
+
+-- one user per name in a project, remove duplicates before applying
+CREATE UNIQUE INDEX idx_user_project_id_name ON user(project_id, name);
+
+-- email leases
+ALTER TABLE email ADD COLUMN lease VARCHAR(32);
+ALTER TABLE email ADD COLUMN lease_expires DATETIME;
+CREATE INDEX idx_email_project_id_email_id ON email(project_id, email_id);
+CREATE INDEX idx_email_lease ON email(lease);
+
+-- email templates, body is only kept for emails created before
+ALTER TABLE email ADD COLUMN template INTEGER;
+ALTER TABLE email ADD COLUMN params VARCHAR(256);
+CREATE INDEX idx_email_issue_id_user_id ON email(issue_id, user_id);
+
+-- email digests
+ALTER TABLE email ADD COLUMN created DATETIME;
+
+-- change feeds read changes of a project in id order
+CREATE INDEX idx_change_project_id_change_id ON change(project_id, change_id);
+
+-- webhooks
+CREATE TABLE webhook (
+	webhook_id INTEGER NOT NULL,
+	project_id INTEGER NOT NULL,
+	url VARCHAR(1024) NOT NULL,
+	secret VARCHAR(256),
+	events VARCHAR(256) NOT NULL,
+	last_change_id INTEGER NOT NULL,
+	failures INTEGER NOT NULL,
+	PRIMARY KEY (webhook_id)
+);
+
+CREATE INDEX idx_webhook_project_id ON webhook(project_id);
+
+CREATE TABLE webhook_failure (
+	failure_id INTEGER NOT NULL,
+	webhook_id INTEGER NOT NULL,
+	project_id INTEGER NOT NULL,
+	timestamp DATETIME NOT NULL,
+	payload TEXT NOT NULL,
+	error VARCHAR(1024) NOT NULL,
+	PRIMARY KEY (failure_id)
+);
+
+CREATE INDEX idx_webhook_failure_webhook_id ON webhook_failure(webhook_id);
+
+-- indexes for lookups of the data layer, verified by test/integration_test/query_plan_test.py
+CREATE INDEX idx_project_name ON project(name);
+CREATE INDEX idx_issue_project_id_issue_ref ON issue(project_id, issue_ref);
+CREATE INDEX idx_issue_project_id_status ON issue(project_id, status);
+CREATE INDEX idx_issue_owner_id ON issue(owner_id);
+CREATE INDEX idx_sponsorship_issue_id_account_id ON sponsorship(issue_id, account_id);
+CREATE INDEX idx_payment_sponsorship_id_payment_id ON payment(sponsorship_id, payment_id);
+CREATE INDEX idx_payment_gateway_id ON payment(gateway_id);
+
+-- shard holding data of the project, NULL for the main database
+ALTER TABLE project ADD COLUMN shard VARCHAR(64);
+-- user.account_id and sponsorship.account_id keep referencing account in the main
+-- database, shard databases are created by create-db action without these foreign keys
+
+-- number of moves of the project between shards and flag refusing its writes during a move
+ALTER TABLE project ADD COLUMN shard_version INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE project ADD COLUMN moving BOOLEAN NOT NULL DEFAULT 0;
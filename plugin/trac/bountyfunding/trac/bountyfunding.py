@@ -45,6 +45,8 @@ class Email:
         self.recipient = dictionary.get('recipient')
         self.issue_id = dictionary.get('issue_id')
         self.body = dictionary.get('body')
+        # Digests merge emails about several issues
+        self.issues = dictionary.get('issues', [self.issue_id])
 
 class GenericNotifyEmail(NotifyEmail):
     template_name = 'email.txt'
@@ -180,6 +182,16 @@ class BountyFundingPlugin(Component):
         email = GenericNotifyEmail(self.env, recipient, body, link)
         email.notify('', subject)
 
+    def send_digest(self, recipient, ticket_ids, body):
+        prefix = self.config.get('notification', 'smtp_subject_prefix')
+        if prefix == '__default__':
+            prefix = '[%s]' % self.env.project_name
+        subject = '%s Bounty updates of %d tickets' % (prefix, len(ticket_ids))
+        link = self.env.abs_href.query(id=','.join(map(str, ticket_ids)))
+
+        email = GenericNotifyEmail(self.env, recipient, body, link)
+        email.notify('', subject)
+
     def format_email_subject(self, ticket):
         template = self.config.get('notification','ticket_subject_template')
         template = NewTextTemplate(template.encode('utf8'))
@@ -462,12 +474,17 @@ class BountyFundingPlugin(Component):
         elif match.group('bountyfunding'):
             action = match.group('bountyfunding_action')
             if action == 'email':
-                request = self.call_api('GET', '/emails')
+                request = self.call_api('POST', '/emails/claim')
                 if request.status_code == 200:
+                    lease = request.json().get('lease')
                     emails = [Email(email) for email in request.json().get('data')]
                     for email in emails:
-                        self.send_email(email.recipient, int(email.issue_id), email.body)
-                        self.call_api('DELETE', '/email/%s' % email.id), 
+                        if len(email.issues) > 1:
+                            self.send_digest(email.recipient, map(int, email.issues), email.body)
+                        else:
+                            self.send_email(email.recipient, int(email.issue_id), email.body)
+                    if emails:
+                        self.call_api('DELETE', '/emails', lease=lease)
                 req.send_no_content()
             if action == 'status':
                 request = self.call_api('GET', '/version')
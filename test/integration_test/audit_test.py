@@ -0,0 +1,41 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database
+from bountyfunding.core.models import Change, Issue
+from bountyfunding.core.audit import audit_log
+
+from test import to_object
+
+from flask import json
+from mock import patch
+from nose.tools import *
+
+
+class Audit_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        clean_database()
+
+    def test_change_committed_with_request(self):
+        # Audit log writing failed requests does not take part
+        with patch.object(audit_log, 'write') as write:
+            r = self.app.post('/issues', data=dict(ref=1, status='READY', 
+                title='Title', link='/issue/1'))
+            eq_(r.status_code, 200)
+            eq_(write.call_count, 0)
+        eq_([(c.path, c.status) for c in Change.query.all()], [('/issues', 200)])
+
+    def test_failed_change_written_by_audit_log(self):
+        r = self.app.put('/issue/1', data=dict(title='Missing'))
+        eq_(r.status_code, 404)
+        eq_([(c.path, c.status) for c in Change.query.all()], [('/issue/1', 404)])
+        eq_(to_object(self.app.get('/changes')).data, [])
+
+    def test_batch_changes_committed_with_subrequests(self):
+        requests = [dict(method='POST', path='/issues', params=dict(ref=i, status='READY',
+            title='Title', link='/issue/%d' % i)) for i in (1, 1)]
+        r = self.app.post('/batch', data=json.dumps(
+            dict(requests=requests)), content_type='application/json')
+        eq_(r.status_code, 200)
+        eq_(Issue.query.count(), 1)
+        eq_(sorted(c.status for c in Change.query.all()), [200, 409])
@@ -0,0 +1,63 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database, create_project
+from bountyfunding.core.models import db
+from bountyfunding.api.badge import Badge, badge_cache
+
+from nose.tools import *
+
+
+class Badge_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        self.app.get('/version')
+        clean_database()
+        badge_cache.clear()
+        project, token = create_project('badge', 'Badge test project')
+        db.session.commit()
+        self.token = token.token
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1', token=self.token))
+
+    def test_badge(self):
+        r = self.app.get('/projects/badge/issues/1.svg')
+        eq_(r.status_code, 200)
+        eq_(r.mimetype, 'image/svg+xml')
+        ok_('stale-while-revalidate' in r.headers['Cache-Control'])
+        etag = r.headers['ETag']
+        ok_(etag)
+
+        r = self.app.get('/projects/badge/issues/1.svg', headers={'If-None-Match': etag})
+        eq_(r.status_code, 304)
+
+    def test_badge_invalidated_by_sponsorship(self):
+        r = self.app.get('/projects/badge/issues/1.svg')
+        etag = r.headers['ETag']
+        
+        self.app.post('/issue/1/sponsorships', 
+            data=dict(user='jane', amount=15, token=self.token))
+
+        r = self.app.get('/projects/badge/issues/1.svg', headers={'If-None-Match': etag})
+        eq_(r.status_code, 200)
+        ok_('15' in r.data)
+        ok_(r.headers['ETag'] != etag)
+
+    def test_missing_badge(self):
+        eq_(self.app.get('/projects/badge/issues/2.svg').status_code, 404)
+        eq_(self.app.get('/projects/none/issues/1.svg').status_code, 404)
+
+    def test_stale_badge_not_cached(self):
+        # Rendering started before the sponsorship was committed
+        version = badge_cache.current_version()
+        self.app.post('/issue/1/sponsorships', 
+            data=dict(user='jane', amount=15, token=self.token))
+        badge_cache.put('badge', '1', Badge(1, 0, 'stale'), version)
+        eq_(badge_cache.get('badge', '1'), None)
+
+    def test_badge_invalidated_by_rename(self):
+        eq_(self.app.get('/projects/badge/issues/1.svg').status_code, 200)
+        r = self.app.put('/project', data=dict(name='renamed', token=self.token))
+        eq_(r.status_code, 200)
+        eq_(badge_cache.get('badge', '1'), None)
+        eq_(self.app.get('/projects/badge/issues/1.svg').status_code, 404)
+        eq_(self.app.get('/projects/renamed/issues/1.svg').status_code, 200)
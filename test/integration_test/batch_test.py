@@ -0,0 +1,78 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database
+from bountyfunding.core.models import Issue, Change
+
+from flask import json
+from nose.tools import *
+
+
+class Batch_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        clean_database()
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+
+    def test_batch(self):
+        r = self.batch([
+            dict(method='POST', path='/issue/1/sponsorships', params=dict(user='jane', amount=10)),
+            dict(method='GET', path='/issue/1'),
+            dict(method='GET', path='/issue/1/sponsorships'),
+            dict(method='GET', path='/issue/2'),
+            dict(method='GET', path='/config/payment_gateways'),
+        ])
+        eq_(r['committed'], True)
+        eq_([d['status'] for d in r['data']], [200, 200, 200, 404, 200])
+        eq_(r['data'][1]['body']['title'], 'Title')
+        eq_(r['data'][2]['body']['jane']['amount'], 10)
+
+        # Sponsorship is logged as a separate change
+        eq_(Change.query.filter_by(path='/issue/1/sponsorships').count(), 1)
+        eq_(Change.query.filter_by(path='/batch').count(), 0)
+
+    def test_atomic_batch_rolled_back(self):
+        r = self.batch([
+            dict(method='POST', path='/issues', params=dict(ref=2, status='READY', 
+                title='Title', link='/issue/2')),
+            dict(method='POST', path='/issue/3/sponsorships', params=dict(user='jane', amount=10)),
+            dict(method='GET', path='/issue/1'),
+        ], atomic=True)
+        eq_(r['committed'], False)
+        eq_([d['status'] for d in r['data']], [200, 404])
+        eq_(Issue.query.filter_by(issue_ref='2').count(), 0)
+
+    def test_non_atomic_batch(self):
+        r = self.batch([
+            dict(method='POST', path='/issues', params=dict(ref=2, status='READY', 
+                title='Title', link='/issue/2')),
+            dict(method='POST', path='/issue/3/sponsorships', params=dict(user='jane', amount=10)),
+            dict(method='POST', path='/issue/2/sponsorships', params=dict(user='jane', amount=10)),
+        ])
+        eq_(r['committed'], True)
+        eq_([d['status'] for d in r['data']], [200, 404, 200])
+        eq_(Issue.query.filter_by(issue_ref='2').count(), 1)
+
+    def test_invalid_batch(self):
+        r = self.app.post('/batch', data='[]', content_type='application/json')
+        eq_(r.status_code, 400)
+        
+        r = self.batch([dict(method='GET', path='/nothing')])
+        eq_(r['data'][0]['status'], 404)
+        
+        r = self.batch([dict(method='POST', path='/batch')])
+        eq_(r['data'][0]['status'], 400)
+
+    def test_waiting_for_changes_rejected(self):
+        r = self.batch([
+            dict(method='GET', path='/events'),
+            dict(method='GET', path='/changes', params=dict(wait=5)),
+            dict(method='GET', path='/changes', params=dict(wait=0)),
+        ])
+        eq_([d['status'] for d in r['data']], [400, 400, 200])
+
+    def batch(self, requests, atomic=False):
+        r = self.app.post('/batch', data=json.dumps(dict(requests=requests, atomic=atomic)), 
+                content_type='application/json')
+        eq_(r.status_code, 200)
+        return json.loads(r.data)
@@ -0,0 +1,57 @@
+import bountyfunding
+from bountyfunding import is_repeatable
+from bountyfunding.core import sqlite_profile
+from bountyfunding.core.data import clean_database
+from bountyfunding.core.models import Issue
+
+from test import to_object
+
+from flask import json
+from nose.tools import *
+from mock import patch
+from sqlalchemy.exc import OperationalError
+import sys, sqlite3
+
+
+views = sys.modules['bountyfunding.api.views']
+
+
+class BusyRetry_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        clean_database()
+        self.backoff = sqlite_profile.BACKOFF_INITIAL
+        sqlite_profile.BACKOFF_INITIAL = 0
+
+    def teardown(self):
+        sqlite_profile.BACKOFF_INITIAL = self.backoff
+
+    def test_bulk_import_repeated_with_its_body(self):
+        import_issues = views.import_issues
+        attempts = []
+        def import_busy_once(project_id, issues):
+            attempts.append(len(issues))
+            if len(attempts) == 1:
+                raise OperationalError('INSERT INTO issue', {},
+                        sqlite3.OperationalError('database is locked'))
+            return import_issues(project_id, issues)
+
+        data = ''.join(json.dumps(dict(ref=ref, status='READY', title='Title',
+            link='/issue/%d' % ref)) + '\n' for ref in (1, 2))
+        with patch.object(views, 'import_issues', import_busy_once):
+            r = self.app.post('/issues/bulk', data=data, content_type='application/x-ndjson')
+        eq_(r.status_code, 200)
+        eq_([2, 2], attempts)
+        eq_(2, to_object(r).created)
+        eq_(2, Issue.query.count())
+
+    def test_requests_with_outside_effects_not_repeated(self):
+        for method, path, repeatable in [
+                ('POST', '/issues', True),
+                ('POST', '/batch', False),
+                ('POST', '/issue/1/sponsorship/jane/payments', False),
+                ('PUT', '/issue/1/sponsorship/jane/payment', False),
+                ('POST', '/login', False)]:
+            with bountyfunding.app.test_request_context(path, method=method):
+                eq_(repeatable, is_repeatable(), path)
@@ -0,0 +1,49 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database
+
+from test import to_object
+
+from flask import json
+from nose.tools import *
+
+
+class Changes_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        clean_database()
+        for i in xrange(3):
+            self.app.post('/issues', data=dict(ref=i, status='READY', 
+                title='Title', link='/issue/%d' % i))
+
+    def test_changes(self):
+        r = to_object(self.app.get('/changes', query_string=dict(limit=2)))
+        eq_([c.path for c in r.data], ['/issues', '/issues'])
+        eq_(r.data[0].type, 'issue')
+
+        r = to_object(self.app.get('/changes', query_string=dict(since=r.next)))
+        eq_(len(r.data), 1)
+
+        r = to_object(self.app.get('/changes', query_string=dict(since=r.next)))
+        eq_(r.data, [])
+        next = r.next
+
+        self.app.put('/issue/1', data=dict(title='Changed'))
+        r = to_object(self.app.get('/changes', query_string=dict(since=next)))
+        eq_([c.path for c in r.data], ['/issue/1'])
+
+    def test_wait_times_out(self):
+        r = to_object(self.app.get('/changes', query_string=dict(limit=10)))
+        r = self.app.get('/changes', query_string=dict(since=r.next, wait=0.05))
+        eq_(to_object(r).data, [])
+
+    def test_changes_scoped_to_project(self):
+        r = to_object(self.app.get('/changes', query_string=dict(token='test2')))
+        eq_(r.data, [])
+
+    def test_ndjson(self):
+        r = self.app.get('/changes', query_string=dict(format='ndjson'))
+        eq_(r.mimetype, 'application/x-ndjson')
+        changes = [json.loads(line) for line in r.data.splitlines()]
+        eq_(len(changes), 3)
+        ok_(changes[0]['id'] < changes[1]['id'] < changes[2]['id'])
@@ -0,0 +1,76 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database
+from bountyfunding.core.models import db, Change, Webhook
+from bountyfunding.core.compact import archive_changes, truncate_responses, optimize
+from bountyfunding.core.changes import retrieve_changes
+
+from test import to_object
+
+from nose.tools import *
+from datetime import datetime, timedelta
+import tempfile, shutil, gzip, json, os
+
+
+class Compact_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        clean_database()
+        self.archive_dir = tempfile.mkdtemp()
+        for i in xrange(5):
+            self.app.post('/issues', data=dict(ref=i, status='READY', 
+                title='Title', link='/issue/%d' % i))
+
+    def teardown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def test_archive(self):
+        # Make first three changes old
+        old_ids = [c.change_id for c in Change.query.order_by(Change.change_id).limit(3)]
+        Change.query.filter(Change.change_id.in_(old_ids)) \
+                .update(dict(timestamp=datetime(2000, 1, 1)), synchronize_session=False)
+        db.session.commit()
+
+        path, archived = archive_changes(datetime(2001, 1, 1), self.archive_dir, batch_size=2)
+        eq_(archived, 3)
+        eq_(Change.query.count(), 2)
+        archive = [json.loads(line) for line in gzip.open(path)]
+        eq_([c['change_id'] for c in archive], old_ids)
+        eq_(archive[0]['path'], '/issues')
+
+    def test_archive_everything(self):
+        r = self.app.post('/webhooks', data=dict(url='http://93.184.216.34/hook'))
+        eq_(r.status_code, 200)
+        last_id = db.session.query(db.func.max(Change.change_id)).scalar()
+        # Webhook has delivered all changes
+        webhook = Webhook.query.one()
+        webhook.last_change_id = last_id
+        project_id = webhook.project_id
+        db.session.commit()
+
+        path, archived = archive_changes(datetime.now() + timedelta(days=1), self.archive_dir)
+        eq_(archived, 5)
+        # Newest change keeps its id from being reused
+        eq_([last_id], [c.change_id for c in Change.query])
+
+        self.app.post('/issues', data=dict(ref=5, status='READY', 
+            title='Title', link='/issue/5'))
+        r = self.app.get('/changes', query_string=dict(since=last_id))
+        eq_(['/issues'], [c.path for c in to_object(r).data])
+        eq_(1, len(retrieve_changes(project_id, last_id, 10)))
+
+    def test_nothing_to_archive(self):
+        path, archived = archive_changes(datetime(2001, 1, 1), self.archive_dir)
+        eq_((path, archived), (None, 0))
+        eq_(os.listdir(self.archive_dir), [])
+
+    def test_truncate_responses(self):
+        truncated = truncate_responses(5, batch_size=2)
+        eq_(truncated, 5)
+        ok_(all(len(c.response) == 5 for c in Change.query))
+        eq_(truncate_responses(5), 0)
+
+    def test_optimize(self):
+        optimize()
+        optimize(vacuum=True)
+        eq_(Change.query.count(), 5)
@@ -1,10 +1,12 @@
 import bountyfunding
 from bountyfunding.core.const import *
 from bountyfunding.core.data import clean_database
+from bountyfunding.core.models import db, Email, Config
 
 from test import to_object
 
 from nose.tools import *
+from datetime import datetime
 
 
 USER = "bountyfunding"
@@ -43,6 +45,137 @@ class Email_Test:
         r = self.app.delete("/email/%s" % email.id)
         eq_(r.status_code, 200)
 
+    def test_claim_and_ack(self):
+        self.create_emails(3)
+
+        r = self.app.post('/emails/claim', data=dict(limit=2, duration=60))
+        eq_(r.status_code, 200)
+        first = to_object(r)
+        eq_(len(first.data), 2)
+
+        # Claimed emails are not returned to other consumers
+        eq_(len(self.get_emails()), 1)
+        second = to_object(self.app.post('/emails/claim'))
+        eq_(len(second.data), 1)
+        ok_(first.lease != second.lease)
+        eq_(len(to_object(self.app.post('/emails/claim')).data), 0)
+
+        r = self.app.delete('/emails', data=dict(lease=first.lease))
+        eq_(to_object(r).deleted, 2)
+        eq_(Email.query.count(), 1)
+
+        r = self.app.delete('/emails', data=dict(ids=str(second.data[0].id)))
+        eq_(to_object(r).deleted, 1)
+        eq_(Email.query.count(), 0)
+
+    def test_expired_lease(self):
+        self.create_emails(1)
+        lease = to_object(self.app.post('/emails/claim')).lease
+        Email.query.update(dict(lease_expires=datetime(2000, 1, 1)))
+        db.session.commit()
+        eq_(len(self.get_emails()), 1)
+
+        # Late acknowledgement of an expired lease still removes the email
+        self.app.delete('/emails', data=dict(lease=lease))
+        eq_(Email.query.count(), 0)
+
+    def test_emails_paginated(self):
+        self.create_emails(3)
+        r = self.app.get('/emails', data=dict(limit=2))
+        eq_(r.headers['X-Total-Count'], '3')
+        page = to_object(r)
+        eq_(len(page.data), 2)
+        page = to_object(self.app.get('/emails', data=dict(limit=2, after=page.next)))
+        eq_(len(page.data), 1)
+        eq_(page.next, None)
+
+    def test_emails_scoped_to_project(self):
+        self.create_emails(1)
+        other = 'test2'
+        r = self.app.get('/emails', data=dict(token=other))
+        eq_(to_object(r).data, [])
+
+        email_id = self.get_emails()[0].id
+        r = self.app.delete('/email/%s' % email_id, data=dict(token=other))
+        eq_(r.status_code, 404)
+        r = self.app.delete('/emails', data=dict(ids=str(email_id), token=other))
+        eq_(to_object(r).deleted, 0)
+        eq_(Email.query.count(), 1)
+
+    def test_all_sponsors_notified(self):
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+        for i in xrange(3):
+            self.app.post('/issue/1/sponsorships', data=dict(user='user%d' % i, amount=10))
+        self.app.put('/issue/1', data=dict(status='STARTED'))
+
+        emails = self.get_emails()
+        eq_(sorted(e.recipient for e in emails), ['user0', 'user1', 'user2'])
+        ok_(all(e.issue_id == '1' for e in emails))
+
+    def test_repeated_status_change_deduplicated(self):
+        self.create_emails(1)
+        self.app.put('/issue/0', data=dict(status='READY'))
+        self.app.put('/issue/0', data=dict(status='STARTED'))
+        eq_(Email.query.count(), 1)
+
+        # Once sent, the same notification may be queued again
+        self.app.delete('/emails', data=dict(ids=str(self.get_emails()[0].id)))
+        self.app.put('/issue/0', data=dict(status='READY'))
+        self.app.put('/issue/0', data=dict(status='STARTED'))
+        eq_(Email.query.count(), 1)
+
+    def test_admin_email_rendered(self):
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+        self.app.post('/issue/1/sponsorships', data=dict(user='jane', amount=10))
+        self.app.post('/issue/1/sponsorship/jane/payments', data=dict(gateway='DUMMY'))
+        self.app.put('/issue/1/sponsorship/jane/payment', data=dict(status='CONFIRMED', 
+            card_number='4111111111111111', card_date='05/50'))
+        r = self.app.put('/issue/1/sponsorship/jane', data=dict(status='VALIDATED'))
+        eq_(r.status_code, 200)
+
+        emails = self.get_emails()
+        eq_(len(emails), 1)
+        ok_(emails[0].body.startswith('User jane has validated'))
+        email = Email.query.one()
+        eq_(email.template, EmailTemplate.SPONSORSHIP_VALIDATED)
+        eq_(email.body, None)
+
+    def test_superseded_notification_dropped(self):
+        self.create_emails(1)
+        self.app.put('/issue/0', data=dict(status='COMPLETED'))
+        eq_(Email.query.one().template, EmailTemplate.ISSUE_COMPLETED_PLEDGED)
+
+    def test_digest(self):
+        db.session.add(Config(1, 'EMAIL_DIGEST_WINDOW', '60'))
+        db.session.commit()
+        self.create_emails(3)
+
+        # Held until the window of the first email elapses
+        eq_(to_object(self.app.post('/emails/claim')).data, [])
+        Email.query.update(dict(created=datetime(2000, 1, 1)))
+        db.session.commit()
+
+        claim = to_object(self.app.post('/emails/claim'))
+        eq_(len(claim.data), 1)
+        digest = claim.data[0]
+        eq_(digest.recipient, USER)
+        eq_(digest.issues, ['0', '1', '2'])
+        eq_(len(digest.ids), 3)
+        ok_(digest.body.startswith('Issue 0: '))
+
+        self.app.delete('/emails', data=dict(lease=claim.lease))
+        eq_(Email.query.count(), 0)
+
+    def create_emails(self, count):
+        for i in xrange(count):
+            self.app.post('/issues', data=dict(ref=i, status='READY', 
+                title='Title', link='/issue/%d' % i))
+            self.app.post('/issue/%d/sponsorships' % i, data=dict(user=USER, amount=10))
+            self.app.put('/issue/%d' % i, data=dict(status='STARTED'))
+        eq_(Email.query.count(), count)
+
     def get_emails(self):
         r = self.app.get("/emails")
         eq_(r.status_code, 200)
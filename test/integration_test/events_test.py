@@ -0,0 +1,61 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database
+from bountyfunding.api import events
+
+from nose.tools import *
+import json
+
+
+class Events_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        clean_database()
+        self.stream_duration = events.STREAM_DURATION
+        events.STREAM_DURATION = 0.1
+
+    def teardown(self):
+        events.STREAM_DURATION = self.stream_duration
+
+    def test_events_resumed(self):
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+        self.app.post('/issue/1/sponsorships', data=dict(user='jane', amount=10))
+        # Failed requests are not events
+        self.app.post('/issue/1/sponsorships', data=dict(user='jane', amount=10))
+
+        r = self.app.get('/events', headers={'Last-Event-ID': '0'})
+        eq_(r.status_code, 200)
+        eq_(r.mimetype, 'text/event-stream')
+        received = self.parse(r.data)
+        eq_([e['event'] for e in received], ['issue', 'sponsorship'])
+        eq_(json.loads(received[1]['data'])['path'], '/issue/1/sponsorships')
+
+        self.app.put('/issue/1/sponsorship/jane', data=dict(amount=20))
+        r = self.app.get('/events', headers={'Last-Event-ID': received[-1]['id']})
+        eq_([e['event'] for e in self.parse(r.data)], ['sponsorship'])
+
+    def test_only_future_events_without_last_id(self):
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+        r = self.app.get('/events')
+        eq_(self.parse(r.data), [])
+
+    def test_events_scoped_to_project(self):
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+        r = self.app.get('/events', headers={'Last-Event-ID': '0'}, 
+                query_string=dict(token='test2'))
+        eq_(self.parse(r.data), [])
+
+    def test_invalid_last_id(self):
+        r = self.app.get('/events', headers={'Last-Event-ID': 'abc'})
+        eq_(r.status_code, 400)
+
+    def parse(self, data):
+        received = []
+        for block in data.split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.split('\n') if ': ' in line)
+            if 'event' in fields:
+                received.append(fields)
+        return received
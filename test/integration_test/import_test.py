@@ -0,0 +1,76 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database
+from bountyfunding.core.models import Issue, User, Email
+
+from test import to_object
+
+from flask import json
+from nose.tools import *
+
+
+class Import_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        clean_database()
+
+    def test_import(self):
+        issues = [dict(ref=i, status='READY', title='Title %d' % i, link='/issue/%d' % i, 
+            owner='dev%d' % (i % 3)) for i in xrange(250)]
+        r = self.post(json.dumps(issues))
+        eq_(r.created, 250)
+        eq_(Issue.query.count(), 250)
+        eq_(User.query.count(), 3)
+
+        issue = to_object(self.app.get('/issue/7'))
+        eq_(issue.title, 'Title 7')
+        eq_(issue.owner, 'dev1')
+
+    def test_upsert(self):
+        self.app.post('/issues', data=dict(ref=1, status='READY', title='Title', link='/issue/1'))
+        self.app.post('/issues', data=dict(ref=2, status='READY', title='Title', link='/issue/2'))
+        self.app.post('/issue/2/sponsorships', data=dict(user='jane', amount=10))
+
+        issues = [
+            dict(ref=1, status='READY', title='Title', link='/issue/1'),
+            dict(ref=2, status='STARTED', title='Title', link='/issue/2'),
+            dict(ref=3, status='READY', title='Title', link='/issue/3'),
+            dict(ref=3, status='READY', title='Title', link='/issue/3'),
+            dict(ref=4, status='READY', title='Title'),
+        ]
+        r = self.post(json.dumps(issues))
+        eq_([d.result for d in r.data], ['unchanged', 'updated', 'created', 'error', 'error'])
+        eq_((r.unchanged, r.updated, r.created, r.error), (1, 1, 1, 2))
+
+        eq_(to_object(self.app.get('/issue/2')).status, 'STARTED')
+        # Status change notifies sponsors
+        eq_(Email.query.count(), 1)
+
+    def test_import_ndjson(self):
+        lines = [json.dumps(dict(ref=i, status='READY', title='Title', link='/issue/%d' % i)) 
+                for i in xrange(3)]
+        r = self.post('\n'.join(lines) + '\n', 'application/x-ndjson')
+        eq_(r.created, 3)
+
+    def test_malformed_items(self):
+        issues = [5, dict(ref=1, status=1, title='Title', link='/issue/1'),
+            dict(ref=2, status='READY', title='Title', link=2),
+            dict(ref=3, status='READY', title='Title', link='/issue/3'),
+            dict(ref='3', status='READY', title='Title', link='/issue/3')]
+        r = self.post(json.dumps(issues))
+        eq_([d.result for d in r.data], ['error', 'error', 'error', 'created', 'error'])
+        eq_(r.data[4].error, 'Duplicate ref')
+        eq_(Issue.query.count(), 1)
+
+        r = self.post('5\n' + json.dumps(dict(ref=4, status='READY', title='Title', 
+            link='/issue/4')) + '\n', 'application/x-ndjson')
+        eq_((r.error, r.created), (1, 1))
+
+    def test_invalid_import(self):
+        r = self.app.post('/issues/bulk', data='{}', content_type='application/json')
+        eq_(r.status_code, 400)
+
+    def post(self, data, content_type='application/json'):
+        r = self.app.post('/issues/bulk', data=data, content_type=content_type)
+        eq_(r.status_code, 200)
+        return to_object(r)
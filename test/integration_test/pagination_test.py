@@ -0,0 +1,74 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database
+
+from test import to_object
+
+from nose.tools import *
+
+
+class Pagination_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        clean_database()
+        for ref in xrange(1, 6):
+            status = 'READY' if ref % 2 else 'STARTED'
+            self.app.post('/issues', data=dict(ref=ref, status=status, 
+                title='Title', link='/issue/%d' % ref, owner='dev%d' % (ref % 2)))
+            self.app.post('/issue/%d/sponsorships' % ref, data=dict(user='jane', amount=10 * (ref % 3 + 1)))
+
+    def test_unpaginated_issues(self):
+        r = self.app.get('/issues')
+        eq_(len(to_object(r).data), 5)
+
+    def test_issues_pages(self):
+        refs = []
+        after = None
+        while True:
+            params = dict(limit=2)
+            if after:
+                params['after'] = after
+            r = self.app.get('/issues', query_string=params)
+            eq_(r.status_code, 200)
+            eq_(r.headers['X-Total-Count'], '5')
+            page = to_object(r)
+            refs.extend(i.ref for i in page.data)
+            after = page.next
+            if after == None:
+                break
+        eq_(refs, ['1', '2', '3', '4', '5'])
+
+    def test_issues_filters(self):
+        r = self.app.get('/issues', query_string=dict(status='STARTED', limit=10))
+        eq_([i.ref for i in to_object(r).data], ['2', '4'])
+        eq_(r.headers['X-Total-Count'], '2')
+
+        r = self.app.get('/issues', query_string=dict(owner='dev1'))
+        eq_([i.ref for i in to_object(r).data], ['1', '3', '5'])
+        
+        r = self.app.get('/issues', query_string=dict(owner='nobody'))
+        eq_(to_object(r).data, [])
+
+    def test_sponsored_issues_pages(self):
+        # Amounts: 1 -> 20, 2 -> 30, 3 -> 10, 4 -> 20, 5 -> 30
+        refs = []
+        after = None
+        while True:
+            params = dict(limit=2)
+            if after:
+                params['after'] = after
+            r = self.app.get('/sponsored_issues', query_string=params)
+            eq_(r.headers['X-Total-Count'], '5')
+            page = to_object(r)
+            refs.extend(i.ref for i in page.data)
+            after = page.next
+            if after == None:
+                break
+        eq_(refs, ['2', '5', '1', '4', '3'])
+
+    def test_invalid_parameters(self):
+        eq_(self.app.get('/issues', query_string=dict(limit='x')).status_code, 400)
+        eq_(self.app.get('/issues', query_string=dict(limit=0)).status_code, 400)
+        eq_(self.app.get('/issues', query_string=dict(limit=1, after='x')).status_code, 400)
+        eq_(self.app.get('/sponsored_issues', query_string=dict(limit=1, after='1')).status_code, 400)
+        eq_(self.app.get('/issues', query_string=dict(status='UNKNOWN')).status_code, 400)
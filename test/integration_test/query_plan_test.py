@@ -0,0 +1,155 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database, create_project, retrieve_create_users
+from bountyfunding.core.models import db, Payment
+from bountyfunding.api.badge import badge_cache
+from bountyfunding.api import events
+
+from test import to_object
+
+from flask import json
+from nose.tools import *
+import re
+
+
+# Plan steps reading whole table, SQLite 3.36 changed "SCAN TABLE x" to "SCAN x".
+# Constant rows and results of subqueries are not tables
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?(?!CONSTANT ROW|anon_\d+|SUBQUERY)(?P<table>\w+)'
+        r'(?! USING (COVERING )?INDEX)( |$)')
+
+# Statements which are expected to read whole table, with reason
+ALLOWED_SCANS = [
+]
+
+IGNORED = re.compile(r'^\s*(PRAGMA|SAVEPOINT|RELEASE|ROLLBACK|BEGIN|COMMIT)', re.I)
+
+
+class ProjectClient:
+    """Test client sending token of the project with each request"""
+
+    def __init__(self, client, token):
+        self.client = client
+        self.token = token
+
+    def open(self, method, path, **kwargs):
+        query_string = dict(kwargs.pop('query_string', {}), token=self.token)
+        return self.client.open(path, method=method, query_string=query_string, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.open('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.open('PUT', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open('DELETE', path, **kwargs)
+
+
+class QueryPlan_Test:
+    """Runs EXPLAIN QUERY PLAN for each statement issued while serving API
+    requests on a seeded database and fails on full table scans"""
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        self.app.get('/version')
+        clean_database()
+        badge_cache.clear()
+        self.seed()
+        self.statements = []
+        db.event.listen(db.engine, 'before_cursor_execute', self.record)
+
+    def teardown(self):
+        db.event.remove(db.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0]
+        self.statements.append((statement, parameters))
+
+    def seed(self):
+        project, token = create_project('plan', 'Query plan project')
+        db.session.commit()
+        self.project_id = project.project_id
+        self.project = ProjectClient(self.app, token.token)
+        issues = [dict(ref=i, status='READY', title='Title %d' % i, link='/issue/%d' % i,
+            owner='dev%d' % (i % 5)) for i in xrange(200)]
+        r = self.project.post('/issues/bulk', data=json.dumps(issues), 
+                content_type='application/json')
+        eq_(to_object(r).created, 200)
+        for i in xrange(50):
+            self.project.post('/issue/%d/sponsorships' % i, data=dict(user='user%d' % i, amount=10))
+        db.session.commit()
+
+        # Statistics left by ANALYZE of other tests describe empty tables and 
+        # steer the planner, plans are checked without them
+        if db.engine.has_table('sqlite_stat1'):
+            db.engine.execute('DELETE FROM sqlite_stat1')
+            db.engine.execute('ANALYZE sqlite_master')
+
+    def test_query_plans(self):
+        events.STREAM_DURATION, duration = 0, events.STREAM_DURATION
+        try:
+            self.exercise()
+        finally:
+            events.STREAM_DURATION = duration
+
+        scans = []
+        cursor = db.engine.raw_connection().cursor()
+        for statement, parameters in self.statements:
+            if IGNORED.match(statement) or any(p.match(statement) for p in ALLOWED_SCANS):
+                continue
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            for row in cursor.fetchall():
+                detail = row[-1]
+                if FULL_SCAN.match(detail):
+                    scans.append('%s\n    %s' % (' '.join(statement.split()), detail))
+        ok_(len(self.statements) > 100)
+        eq_(sorted(set(scans)), [])
+
+    def exercise(self):
+        app = self.project
+        app.get('/issues')
+        app.get('/issues', query_string=dict(limit=10, after=5, status='READY', owner='dev1'))
+        eq_(app.get('/issue/7').status_code, 200)
+        app.put('/issue/7', data=dict(title='Changed', owner='dev2'))
+        app.post('/issues', data=dict(ref=1000, status='READY', title='Title', 
+            link='/issue/1000', owner='dev3'))
+        app.get('/sponsored_issues', query_string=dict(limit=10))
+        app.get('/sponsored_issues', query_string=dict(limit=10, status='READY', owner='dev1'))
+
+        app.get('/issue/1/sponsorships')
+        eq_(app.get('/issue/1/sponsorship/user1').status_code, 200)
+        app.put('/issue/1/sponsorship/user1', data=dict(amount=20))
+        app.post('/issue/2/sponsorship/user2/payments', data=dict(gateway='DUMMY'))
+        app.get('/issue/2/sponsorship/user2/payment')
+        app.put('/issue/2/sponsorship/user2/payment', data=dict(status='CONFIRMED', 
+            card_number='4111111111111111', card_date='05/50'))
+        app.put('/issue/2/sponsorship/user2', data=dict(status='VALIDATED'))
+        app.put('/issue/3', data=dict(status='STARTED'))
+        app.put('/issue/3', data=dict(status='COMPLETED'))
+        app.delete('/issue/4/sponsorship/user4')
+
+        eq_(app.get('/user/user1').status_code, 200)
+        app.put('/user/user1', data=dict(paypal_email='user1@example.com'))
+
+        app.get('/emails', query_string=dict(limit=10))
+        lease = to_object(app.post('/emails/claim', data=dict(limit=10))).lease
+        app.delete('/emails', data=dict(lease=lease))
+        app.delete('/email/1')
+
+        eq_(self.app.get('/projects/plan/issues/1.svg').status_code, 200)
+        app.get('/project')
+        app.get('/changes', query_string=dict(since=10, limit=10))
+        app.get('/events', headers={'Last-Event-ID': '10'})
+        app.post('/webhooks', data=dict(url='http://93.184.216.34/hook'))
+        app.get('/webhooks')
+        app.get('/webhook/1/failures')
+        r = app.post('/batch', data=json.dumps(dict(requests=[dict(method='GET', path='/issue/8')])), 
+                content_type='application/json')
+        eq_(r.status_code, 200)
+
+        db.session.query(db.exists().where(Payment.gateway_id == 'tx')).scalar()
+        retrieve_create_users(self.project_id, ['dev1', 'new'])
+        db.session.commit()
@@ -0,0 +1,85 @@
+import bountyfunding
+from bountyfunding.core.config import config
+from bountyfunding.core.data import clean_database, retrieve_create_users, create_project
+from bountyfunding.core.models import db, Issue, Config
+from bountyfunding.api.badge import badge_cache
+from bountyfunding.core.replica import replica_router, REPLICA_BIND
+from bountyfunding.util.metrics import metrics
+
+from test import to_object
+
+from nose.tools import *
+
+
+class Replica_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        self.app.get('/version')
+        clean_database()
+
+        # Replica is another in-memory database of the test thread
+        config.DATABASE_REPLICA_URL = 'sqlite://'
+        bountyfunding.app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: config.DATABASE_REPLICA_URL}
+        self.replica = db.get_engine(bountyfunding.app, REPLICA_BIND)
+        db.metadata.create_all(self.replica)
+        replica_router.clear()
+
+    def teardown(self):
+        db.metadata.drop_all(self.replica)
+        config.DATABASE_REPLICA_URL = ''
+        bountyfunding.app.config['SQLALCHEMY_BINDS'] = None
+        replica_router.clear()
+
+    def test_reads_routed_to_replica(self):
+        r = self.app.post('/issues', data=dict(ref=1, status='READY', title='Primary', link='/issue/1'))
+        eq_(r.status_code, 200)
+
+        # Client reads its own write
+        r = self.app.get('/issue/1')
+        eq_(r.status_code, 200)
+        eq_(to_object(r).title, 'Primary')
+
+        # Other clients read replica, which has not caught up yet
+        replica_router.clear()
+        queries = metrics.get('database.replica.queries')
+        r = self.app.get('/issue/1')
+        eq_(r.status_code, 404)
+        ok_(metrics.get('database.replica.queries') > queries)
+
+        issue = db.engine.execute(Issue.__table__.select()).first()
+        self.replica.execute(Issue.__table__.insert().values(dict(issue, title='Replica')))
+        r = self.app.get('/issue/1')
+        eq_(r.status_code, 200)
+        eq_(to_object(r).title, 'Replica')
+
+    def test_session_stays_on_primary_after_write(self):
+        with bountyfunding.app.test_request_context('/issue/1', method='GET'):
+            ok_(replica_router.use_replica())
+            eq_(db.session.get_bind(Issue.__mapper__), self.replica)
+
+            retrieve_create_users(1, ['jane'])
+            eq_(db.session.get_bind(Issue.__mapper__), db.engine)
+            db.session.rollback()
+            db.session.remove()
+
+    def test_caches_filled_from_primary(self):
+        project, token = create_project('cached', 'Cached project')
+        db.session.add(Config(project.project_id, 'max_pledge_amount', '50'))
+        db.session.commit()
+        project_id, token = project.project_id, token.token
+        r = self.app.post('/issues', data=dict(ref=1, status='READY', title='Primary', 
+            link='/issue/1', token=token))
+        eq_(r.status_code, 200)
+        replica_router.clear()
+        badge_cache.clear()
+
+        # Replica has not seen the project yet, but token, badge and configuration
+        # caches are filled from the primary
+        r = self.app.get('/issue/1', query_string=dict(token=token))
+        eq_(r.status_code, 404)
+        eq_(self.app.get('/projects/cached/issues/1.svg').status_code, 200)
+        with bountyfunding.app.test_request_context('/issue/1', method='GET'):
+            ok_(replica_router.use_replica())
+            eq_(50, config[project_id].MAX_PLEDGE_AMOUNT)
+            db.session.remove()
@@ -0,0 +1,156 @@
+import bountyfunding
+from bountyfunding.core.config import config
+from bountyfunding.core.data import clean_database, create_project
+from bountyfunding.core.models import db, Project, Issue, Sponsorship, IssueTotal, Change, Webhook, \
+        Account, User
+from bountyfunding.core.shards import shard_map, shard_bind, move_project, route_hash, \
+        sharded_tables, MAIN
+from bountyfunding.core.totals import check_issue_totals
+
+from test import to_object
+
+from collections import OrderedDict
+from nose.tools import *
+
+
+class Shards_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        self.app.get('/version')
+
+        # Shard is another in-memory database of the test thread
+        config.DATABASE_SHARDS = OrderedDict(a='sqlite://')
+        bountyfunding.app.config['SQLALCHEMY_BINDS'] = {shard_bind('a'): 'sqlite://'}
+        self.shard = db.get_engine(bountyfunding.app, shard_bind('a'))
+        db.metadata.create_all(self.shard)
+        clean_database()
+
+        project, token = create_project('sharded', 'Sharded project')
+        db.session.commit()
+        self.project_id = project.project_id
+        self.token = token.token
+
+    def teardown(self):
+        self.shard.execute('PRAGMA foreign_keys = OFF')
+        db.metadata.drop_all(self.shard)
+        config.DATABASE_SHARDS = OrderedDict()
+        bountyfunding.app.config['SQLALCHEMY_BINDS'] = None
+        shard_map.clear()
+
+    def count(self, engine, model):
+        table = model.__table__
+        return engine.execute(table.count().where(table.c.project_id == self.project_id)).scalar()
+
+    def create_issue(self):
+        r = self.app.post('/issues', data=dict(ref=1, status='READY', title='Sharded',
+            link='/issue/1', token=self.token))
+        eq_(r.status_code, 200)
+        r = self.app.post('/issue/1/sponsorships', data=dict(user='jane', amount=10,
+            token=self.token))
+        eq_(r.status_code, 200)
+
+    def test_project_data_stored_in_shard(self):
+        eq_('a', shard_map.shard(self.project_id))
+        self.create_issue()
+
+        eq_(1, self.count(self.shard, Issue))
+        eq_(1, self.count(self.shard, Sponsorship))
+        eq_(1, self.count(self.shard, IssueTotal))
+        eq_(0, self.count(db.engine, Issue))
+        # Project stays in the main database
+        eq_(0, self.shard.execute(Project.__table__.count()).scalar())
+
+        r = self.app.get('/issue/1', query_string=dict(token=self.token))
+        eq_(to_object(r).title, 'Sharded')
+        eq_(self.app.get('/projects/sharded/issues/1.svg').status_code, 200)
+        # Other project does not see it
+        eq_(self.app.get('/issue/1', query_string=dict(token='test2')).status_code, 404)
+
+    def test_move_project(self):
+        self.create_issue()
+        r = self.app.post('/webhooks', data=dict(url='http://93.184.216.34/hook', token=self.token))
+        eq_(r.status_code, 200)
+        # Occupy ids in main database, so that moved rows get new ones
+        for ref in (1, 2):
+            self.app.post('/issues', data=dict(ref=ref, status='READY', title='Other',
+                link='/issue/%d' % ref, token='test2'))
+
+        moved = move_project(self.project_id, MAIN, wait=0)
+        ok_(moved > 0)
+        eq_(None, Project.query.get(self.project_id).shard)
+        eq_(0, self.count(self.shard, Issue))
+        eq_(0, self.count(self.shard, Change))
+        eq_(1, self.count(db.engine, Issue))
+        eq_([], check_issue_totals(self.project_id))
+
+        # References follow new ids
+        issue = Issue.query.filter_by(project_id=self.project_id).one()
+        sponsorship = Sponsorship.query.filter_by(project_id=self.project_id).one()
+        eq_(issue.issue_id, sponsorship.issue_id)
+        eq_(sponsorship.user_id, sponsorship.user.user_id)
+        eq_('jane', sponsorship.user.name)
+        eq_(10, IssueTotal.query.get(issue.issue_id).total)
+
+        r = self.app.get('/issue/1/sponsorships', query_string=dict(token=self.token))
+        eq_(r.status_code, 200)
+        r = self.app.get('/changes', query_string=dict(token=self.token))
+        change_ids = [c.id for c in to_object(r).data]
+        eq_(3, len(change_ids))
+        # Webhook created by the third change has not delivered it yet
+        webhook = Webhook.query.filter_by(project_id=self.project_id).one()
+        eq_(change_ids[1], webhook.last_change_id)
+
+    def test_users_cached_before_move_not_used(self):
+        self.create_issue()
+        move_project(self.project_id, MAIN, wait=0)
+        r = self.app.post('/issues', data=dict(ref=2, status='READY', title='Moved',
+            link='/issue/2', token=self.token))
+        eq_(r.status_code, 200)
+        r = self.app.post('/issue/2/sponsorships', data=dict(user='jane', amount=20,
+            token=self.token))
+        eq_(r.status_code, 200)
+        eq_(1, User.query.filter_by(project_id=self.project_id).count())
+        for sponsorship in Sponsorship.query.filter_by(project_id=self.project_id):
+            eq_('jane', sponsorship.user.name)
+
+    def test_writes_refused_while_moving(self):
+        self.create_issue()
+        Project.query.get(self.project_id).moving = True
+        db.session.commit()
+        shard_map.invalidate(self.project_id)
+
+        r = self.app.post('/issues', data=dict(ref=2, status='READY', title='Refused',
+            link='/issue/2', token=self.token))
+        eq_(r.status_code, 503)
+        r = self.app.get('/issue/1', query_string=dict(token=self.token))
+        eq_(r.status_code, 200)
+        eq_(1, self.count(self.shard, Issue))
+
+    def test_no_foreign_keys_to_main_database(self):
+        for table in sharded_tables():
+            for key in table.foreign_keys:
+                ok_(key.column.table.info.get('sharded'), '%s.%s' % (table.name, key.parent.name))
+
+    def test_account_users_in_shards(self):
+        # Shard enforcing foreign keys accepts users of accounts from main database
+        self.shard.execute('PRAGMA foreign_keys = ON')
+        account = Account('jane@example.com', 'Jane')
+        db.session.add(account)
+        db.session.commit()
+        with shard_map.project(self.project_id):
+            user = User(self.project_id, 'jane')
+            user.account_id = account.account_id
+            db.session.add(user)
+            db.session.commit()
+        eq_(1, self.count(self.shard, User))
+
+        eq_('jane', account.get_user(self.project_id).name)
+        eq_(None, account.get_user(-2))
+
+    @raises(ValueError)
+    def test_move_to_same_shard(self):
+        move_project(self.project_id, 'a', wait=0)
+
+    def test_hash_routing(self):
+        eq_('b', route_hash(3, ['a', 'b']))
@@ -0,0 +1,63 @@
+import bountyfunding
+from bountyfunding.core.const import *
+from bountyfunding.core.data import clean_database
+from bountyfunding.core.models import IssueTotal
+from bountyfunding.core.totals import rebuild_issue_totals, check_issue_totals
+
+from test import to_object
+
+from nose.tools import *
+
+
+class Totals_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        clean_database()
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+
+    def test_totals_follow_sponsorships(self):
+        self.app.post('/issue/1/sponsorships', data=dict(user='jane', amount=10))
+        self.app.post('/issue/1/sponsorships', data=dict(user='john', amount=20))
+        self.check_total(total=30, pledged=30)
+
+        self.app.put('/issue/1/sponsorship/john', data=dict(amount=5))
+        self.check_total(total=15, pledged=15)
+
+        self.app.post('/issue/1/sponsorship/jane/payments', 
+            data=dict(gateway='DUMMY'))
+        self.app.put('/issue/1/sponsorship/jane/payment', data=dict(status='CONFIRMED', 
+            card_number='4111111111111111', card_date='05/50'))
+        self.check_total(total=15, pledged=5, confirmed=10)
+
+        self.app.delete('/issue/1/sponsorship/john')
+        self.check_total(total=10, pledged=0, confirmed=10)
+
+        eq_(check_issue_totals(), [])
+
+    def test_sponsored_issues(self):
+        self.app.post('/issues', data=dict(ref=2, status='READY', 
+            title='Title', link='/issue/2'))
+        self.app.post('/issue/1/sponsorships', data=dict(user='jane', amount=10))
+        self.app.post('/issue/2/sponsorships', data=dict(user='jane', amount=20))
+
+        r = self.app.get('/sponsored_issues')
+        issues = to_object(r).data
+        eq_([i.ref for i in issues], ['2', '1'])
+        eq_([i.amount for i in issues], [20, 10])
+
+    def test_rebuild(self):
+        self.app.post('/issue/1/sponsorships', data=dict(user='jane', amount=10))
+        IssueTotal.query.delete()
+        bountyfunding.core.models.db.session.commit()
+        eq_(len(check_issue_totals()), 1)
+
+        rebuild_issue_totals()
+        eq_(check_issue_totals(), [])
+        self.check_total(total=10, pledged=10)
+
+    def check_total(self, **expected):
+        total = IssueTotal.query.one()
+        for name, value in expected.items():
+            eq_(getattr(total, name), value, name)
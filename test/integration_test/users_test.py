@@ -0,0 +1,48 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database, retrieve_create_users, _insert_users, \
+        user_cache, user_key
+from bountyfunding.core.models import db, User
+
+from nose.tools import *
+
+
+class Users_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        self.app.get('/version')
+        clean_database()
+
+    def test_retrieve_create_users(self):
+        user_ids = retrieve_create_users(1, ['jane', 'john'])
+        db.session.commit()
+        eq_(sorted(user_ids), ['jane', 'john'])
+
+        eq_(retrieve_create_users(1, ['john', 'mike'])['john'], user_ids['john'])
+        db.session.commit()
+        eq_(User.query.filter_by(project_id=1).count(), 3)
+
+        # Same name in another project is another user
+        other_ids = retrieve_create_users(2, ['jane'])
+        db.session.commit()
+        ok_(other_ids['jane'] != user_ids['jane'])
+
+    def test_cached_after_commit(self):
+        user_ids = retrieve_create_users(1, ['jane'])
+        eq_(user_cache.get(user_key(1, 'jane')), None)
+        db.session.rollback()
+        eq_(user_cache.get(user_key(1, 'jane')), None)
+
+        user_ids = retrieve_create_users(1, ['jane'])
+        db.session.commit()
+        eq_(user_cache.get(user_key(1, 'jane')), user_ids['jane'])
+
+    def test_concurrently_created_users_ignored(self):
+        user_ids = retrieve_create_users(1, ['jane'])
+        db.session.commit()
+
+        # As if another transaction created the user after our select
+        _insert_users(1, ['jane', 'john'])
+        db.session.commit()
+        eq_(User.query.filter_by(project_id=1, name='jane').one().user_id, user_ids['jane'])
+        eq_(User.query.filter_by(project_id=1).count(), 2)
@@ -0,0 +1,143 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database
+from bountyfunding.core.config import config
+from bountyfunding.core.models import db, Webhook, Change
+from bountyfunding.core.webhooks import webhook_dispatcher, sign, MAX_ATTEMPTS
+from bountyfunding.core import webhooks
+
+from test import to_object
+
+from flask import json
+from nose.tools import *
+from mock import patch
+import threading, BaseHTTPServer
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((dict(self.headers), body))
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class Webhooks_Test:
+
+    def setup(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.received = []
+        self.server.status = 200
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.app = bountyfunding.app.test_client()
+        clean_database()
+        webhook_dispatcher.retries.clear()
+        # Stub server listens on loopback
+        config.WEBHOOK_ALLOW_PRIVATE = True
+        r = self.app.post('/webhooks', data=dict(secret='secret',
+            url='http://127.0.0.1:%d/hook' % self.server.server_port))
+        eq_(r.status_code, 200)
+        self.webhook_id = to_object(r).id
+
+    def teardown(self):
+        config.WEBHOOK_ALLOW_PRIVATE = False
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_delivery(self):
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+        self.app.post('/issue/1/sponsorships', data=dict(user='jane', amount=10))
+        self.app.put('/user/jane', data=dict(paypal_email='jane@example.com'))
+
+        ok_(webhook_dispatcher.deliver(self.webhook_id))
+        eq_(len(self.server.received), 1)
+        headers, body = self.server.received[0]
+        eq_(headers['x-bountyfunding-signature'], sign('secret', body))
+        # User changes are not subscribed by default
+        eq_([e['type'] for e in json.loads(body)['events']], ['issue', 'sponsorship'])
+
+        # Nothing new to deliver
+        ok_(webhook_dispatcher.deliver(self.webhook_id))
+        eq_(len(self.server.received), 1)
+
+    def test_retry_and_dead_letter(self):
+        self.server.status = 500
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+
+        ok_(not webhook_dispatcher.deliver(self.webhook_id))
+        ok_(self.webhook_id in webhook_dispatcher.retries)
+        eq_(Webhook.query.get(self.webhook_id).failures, 1)
+
+        db.engine.execute(Webhook.__table__.update().values(failures=MAX_ATTEMPTS - 1))
+        ok_(webhook_dispatcher.deliver(self.webhook_id))
+        failures = to_object(self.app.get('/webhook/%d/failures' % self.webhook_id)).data
+        eq_(len(failures), 1)
+        eq_(failures[0].error, 'HTTP status 500')
+        eq_(failures[0].payload.events[0].path, '/issues')
+
+        # Following changes are delivered again
+        self.server.status = 200
+        self.app.put('/issue/1', data=dict(title='Changed'))
+        ok_(webhook_dispatcher.deliver(self.webhook_id))
+        eq_(json.loads(self.server.received[-1][1])['events'][0]['path'], '/issue/1')
+
+    def test_webhooks_api(self):
+        r = self.app.post('/webhooks', data=dict(url='ftp://example.com'))
+        eq_(r.status_code, 400)
+        r = self.app.post('/webhooks', data=dict(url='http://example.com', events='issue,foo'))
+        eq_(r.status_code, 400)
+
+        r = self.app.post('/webhooks', data=dict(url='http://example.com', events='issue, user'))
+        eq_(to_object(r).events, 'issue,user')
+        eq_(len(to_object(self.app.get('/webhooks')).data), 2)
+        eq_(to_object(self.app.get('/webhooks', query_string=dict(token='test2'))).data, [])
+
+        r = self.app.delete('/webhook/%d' % self.webhook_id, data=dict(token='test2'))
+        eq_(r.status_code, 404)
+        r = self.app.delete('/webhook/%d' % self.webhook_id)
+        eq_(r.status_code, 200)
+        eq_(len(to_object(self.app.get('/webhooks')).data), 1)
+
+    def test_private_addresses_rejected(self):
+        config.WEBHOOK_ALLOW_PRIVATE = False
+        for url in ['http://127.0.0.1/hook', 'http://10.1.2.3/hook', 'http://192.168.0.1/',
+                'http://169.254.169.254/latest', 'http://[::1]/hook', 'http://[fe80::1]/',
+                'http://[::ffff:127.0.0.1]/', 'http://0.0.0.0/', 'http://198.18.0.1/',
+                'http://192.0.0.8/', 'http://255.255.255.255/', 'http://[64:ff9b::a00:1]/',
+                'http://[2002:7f00:1::]/', 'http://[fd00::1]/']:
+            r = self.app.post('/webhooks', data=dict(url=url))
+            eq_(r.status_code, 400, url)
+
+        # Existing webhook to loopback is not delivered either
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+        ok_(not webhook_dispatcher.deliver(self.webhook_id))
+        eq_(self.server.received, [])
+
+    def test_public_addresses_accepted(self):
+        config.WEBHOOK_ALLOW_PRIVATE = False
+        for url in ['http://93.184.216.34/hook', 'http://[2606:2800:220:1::]/hook']:
+            r = self.app.post('/webhooks', data=dict(url=url))
+            eq_(r.status_code, 200, url)
+
+    def test_host_resolved_to_private_address_later(self):
+        # Host passes the check, but resolves to loopback when connecting
+        config.WEBHOOK_ALLOW_PRIVATE = False
+        self.app.post('/issues', data=dict(ref=1, status='READY', 
+            title='Title', link='/issue/1'))
+        with patch.object(webhooks, 'check_webhook_url', return_value=None):
+            ok_(not webhook_dispatcher.deliver(self.webhook_id))
+        eq_(self.server.received, [])
+
+    def test_secret_not_logged(self):
+        arguments = [c.arguments for c in Change.query.all()]
+        eq_(len(arguments), 1)
+        ok_('secret:***' in arguments[0])
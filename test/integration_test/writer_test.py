@@ -0,0 +1,39 @@
+import bountyfunding
+from bountyfunding.core.data import clean_database
+from bountyfunding.core.errors import Error
+from bountyfunding.core.models import db, after_commit
+from bountyfunding.core.writer import Writer, Task
+
+from nose.tools import *
+
+
+class Writer_Test:
+
+    def setup(self):
+        self.app = bountyfunding.app.test_client()
+        self.app.get('/version')
+        clean_database()
+        self.committed = []
+
+    def succeed(self, name):
+        def function():
+            after_commit(lambda: self.committed.append(name))
+            # As unit of work of a request does
+            db.session.commit()
+            eq_([], self.committed)
+            return name
+        return function
+
+    def fail(self):
+        after_commit(lambda: self.committed.append('failed'))
+        raise Error('Failed')
+
+    def test_group_committed_together(self):
+        tasks = [Task(self.succeed('first')), Task(self.fail), Task(self.succeed('second'))]
+        Writer()._execute(tasks)
+
+        # Callbacks of failed request are discarded with its savepoint only
+        eq_(['first', 'second'], self.committed)
+        eq_(['first', None, 'second'], [t.result for t in tasks])
+        eq_(Error, tasks[1].error[0])
+        ok_(all(t.done.is_set() for t in tasks))
@@ -0,0 +1,38 @@
+from bountyfunding.core.audit import AuditLog, change_record
+from nose.tools import *
+from mock import MagicMock, patch
+
+
+def test_synchronous_write():
+    log = AuditLog()
+    log._insert = MagicMock()
+    record = change_record(1, 'PUT', '/issue/1', 'status:READY')
+    log.write(record)
+    log._insert.assert_called_once_with([record])
+
+def test_batches_written_on_stop():
+    log = AuditLog(batch_size=10, flush_interval=60)
+    log._insert = MagicMock()
+    log.start()
+    for i in xrange(25):
+        log.write(change_record(1, 'PUT', '/issue/%d' % i, ''))
+    log.stop()
+    
+    batches = [args[0] for args, kwargs in log._insert.call_args_list]
+    eq_(25, sum(len(b) for b in batches))
+    ok_(all(len(b) <= 10 for b in batches))
+    eq_('/issue/24', batches[-1][-1]['path'])
+
+def test_only_records_of_failing_shard_dropped():
+    good, bad = MagicMock(), MagicMock()
+    bad.execute.side_effect = Exception('Database is locked')
+    records = [change_record(1, 'PUT', '/issue/1', ''), change_record(2, 'PUT', '/issue/2', '')]
+    with patch('bountyfunding.core.audit.shard_map') as shard_map, \
+            patch('bountyfunding.core.audit.metrics') as metrics, \
+            patch('bountyfunding.core.audit.notify_changes') as notify_changes:
+        shard_map.engine.side_effect = lambda project_id: good if project_id == 1 else bad
+        AuditLog()._insert(records)
+
+    metrics.increment.assert_any_call('audit.written', 1)
+    metrics.increment.assert_any_call('audit.dropped', 1)
+    notify_changes.assert_called_once_with(set([1]))
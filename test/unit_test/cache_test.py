@@ -0,0 +1,43 @@
+from bountyfunding.util.cache import LruCache
+from nose.tools import *
+import time
+
+def test_get_put():
+    c = LruCache(2)
+    c.put('a', 1)
+    eq_(1, c.get('a'))
+    eq_(None, c.get('b'))
+
+def test_least_recently_used_evicted():
+    c = LruCache(2)
+    c.put('a', 1)
+    c.put('b', 2)
+    c.get('a')
+    c.put('c', 3)
+    eq_(1, c.get('a'))
+    eq_(None, c.get('b'))
+    eq_(3, c.get('c'))
+
+def test_expired():
+    c = LruCache(2, ttl=0.01)
+    c.put('a', 1)
+    time.sleep(0.02)
+    eq_(None, c.get('a'))
+    eq_(0, len(c))
+
+def test_invalidate_if():
+    c = LruCache(3)
+    c.put('a', 1)
+    c.put('b', 2)
+    c.invalidate_if(lambda k, v: v == 2)
+    eq_(1, c.get('a'))
+    eq_(None, c.get('b'))
+
+def test_put_after_invalidation_ignored():
+    c = LruCache(2)
+    version = c.version
+    c.invalidate('a')
+    c.put('a', 1, version)
+    eq_(None, c.get('a'))
+    c.put('a', 2, c.version)
+    eq_(2, c.get('a'))
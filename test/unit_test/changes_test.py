@@ -0,0 +1,26 @@
+from bountyfunding.core.changes import ChangeNotifier, change_type
+from nose.tools import *
+import threading
+
+
+def test_change_type():
+    eq_('issue', change_type('/issues'))
+    eq_('issue', change_type('/issue/1'))
+    eq_('sponsorship', change_type('/issue/1/sponsorships'))
+    eq_('payment', change_type('/issue/1/sponsorship/jane/payment'))
+    eq_('email', change_type('/emails/claim'))
+    eq_('user', change_type('/user/jane'))
+    eq_('other', change_type('/batch'))
+
+def test_wait_woken_by_notify():
+    notifier = ChangeNotifier()
+    versions = notifier.snapshot(['a', 'b'])
+    threading.Timer(0.05, lambda: notifier.notify(['b'])).start()
+    current = notifier.wait(versions, 5)
+    eq_({'a': 0, 'b': 1}, current)
+
+def test_wait_timeout():
+    notifier = ChangeNotifier()
+    notifier.notify(['b'])
+    versions = notifier.snapshot(['a'])
+    eq_(versions, notifier.wait(versions, 0.01))
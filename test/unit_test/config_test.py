@@ -1,18 +1,45 @@
 from nose.tools import *
 from mock import MagicMock
 
-from bountyfunding.core.config import ProjectConfig
+from bountyfunding.core.config import ProjectConfig, ProjectConfigCache
 from bountyfunding.core.models import Config
+from bountyfunding.util.metrics import metrics
 
 
 def test_project_config():
     project_id = 5
     name = 'max_pledge_amount'
     value = 9
-    pc = ProjectConfig(project_id)
-    pc._get_property = MagicMock(return_value=Config(project_id, name, value))
+    cache = ProjectConfigCache()
+    cache._load_properties = MagicMock(return_value=[Config(project_id, name, value)])
+    pc = ProjectConfig(project_id, cache)
 
     v = pc.MAX_PLEDGE_AMOUNT
     eq_(value, v)
-    pc._get_property.assert_called_with(project_id, name)
-    
+    cache._load_properties.assert_called_with(project_id)
+
+def test_project_config_cached():
+    project_id = 5
+    cache = ProjectConfigCache()
+    cache._load_properties = MagicMock(return_value=[
+        Config(project_id, 'max_pledge_amount', 9), 
+        Config(project_id, 'tracker_url', 'http://localhost')])
+    pc = ProjectConfig(project_id, cache)
+    hits = metrics.get('config_cache.hits')
+
+    eq_(9, pc.MAX_PLEDGE_AMOUNT)
+    eq_('http://localhost', pc.TRACKER_URL)
+    eq_(1, cache._load_properties.call_count)
+    eq_(hits + 1, metrics.get('config_cache.hits'))
+
+def test_project_config_invalidate():
+    project_id = 5
+    cache = ProjectConfigCache()
+    cache._load_properties = MagicMock(return_value=[Config(project_id, 'max_pledge_amount', 9)])
+    pc = ProjectConfig(project_id, cache)
+
+    eq_(9, pc.MAX_PLEDGE_AMOUNT)
+    cache._load_properties.return_value = [Config(project_id, 'max_pledge_amount', 7)]
+    cache.invalidate(project_id)
+    eq_(7, pc.MAX_PLEDGE_AMOUNT)
+    eq_(2, cache._load_properties.call_count)
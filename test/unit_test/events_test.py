@@ -0,0 +1,21 @@
+from bountyfunding.api.events import WaitingSlots
+from bountyfunding.core.config import config
+from nose.tools import *
+
+
+def acquire_all(threads):
+    previous = config.THREADS
+    config.THREADS = threads
+    try:
+        slots = WaitingSlots()
+        acquired = 0
+        while slots.acquire():
+            acquired += 1
+        return acquired
+    finally:
+        config.THREADS = previous
+
+def test_waiting_slots_limited_to_quarter_of_threads():
+    eq_(0, acquire_all(1))
+    eq_(1, acquire_all(4))
+    eq_(4, acquire_all(16))
@@ -0,0 +1,83 @@
+from bountyfunding.core.outbox import Outbox, TrackerState, BACKOFF_MAX
+from bountyfunding.util.metrics import metrics
+from nose.tools import *
+from mock import MagicMock
+import threading
+
+
+def create_outbox(pending):
+    outbox = Outbox(sweep_interval=60)
+    outbox._pending_project_ids = MagicMock(side_effect=pending)
+    notified = threading.Event()
+    outbox._notify = MagicMock(side_effect=lambda project_ids: project_ids and notified.set())
+    outbox._digest_window = MagicMock(return_value=0)
+    return outbox, notified
+
+def test_dirty_project_notified_immediately():
+    outbox, notified = create_outbox([set()])
+    outbox.start()
+    outbox.mark_dirty(3)
+    ok_(notified.wait(1))
+    outbox.stop()
+    eq_(set([3]), set().union(*[args[0] for args, kwargs in outbox._notify.call_args_list]))
+
+def test_pending_emails_swept_on_start():
+    outbox, notified = create_outbox([set([1, 2])])
+    outbox.sweep_interval = 0.01
+    outbox.start()
+    ok_(notified.wait(1))
+    outbox.stop()
+    outbox._notify.assert_any_call(set([1, 2]))
+
+def test_idle_without_pending_emails():
+    outbox, notified = create_outbox([set()])
+    outbox.sweep_interval = 0.01
+    outbox.start()
+    ok_(not notified.wait(0.1))
+    outbox.stop()
+    # Only the initial sweep, then waits for dirty projects
+    eq_(1, outbox._pending_project_ids.call_count)
+
+def test_digest_project_notified_after_window():
+    outbox, notified = create_outbox([set()])
+    outbox._digest_window = MagicMock(return_value=0.2)
+    outbox.start()
+    outbox.mark_dirty(3)
+    outbox.mark_dirty(3)
+    ok_(not notified.wait(0.1))
+    ok_(notified.wait(1))
+    outbox.stop()
+    eq_([set([3])], [args[0] for args, kwargs in outbox._notify.call_args_list if args[0]])
+
+def test_backoff():
+    tracker = TrackerState()
+    ok_(not tracker.is_open(0))
+    tracker.failed(100)
+    ok_(tracker.is_open(100.5))
+    ok_(not tracker.is_open(101))
+    tracker.failed(101)
+    ok_(tracker.is_open(102.5))
+    ok_(not tracker.is_open(103))
+    for i in xrange(20):
+        tracker.failed(1000)
+    ok_(not tracker.is_open(1000 + BACKOFF_MAX))
+    tracker.succeeded()
+    ok_(not tracker.is_open(0))
+
+def test_failed_tracker_skipped():
+    metrics.clear()
+    outbox = Outbox()
+    outbox._ping = MagicMock(return_value=False)
+    outbox.trackers[1] = TrackerState()
+    outbox._ping_tracker((1, 'http://tracker/bountyfunding/email'))
+    ok_(outbox.trackers[1].is_open(0))
+    eq_(1, metrics.get('outbox.ping_errors'))
+
+    # Circuit open, tracker is not pinged
+    outbox._notify([1])
+    eq_(1, outbox._ping.call_count)
+    eq_(1, metrics.get('outbox.skipped'))
+    eq_(1, metrics.get('outbox.circuits_open'))
+    eq_(1, metrics.get('outbox.trackers_failing'))
+    # Metrics are not kept per project
+    eq_([], [name for name in metrics.snapshot() if 'project' in name])
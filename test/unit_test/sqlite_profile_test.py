@@ -0,0 +1,99 @@
+from bountyfunding.core.sqlite_profile import retry_busy, configure_connection, apply_pool_options
+from bountyfunding.core import sqlite_profile
+from bountyfunding.core.config import config
+from bountyfunding.util.metrics import metrics
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from nose.tools import *
+from mock import MagicMock
+import sqlite3, tempfile, shutil, os
+
+
+def busy_error(message='database is locked'):
+    return OperationalError('UPDATE issue', {}, sqlite3.OperationalError(message))
+
+
+class RetryBusy_Test:
+
+    def setup(self):
+        self.backoff = sqlite_profile.BACKOFF_INITIAL
+        sqlite_profile.BACKOFF_INITIAL = 0
+
+    def teardown(self):
+        sqlite_profile.BACKOFF_INITIAL = self.backoff
+
+    def test_retried_until_success(self):
+        function = MagicMock(side_effect=[busy_error(), busy_error(), 'OK'])
+        rollback = MagicMock()
+        retries = metrics.get('sqlite.busy_retries')
+
+        eq_('OK', retry_busy(function, rollback, retries=5))
+        eq_(3, function.call_count)
+        eq_(2, rollback.call_count)
+        eq_(retries + 2, metrics.get('sqlite.busy_retries'))
+
+    @raises(OperationalError)
+    def test_gives_up(self):
+        failures = metrics.get('sqlite.busy_failures')
+        function = MagicMock(side_effect=busy_error())
+        try:
+            retry_busy(function, MagicMock(), retries=2)
+        finally:
+            eq_(3, function.call_count)
+            eq_(failures + 1, metrics.get('sqlite.busy_failures'))
+
+    @raises(OperationalError)
+    def test_other_errors_not_retried(self):
+        function = MagicMock(side_effect=busy_error('no such table: issue'))
+        try:
+            retry_busy(function, MagicMock(), retries=2)
+        finally:
+            eq_(1, function.call_count)
+
+
+class Profile_Test:
+
+    def setup(self):
+        self.profile, self.in_memory = config.SQLITE_PROFILE, config.DATABASE_IN_MEMORY
+        config.DATABASE_IN_MEMORY = False
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        config.SQLITE_PROFILE, config.DATABASE_IN_MEMORY = self.profile, self.in_memory
+        shutil.rmtree(self.directory)
+
+    def pragmas(self):
+        connection = sqlite3.connect(os.path.join(self.directory, 'test.db'))
+        configure_connection(connection, None)
+        pragmas = {}
+        for name in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size'):
+            pragmas[name] = connection.execute('PRAGMA %s' % name).fetchone()[0]
+        connection.close()
+        return pragmas
+
+    def test_default_profile(self):
+        config.SQLITE_PROFILE = 'default'
+        eq_('delete', self.pragmas()['journal_mode'])
+
+        options = {}
+        apply_pool_options(make_url('sqlite:///test.db'), options)
+        eq_({}, options)
+
+    def test_production_profile(self):
+        config.SQLITE_PROFILE = 'production'
+        pragmas = self.pragmas()
+        eq_('wal', pragmas['journal_mode'])
+        eq_(1, pragmas['synchronous'])
+        eq_(config.SQLITE_BUSY_TIMEOUT, pragmas['busy_timeout'])
+        eq_(-config.SQLITE_CACHE_SIZE, pragmas['cache_size'])
+
+        options = {}
+        apply_pool_options(make_url('sqlite:///test.db'), options)
+        eq_(QueuePool, options['poolclass'])
+        eq_(False, options['connect_args']['check_same_thread'])
+
+        options = {}
+        apply_pool_options(make_url('sqlite://'), options)
+        eq_({}, options)
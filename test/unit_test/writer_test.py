@@ -0,0 +1,71 @@
+from bountyfunding.core.writer import Writer
+from nose.tools import *
+import threading
+
+
+def create_writer():
+    writer = Writer()
+    groups = []
+    release = threading.Event()
+    def execute(tasks):
+        groups.append(len(tasks))
+        release.wait(1)
+        for task in tasks:
+            try:
+                task.result = task.function()
+            except Exception as e:
+                task.error = (type(e), e, None)
+            task.done.set()
+    writer._execute = execute
+    return writer, groups, release
+
+def test_result_returned():
+    writer, groups, release = create_writer()
+    release.set()
+    writer.start()
+    eq_(5, writer.submit(lambda: 5))
+    writer.stop()
+
+@raises(ValueError)
+def test_error_raised():
+    writer, groups, release = create_writer()
+    release.set()
+    writer.start()
+    try:
+        writer.submit(lambda: int('x'))
+    finally:
+        writer.stop()
+
+def test_waiting_requests_grouped():
+    writer, groups, release = create_writer()
+    writer.start()
+    results = []
+    def submit(i):
+        results.append(writer.submit(lambda: i))
+
+    first = threading.Thread(target=submit, args=(0,))
+    first.start()
+    while not groups:
+        first.join(0.01)
+    # Arrive while the first group executes
+    others = [threading.Thread(target=submit, args=(i,)) for i in xrange(1, 6)]
+    for t in others:
+        t.start()
+    while writer.queue.qsize() < 5:
+        first.join(0.01)
+    release.set()
+    for t in [first] + others:
+        t.join()
+    writer.stop()
+
+    eq_([1, 5], groups)
+    eq_(range(6), sorted(results))
+
+def test_in_group():
+    writer, groups, release = create_writer()
+    release.set()
+    ok_(not writer.in_group())
+    writer.start()
+    ok_(writer.submit(writer.in_group))
+    ok_(not writer.in_group())
+    writer.stop()